@@ -0,0 +1,463 @@
+import os
+import sys
+import json
+import time
+import array
+import bisect
+import argparse
+import datetime
+import collections
+import pytz
+from event_reader import loads, open_events, read_lines, event_lines, read_event_batches
+
+# statistics of /user_stats and /game_stats calculated in memory from the events file, without a database.
+# the events are cleaned with the rules of the row by row insertion of data_collection.py and in the same order,
+# the users, sessions and matches that are kept are stored in array columns, and the daily and all time statistics
+# are calculated once from them, over utc days and over the local days of the users, as the rollups of
+# data_collection.py are. the results are the same as the results of api.py on a database loaded with the same files,
+# so the engine can be used for local analysis and to check the queries.
+
+# devices of database/init.sql and event window of data_collection.py
+DEVICES = ('ios', 'android', 'web')
+EVENT_TYPES = ('registration', 'session_ping', 'match')
+
+
+def event_window():
+    date_start = datetime.datetime(year=2024, month=10, day=7, hour=0, minute=0, second=0, microsecond=0)
+    date_end = datetime.datetime(year=2024, month=11, day=3, hour=0, minute=0, second=0, microsecond=0)
+
+    return time.mktime(date_start.timetuple()), time.mktime(date_end.timetuple())
+
+
+class EventColumns():
+    # users by the order of registration, and the sessions and matches that were kept, one array per column
+    def __init__(self):
+        self.user_names = []
+        self.user_ids = {}
+        self.user_countries = []
+        self.user_timezones = []
+        self.registration_timestamps = array.array('d')
+        self.session_users = array.array('q')
+        self.session_starts = array.array('d')
+        self.session_ends = array.array('d')
+        self.match_home_users = array.array('q')
+        self.match_away_users = array.array('q')
+        self.match_home_goals = array.array('q')
+        self.match_away_goals = array.array('q')
+        self.match_starts = array.array('d')
+        self.match_ends = array.array('d')
+
+
+class EventCleaner():
+    # replays the row by row insertion. event_ids are the rows of events.event at every moment of the insertion, so a
+    # duplicate event id is refused exactly when the database would refuse it
+    def __init__(self, timezones):
+        self.timezones = timezones
+        self.columns = EventColumns()
+        self.event_ids = set()
+        self.open_sessions = collections.OrderedDict()
+        # the event ids of the first and last ping of the open sessions
+        self.open_event_ids = set()
+        # the first and last timestamp of the sessions written, by user
+        self.user_sessions = collections.defaultdict(list)
+        self.open_matches = {}
+        self.ended_matches = set()
+        self.refused = collections.Counter()
+
+    def insert_event(self, event):
+        self.close_expired(event['event_timestamp'])
+        event_type = event['event_type'].lower()
+        if event_type not in EVENT_TYPES:
+            self.refused['type'] += 1
+            return
+        if event_type == 'session_ping':
+            if 'user_id' not in event['event_data']:
+                self.refused['session_ping'] += 1
+                return
+            if self.ping(event['event_data']['user_id'], event['event_id'], event['event_timestamp']) != 0:
+                self.refused['session_ping'] += 1
+            return
+        if event['event_id'] in self.event_ids or event['event_id'] in self.open_event_ids:
+            self.refused['duplicate'] += 1
+            return
+        self.event_ids.add(event['event_id'])
+        if event_type == 'registration':
+            inserted = self.registration(event['event_data'], event['event_timestamp'])
+        else:
+            inserted = self.match(event['event_data'], event['event_id'], event['event_timestamp'])
+        if not inserted:
+            self.event_ids.discard(event['event_id'])
+            self.refused[event_type] += 1
+
+    def registration(self, event_data, event_timestamp):
+        if ('user_id' not in event_data or 'country' not in event_data or 'device_os' not in event_data
+                or event_data['user_id'] is None):
+            return False
+        user_name = event_data['user_id']
+        device_os, country = event_data['device_os'], event_data['country']
+        country_id = country.upper() if isinstance(country, str) else None
+        if (user_name in self.columns.user_ids or not isinstance(device_os, str) or device_os.lower() not in DEVICES
+                or country_id not in self.timezones):
+            return False
+        self.columns.user_ids[user_name] = len(self.columns.user_names)
+        self.columns.user_names.append(user_name)
+        self.columns.user_countries.append(country_id)
+        self.columns.user_timezones.append(self.timezones[country_id])
+        self.columns.registration_timestamps.append(event_timestamp)
+        return True
+
+    # the codes of the session tracker: 3 for a ping seen before, 4 for a ping before the last ping of the open session
+    def ping(self, user_name, event_id, event_timestamp):
+        session = self.open_sessions.get(user_name)
+        if event_id in self.open_event_ids or (session is not None and session[2] <= event_timestamp <= session[4]
+                                               and (event_timestamp - session[2]) % 60 == 0):
+            return 3
+        if session is not None and session[4] + 60 == event_timestamp:
+            self.open_event_ids.discard(session[3])
+            session[3] = event_id
+            session[4] = event_timestamp
+            self.open_event_ids.add(event_id)
+            self.open_sessions.move_to_end(user_name)
+            return 0
+        user_id = session[0] if session is not None else self.columns.user_ids.get(user_name)
+        if event_id in self.event_ids or any(start < event_timestamp < end
+                                             for start, end in self.user_sessions.get(user_id, ())):
+            return 3
+        if user_id is None:
+            return 2
+        if session is not None and event_timestamp < session[4]:
+            return 4
+        if session is not None:
+            self.close(user_name)
+        # user, first event id and timestamp, last event id and timestamp
+        self.open_sessions[user_name] = [user_id, event_id, event_timestamp, None, event_timestamp]
+        self.open_event_ids.add(event_id)
+        return 0
+
+    def close_expired(self, event_timestamp):
+        while self.open_sessions:
+            user_name, session = next(iter(self.open_sessions.items()))
+            if session[4] + 60 >= event_timestamp:
+                break
+            self.close(user_name)
+
+    # a session is kept with its first and last ping, if neither of them is a duplicate event
+    def close(self, user_name):
+        user_id, start_event_id, start_timestamp, last_event_id, last_timestamp = self.open_sessions.pop(user_name)
+        self.open_event_ids.difference_update((start_event_id, last_event_id))
+        if last_event_id is None:
+            return
+        if start_event_id in self.event_ids:
+            self.refused['session_ping'] += 1
+            return
+        self.event_ids.add(start_event_id)
+        if last_event_id in self.event_ids:
+            self.event_ids.discard(start_event_id)
+            self.refused['session_ping'] += 1
+            return
+        self.event_ids.add(last_event_id)
+        self.user_sessions[user_id].append((start_timestamp, last_timestamp))
+        self.columns.session_users.append(user_id)
+        self.columns.session_starts.append(start_timestamp)
+        self.columns.session_ends.append(last_timestamp)
+
+    def match(self, event_data, event_id, event_timestamp):
+        if ('match_id' not in event_data or 'home_user_id' not in event_data or 'away_user_id' not in event_data
+                or 'home_goals_scored' not in event_data or 'away_goals_scored' not in event_data):
+            return False
+        if event_data['home_user_id'] == event_data['away_user_id']:
+            return False
+        match_id = event_data['match_id']
+        if event_data['home_goals_scored'] is not None or event_data['away_goals_scored'] is not None:
+            if event_data['home_goals_scored'] is None or event_data['away_goals_scored'] is None:
+                return False
+            started_match = self.open_matches.get(match_id)
+            if (started_match is None or started_match[0] != event_data['home_user_id']
+                    or started_match[1] != event_data['away_user_id'] or event_timestamp < started_match[4]):
+                return False
+            del self.open_matches[match_id]
+            self.ended_matches.add(match_id)
+            self.columns.match_home_users.append(started_match[2])
+            self.columns.match_away_users.append(started_match[3])
+            self.columns.match_home_goals.append(int(event_data['home_goals_scored']))
+            self.columns.match_away_goals.append(int(event_data['away_goals_scored']))
+            self.columns.match_starts.append(started_match[4])
+            self.columns.match_ends.append(event_timestamp)
+            return True
+        if match_id is None or match_id in self.open_matches or match_id in self.ended_matches:
+            return False
+        home_user_id = self.columns.user_ids.get(event_data['home_user_id'])
+        away_user_id = self.columns.user_ids.get(event_data['away_user_id'])
+        if home_user_id is None or away_user_id is None:
+            return False
+        self.open_matches[match_id] = (event_data['home_user_id'], event_data['away_user_id'], home_user_id,
+                                       away_user_id, event_timestamp, event_id)
+        return True
+
+    # the sessions still open are over, the matches still open never end
+    def finish(self):
+        while self.open_sessions:
+            self.close(next(iter(self.open_sessions)))
+        for started_match in self.open_matches.values():
+            self.event_ids.discard(started_match[5])
+        if self.open_matches:
+            self.refused['unterminated_match'] += len(self.open_matches)
+            self.open_matches.clear()
+
+
+# the timezone of every country of the timezones file, the first value of a country is kept
+def read_timezones(filename):
+    timezones = {}
+    with open_events(filename) as timezones_file:
+        for lines in read_lines(timezones_file):
+            for line in lines:
+                if line.strip():
+                    line = loads(line)
+                    timezones.setdefault(line.get('country').upper(), line.get('timezone'))
+    return timezones
+
+
+# with sort, the events are cleaned in the order of their timestamps, as data_collection.py does with --sort
+def read_events(timezones_filename, events_filename, sort=False):
+    unix_date_start, unix_date_end = event_window()
+    cleaner = EventCleaner(read_timezones(timezones_filename))
+    with event_lines(events_filename, sort) as lines:
+        for batch in read_event_batches(lines, unix_date_start, unix_date_end):
+            for _, _, event, refusal in batch:
+                if refusal is None:
+                    cleaner.insert_event(event)
+                else:
+                    cleaner.refused[refusal] += 1
+    cleaner.finish()
+    return cleaner.columns, cleaner.refused
+
+
+class AnalyticsEngine():
+    # the statistics are indexed by local_day, False for utc days and True for the local days of the users. days are
+    # date ordinals. user_days holds for every user and day the sessions started, the time spent in sessions, the
+    # points won home and away and the time spent in matches. sessions are counted on every day they overlap in the
+    # daily game statistics, matches on the day they started.
+    def __init__(self, columns):
+        self.columns = columns
+        self.midnights = {}
+        self.user_days = {}
+        self.login_days = {}
+        self.daily_game = {}
+        for local_day in (False, True):
+            self.summarise_days(local_day)
+        self.summarise_users()
+        self.summarise_game()
+
+    def timezone(self, user_id, local_day):
+        return pytz.timezone(self.columns.user_timezones[user_id]) if local_day else pytz.utc
+
+    # the unix timestamps of the midnights starting the days around the event window in the timezone, the day of a
+    # timestamp is found among them with a binary search
+    def timezone_midnights(self, timezone):
+        if timezone.zone not in self.midnights:
+            unix_date_start, unix_date_end = event_window()
+            first_day = datetime.date.fromtimestamp(unix_date_start).toordinal() - 2
+            last_day = datetime.date.fromtimestamp(unix_date_end).toordinal() + 2
+            self.midnights[timezone.zone] = (first_day, array.array('d', (
+                timezone.localize(datetime.datetime.fromordinal(day)).timestamp()
+                for day in range(first_day, last_day + 2))))
+        return self.midnights[timezone.zone]
+
+    def midnight(self, day, timezone):
+        first_day, midnights = self.timezone_midnights(timezone)
+        if 0 <= day - first_day < len(midnights):
+            return midnights[day - first_day]
+        return timezone.localize(datetime.datetime.fromordinal(day)).timestamp()
+
+    def day_of(self, timestamp, timezone):
+        first_day, midnights = self.timezone_midnights(timezone)
+        position = bisect.bisect_right(midnights, timestamp)
+        if 0 < position < len(midnights):
+            return first_day + position - 1
+        return datetime.datetime.fromtimestamp(timestamp, timezone).toordinal()
+
+    def overlap(self, start, end, day, timezone):
+        return min(end, self.midnight(day + 1, timezone)) - max(start, self.midnight(day, timezone))
+
+    def summarise_days(self, local_day):
+        columns = self.columns
+        user_days = collections.defaultdict(dict)
+        day_sessions = collections.defaultdict(collections.Counter)
+        day_points = collections.defaultdict(collections.Counter)
+        for user_id, start, end in zip(columns.session_users, columns.session_starts, columns.session_ends):
+            timezone = self.timezone(user_id, local_day)
+            start_day = self.day_of(start, timezone)
+            for day in range(start_day, self.day_of(end, timezone) + 1):
+                day_sessions[day][user_id] += 1
+                activity = user_days[user_id].setdefault(day, [0, 0.0, 0, 0, 0.0])
+                activity[0] += day == start_day
+                activity[1] += self.overlap(start, end, day, timezone)
+        for home_user_id, away_user_id, home_goals, away_goals, start, end in zip(
+                columns.match_home_users, columns.match_away_users, columns.match_home_goals,
+                columns.match_away_goals, columns.match_starts, columns.match_ends):
+            home_points = 3 if home_goals > away_goals else 1 if home_goals == away_goals else 0
+            away_points = 3 if away_goals > home_goals else 1 if away_goals == home_goals else 0
+            for user_id, points, score in ((home_user_id, home_points, 2), (away_user_id, away_points, 3)):
+                timezone = self.timezone(user_id, local_day)
+                start_day = self.day_of(start, timezone)
+                day_points[start_day][user_id] += points
+                for day in range(start_day, self.day_of(end, timezone) + 1):
+                    activity = user_days[user_id].setdefault(day, [0, 0.0, 0, 0, 0.0])
+                    if day == start_day:
+                        activity[score] += points
+                    activity[4] += self.overlap(start, end, day, timezone)
+
+        self.user_days[local_day] = user_days
+        # the days with a session started, sorted, for the last login on or before a day
+        self.login_days[local_day] = {user_id: array.array('l', sorted(day for day, activity in days.items()
+                                                                        if activity[0] > 0))
+                                      for user_id, days in user_days.items()}
+        daily_game = {}
+        for day in day_sessions.keys() | day_points.keys():
+            sessions = day_sessions.get(day, {})
+            number_of_sessions = sum(sessions.values())
+            daily_game[day] = (len(sessions), number_of_sessions,
+                               number_of_sessions / len(sessions) if sessions else 0.0,
+                               self.max_points_users(day_points.get(day, {})))
+        self.daily_game[local_day] = daily_game
+
+    def max_points_users(self, points):
+        if not points:
+            return []
+        max_points = max(points.values())
+        return sorted(self.columns.user_names[user_id] for user_id, user_points in points.items()
+                      if user_points == max_points)
+
+    # the all time activity of every user is the sum of its utc days
+    def summarise_users(self):
+        self.user_summary = {}
+        for user_id, days in self.user_days[False].items():
+            summary = [0, 0.0, 0, 0, 0.0]
+            for activity in days.values():
+                for column, value in enumerate(activity):
+                    summary[column] += value
+            self.user_summary[user_id] = summary
+
+    # sessions overlapping several days are counted once here, so the totals are not a sum of the days
+    def summarise_game(self):
+        columns = self.columns
+        dau = len(set(columns.session_users))
+        points = collections.Counter()
+        for user_id, days in self.user_days[False].items():
+            for activity in days.values():
+                points[user_id] += activity[2] + activity[3]
+        # only the users that played a match are ranked
+        played = set(columns.match_home_users) | set(columns.match_away_users)
+        self.total_game = (dau, len(columns.session_users), len(columns.session_users) / dau if dau else 0.0,
+                           self.max_points_users({user_id: points[user_id] for user_id in played}))
+
+    # the fields of /user_stats, or None if the user is not in the system
+    def user_stats(self, user_name, date=None, local_day=False):
+        user_id = self.columns.user_ids.get(user_name)
+        if user_id is None:
+            return None
+        login_days = self.login_days[local_day].get(user_id, array.array('l'))
+        if date is None:
+            activity = self.user_summary.get(user_id, [0, 0.0, 0, 0, 0.0])
+            last_login = login_days[-1] if login_days else None
+        else:
+            activity = self.user_days[local_day].get(user_id, {}).get(date.toordinal(), [0, 0.0, 0, 0, 0.0])
+            position = bisect.bisect_right(login_days, date.toordinal())
+            last_login = login_days[position - 1] if position else None
+        sessions_number, time_spent, score_home, score_away, match_time = activity
+        country_timezone = self.columns.user_timezones[user_id]
+        registration = datetime.datetime.fromtimestamp(self.columns.registration_timestamps[user_id], pytz.utc)
+        result = {}
+        result['country_id'] = self.columns.user_countries[user_id]
+        result['country_timezone'] = country_timezone
+        result['timestamp_local'] = str(registration.astimezone(pytz.timezone(country_timezone)))
+        if last_login is not None:
+            result['days_since_last_login'] = ((date if date is not None else datetime.date.today())
+                                               - datetime.date.fromordinal(last_login)).days
+        else:
+            result['days_since_last_login'] = "No last login."
+        result['sessions_number'] = sessions_number
+        result['time_spent'] = int(time_spent)
+        result['score_home'] = score_home
+        result['score_away'] = score_away
+        result['active_time_played_percentage'] = match_time / (time_spent if time_spent > 0 else 1) * 100
+        return result
+
+    # the fields of /game_stats, of all time or of a day
+    def game_stats(self, date=None, local_day=False):
+        if date is None:
+            dau, number_of_sessions, average_sessions_number, max_points_users = self.total_game
+        else:
+            dau, number_of_sessions, average_sessions_number, max_points_users = \
+                self.daily_game[local_day].get(date.toordinal(), (0, 0, 0.0, []))
+        return {'dau': dau, 'number_of_sessions': number_of_sessions,
+                'average_sessions_number': average_sessions_number, 'max_points_users': max_points_users}
+
+
+# the functions below answer the tests of basic_tests with the engine of the files ANALYTICS_TIMEZONES and
+# ANALYTICS_EVENTS, read on the first call:
+# ANALYTICS_EVENTS=events_test.jsonl python basic_tests/test_user_level_stats.py analytics user_level_stats
+harness_engine = None
+
+
+def get_harness_engine():
+    global harness_engine
+    if harness_engine is None:
+        columns, _ = read_events(os.environ.get('ANALYTICS_TIMEZONES', 'timezones.jsonl'),
+                                 os.environ.get('ANALYTICS_EVENTS', 'events.jsonl'))
+        harness_engine = AnalyticsEngine(columns)
+    return harness_engine
+
+
+def parse_date(date):
+    return datetime.date.fromisoformat(date) if isinstance(date, str) else date
+
+
+def user_level_stats(user_id, date=None):
+    result = get_harness_engine().user_stats(user_id, parse_date(date))
+    if result is None:
+        return None
+    return {'country': result['country_id'],
+            'days_since_last_login': result['days_since_last_login'],
+            'registration_date_local_timezone': result['timestamp_local'][:19],
+            'number_of_sessions': result['sessions_number'],
+            'time_spent_in_game': result['time_spent'],
+            'total_points_won_home': result['score_home'],
+            'total_points_won_away': result['score_away'],
+            'percentage_time_spent_in_match': result['active_time_played_percentage']}
+
+
+def game_level_stats(date=None):
+    result = get_harness_engine().game_stats(parse_date(date))
+    return {'active_users': result['dau'],
+            'number_of_sessions': result['number_of_sessions'],
+            'avg_sessions_for_users': result['average_sessions_number'],
+            'user_with_most_points': result['max_points_users'][0] if result['max_points_users'] else None}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Calculate the statistics of the events in memory.')
+    parser.add_argument('timezones', help='file towards timezones')
+    parser.add_argument('events', help='file towards events')
+    parser.add_argument('--user', help='user to show the statistics of, the game statistics are shown otherwise')
+    parser.add_argument('--date', type=datetime.date.fromisoformat, metavar='YYYY-MM-DD',
+                        help='day of the statistics, all time if not given')
+    parser.add_argument('--timezone', choices=['utc', 'local'], default='utc',
+                        help='calculate the days in utc or in the local timezone of the users')
+    parser.add_argument('--sort', action='store_true',
+                        help='sort the events by timestamp and event id, for files that are not in order')
+    arguments = parser.parse_args()
+
+    started = time.perf_counter()
+    columns, refused = read_events(arguments.timezones, arguments.events, arguments.sort)
+    engine = AnalyticsEngine(columns)
+    print(f"{len(columns.user_names)} users, {len(columns.session_users)} sessions and {len(columns.match_starts)} "
+          f"matches in {time.perf_counter() - started:.1f} s, refused {dict(refused)}", file=sys.stderr)
+    if arguments.user:
+        result = engine.user_stats(arguments.user, arguments.date, arguments.timezone == 'local')
+        if result is None:
+            print(f"No user with given id {arguments.user} in the system", file=sys.stderr)
+            sys.exit(1)
+    else:
+        result = engine.game_stats(arguments.date, arguments.timezone == 'local')
+    print(json.dumps(result, indent=2))
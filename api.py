@@ -1,7 +1,15 @@
 import os
+import json
+import time
+import bisect
+import threading
+import contextlib
+import collections
 import pytz
 import psycopg2
-from flask import Flask, request, jsonify
+import psycopg2.extensions
+import psycopg2.pool
+from flask import Flask, request, jsonify, g, Response, stream_with_context
 from config import Configuration
 
 import datetime
@@ -9,13 +17,456 @@ import datetime
 app = Flask(__name__)
 app.config.from_object(Configuration)
 
-conn = psycopg2.connect(
+# every request checks out its own connection, so requests run their queries concurrently and a failed
+# transaction of one request cannot affect the others
+pool = psycopg2.pool.ThreadedConnectionPool(
+    app.config.get('DATABASE_POOL_MIN'), app.config.get('DATABASE_POOL_MAX'),
     dbname=os.environ.get('DATABASE_NAME', default='events_db'),
     user=os.environ.get('DATABASE_USER', default='postgres'),
     password=os.environ.get('DATABASE_PASSWORD', default='postgres_password'),
     host=os.environ.get('DATABASE_HOST', default='localhost'),
     port=os.environ.get('DATABASE_PORT', default='5432')
 )
+# the pool refuses a connection once all are checked out, requests wait for a free one instead
+pool_slots = threading.BoundedSemaphore(app.config.get('DATABASE_POOL_MAX'))
+
+
+class Metrics():
+    # counters, gauges and latency histograms, read by /metrics in the text format of prometheus. an observation
+    # only adds to a few numbers under a lock, the text is built when /metrics is read
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.gauges = collections.Counter()
+        # by name and labels: the number of observations in every bucket and above the last one, and their sum
+        self.histograms = {}
+
+    def count(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += 1
+
+    def add_gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] += value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        bucket = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][bucket] += 1
+            histogram[1] += seconds
+
+    # counters and gauges read when /metrics is read are passed by name and labels
+    def exposition(self, counters, gauges):
+        lines = []
+        with self.lock:
+            counters = sorted(list(self.counters.items()) + list(counters.items()))
+            gauges = sorted(list(self.gauges.items()) + list(gauges.items()))
+            histograms = sorted((key, (list(counts), total)) for key, (counts, total) in self.histograms.items())
+        for kind, samples in (('counter', counters), ('gauge', gauges)):
+            for position, ((name, labels), value) in enumerate(samples):
+                if position == 0 or samples[position - 1][0][0] != name:
+                    lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name}{format_labels(labels)} {value}")
+        for position, ((name, labels), (counts, total)) in enumerate(histograms):
+            if position == 0 or histograms[position - 1][0][0] != name:
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', format_bound(bound)),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+                          for name, value in labels) + "}"
+
+
+def format_bound(bound):
+    return "+Inf" if bound == float('inf') else repr(bound)
+
+
+metrics = Metrics(app.config.get('METRICS_BUCKETS'))
+
+
+# the duration of the block is observed in the histogram
+@contextlib.contextmanager
+def timed(name, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe(name, time.perf_counter() - started, **labels)
+
+
+# every request is counted by endpoint, method and status, and its duration observed by endpoint. the duration of a
+# streamed response is the time until the response starts
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response):
+    endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    metrics.count('api_requests_total', endpoint=endpoint, method=request.method, status=response.status_code)
+    if 'request_started' in g:
+        metrics.observe('api_request_duration_seconds', time.perf_counter() - g.request_started, endpoint=endpoint)
+    return response
+
+
+class DatabaseUnavailable(Exception):
+    pass
+
+
+def get_connection():
+    if 'conn' not in g:
+        with timed('api_pool_wait_seconds'):
+            acquired = pool_slots.acquire(timeout=app.config.get('DATABASE_POOL_TIMEOUT'))
+        if not acquired:
+            metrics.count('api_pool_timeouts_total')
+            raise DatabaseUnavailable()
+        conn = None
+        try:
+            conn = pool.getconn()
+            # connections that were closed or broken while in the pool are replaced by new ones
+            if conn.closed or conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                pool.putconn(conn, close=True)
+                conn = None
+                conn = pool.getconn()
+            # the api only reads, so no transaction is left open between queries
+            conn.autocommit = True
+        except psycopg2.Error:
+            # a connection taken from the pool is given back closed, so it is neither lost nor reused
+            if conn is not None:
+                pool.putconn(conn, close=True)
+            pool_slots.release()
+            raise DatabaseUnavailable()
+        g.conn = conn
+        metrics.add_gauge('api_pool_connections_in_use', 1)
+    return g.conn
+
+
+@app.teardown_appcontext
+def return_connection(exception):
+    conn = g.pop('conn', None)
+    if conn is not None:
+        # a connection that failed is closed, the pool opens a new one on the next checkout
+        pool.putconn(conn, close=bool(conn.closed) or isinstance(exception, psycopg2.OperationalError))
+        pool_slots.release()
+        metrics.add_gauge('api_pool_connections_in_use', -1)
+
+
+@app.errorhandler(DatabaseUnavailable)
+@app.errorhandler(psycopg2.OperationalError)
+def database_unavailable(error):
+    # the request failed before the connection is returned, so it is marked as broken here
+    if isinstance(error, psycopg2.OperationalError) and 'conn' in g:
+        pool.putconn(g.pop('conn'), close=True)
+        pool_slots.release()
+        metrics.add_gauge('api_pool_connections_in_use', -1)
+    return "Database is unavailable, try again later", 503
+
+
+class ResponseCache():
+    # responses by endpoint and normalized request. the least recently used response is evicted when full, and all
+    # of them are dropped once data_collection.py loads new data and bumps the data version in the database.
+    def __init__(self, size, version_check_seconds):
+        self.size = size
+        self.version_check_seconds = version_check_seconds
+        self.responses = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.data_version = None
+        self.version_checked_at = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    # the version is read from the database at most once every version_check_seconds
+    def check_version(self):
+        checked_at = time.monotonic()
+        if self.version_checked_at is not None and checked_at - self.version_checked_at < self.version_check_seconds:
+            return self.data_version
+        with get_connection().cursor() as version_cursor, timed('api_query_duration_seconds', query='data_version'):
+            version_cursor.execute("SELECT version FROM events.data_version")
+            version_data = version_cursor.fetchone()
+        with self.lock:
+            self.version_checked_at = checked_at
+            if version_data is None or version_data[0] != self.data_version:
+                if self.responses:
+                    self.invalidations += 1
+                self.responses.clear()
+                self.data_version = version_data[0] if version_data is not None else None
+            return self.data_version
+
+    # returns the data version and the cached response, or None if there is none
+    def get(self, key):
+        version = self.check_version()
+        with self.lock:
+            response = self.responses.get(key)
+            if response is None:
+                self.misses += 1
+                return version, None
+            self.hits += 1
+            self.responses.move_to_end(key)
+            return version, response
+
+    # a response read before the data version changed is not cached
+    def put(self, key, version, response):
+        with self.lock:
+            if version is None or version != self.data_version:
+                return
+            self.responses[key] = response
+            self.responses.move_to_end(key)
+            if len(self.responses) > self.size:
+                self.responses.popitem(last=False)
+                self.evictions += 1
+
+    def statistics(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'invalidations': self.invalidations, 'size': len(self.responses), 'max_size': self.size,
+                    'data_version': self.data_version}
+
+
+response_cache = ResponseCache(app.config.get('RESPONSE_CACHE_SIZE'), app.config.get('DATA_VERSION_CHECK_SECONDS'))
+
+
+# first and last day of the collected events, other dates are refused
+start_date = datetime.date(year=2024, month=10, day=7)
+end_date = datetime.date(year=2024, month=11, day=3)
+
+
+# returns the date and None, or None and the reason the value is refused
+def parse_date(value):
+    try:
+        date = datetime.date.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None, "Invalid date format, try YYYY-MM-DD"
+    if not (start_date <= date <= end_date):
+        return None, f"Date must be between bounds {start_date} and {end_date} inclusive"
+    return date, None
+
+
+# the dates of the keys dates, a list of dates, or from and to, the first and the last day of a range. returns the
+# sorted dates or None if none of the keys is given, and the reason the values are refused
+def parse_dates(values):
+    if 'dates' in values:
+        if not isinstance(values['dates'], list) or not values['dates']:
+            return None, "Dates must be a list of dates"
+        dates = []
+        for value in values['dates']:
+            date, error = parse_date(value)
+            if error:
+                return None, error
+            dates.append(date)
+        return sorted(set(dates)), None
+    if 'from' in values or 'to' in values:
+        if 'from' not in values or 'to' not in values:
+            return None, "Date range needs both from and to"
+        first_date, error = parse_date(values['from'])
+        if error:
+            return None, error
+        last_date, error = parse_date(values['to'])
+        if error:
+            return None, error
+        if first_date > last_date:
+            return None, "Date from must not be after date to"
+        return [first_date + datetime.timedelta(days=day) for day in range((last_date - first_date).days + 1)], None
+    return None, None
+
+
+# the key timezone chooses the days the statistics are calculated over, utc days (the default) or the local days of
+# the users in the timezone of their country. returns True for local days, and the reason the value is refused
+def parse_local_day(values):
+    value = values.get('timezone', 'utc')
+    if value not in ('utc', 'local'):
+        return None, "Timezone must be utc or local"
+    return value == 'local', None
+
+
+# the statistics of the requested users from the summaries built by data_collection.py, in the order of the request.
+# the columns are the user, the date and the fields read by user_stats_result, which are null for the users missing
+# from the summaries
+user_stats_summary_query = (
+    "SELECT requested.user_name, NULL::DATE, s.country_id, s.timezone, s.registration_ts, "
+    "CASE WHEN %(local_day)s THEN s.last_login_local ELSE s.last_login END, s.sessions_number, s.time_spent, "
+    "s.score_home, s.score_away, "
+    "s.match_time * 1.0 / CASE WHEN s.time_spent > 0 THEN s.time_spent ELSE 1 END * 100 "
+    "FROM unnest(%(user_names)s::TEXT[]) WITH ORDINALITY requested(user_name, position) "
+    "LEFT JOIN stats.user_summary s ON s.user_name = requested.user_name "
+    "ORDER BY requested.position")
+
+# the same for every requested user and day: the last login on or before the day, and the activity of that day
+user_stats_summary_day_query = (
+    "SELECT requested.user_name, requested_day.day, s.country_id, s.timezone, s.registration_ts, "
+    "(SELECT MAX(l.day) FROM stats.user_day l WHERE l.user_id = s.user_id "
+    "AND l.local_day = %(local_day)s AND l.day <= requested_day.day AND l.sessions_number > 0), "
+    "COALESCE(d.sessions_number, 0), COALESCE(d.time_spent, 0), "
+    "COALESCE(d.score_home, 0), COALESCE(d.score_away, 0), "
+    "COALESCE(d.match_time, 0) * 1.0 / CASE WHEN d.time_spent > 0 THEN d.time_spent ELSE 1 END * 100 "
+    "FROM unnest(%(user_names)s::TEXT[]) WITH ORDINALITY requested(user_name, position) "
+    "LEFT JOIN stats.user_summary s ON s.user_name = requested.user_name "
+    "CROSS JOIN unnest(%(days)s::DATE[]) requested_day(day) "
+    "LEFT JOIN stats.user_day d ON d.user_id = s.user_id AND d.local_day = %(local_day)s "
+    "AND d.day = requested_day.day "
+    "ORDER BY requested.position, requested_day.day")
+
+# the statistics of the requested users calculated from the events, for users that are not in the summaries yet, in
+# the order of the request. users that are not registered have no row. the sessions and the matches of the users are
+# read once, and the columns are the same as in user_stats_summary_query
+user_stats_live_query = (
+    "WITH registered AS ("
+    "SELECT requested.position, u.user_name, u.user_id, c.country_id, c.timezone, e.event_timestamp registration_ts "
+    "FROM unnest(%(user_names)s::TEXT[]) WITH ORDINALITY requested(user_name, position) "
+    "JOIN users.user u ON u.user_name = requested.user_name "
+    "JOIN events.registration r ON r.user_id = u.user_id "
+    "JOIN events.event e ON e.event_id = r.event_id JOIN country.country c ON c.country_id = r.country_code), "
+    "sessions AS ("
+    "SELECT user_id, MAX(CASE WHEN %(local_day)s THEN start_local_day ELSE start_day END) last_login, "
+    "COUNT(*) sessions_number, SUM(duration)::NUMERIC time_spent "
+    "FROM events.session WHERE user_id IN (SELECT user_id FROM registered) GROUP BY user_id), "
+    "matches AS ("
+    "SELECT r.user_id, "
+    "SUM(CASE WHEN m.home_user_id = r.user_id AND m.home_goals_scored > m.away_goals_scored THEN 3 "
+    "WHEN m.home_user_id = r.user_id AND m.home_goals_scored = m.away_goals_scored THEN 1 ELSE 0 END) score_home, "
+    "SUM(CASE WHEN m.away_user_id = r.user_id AND m.away_goals_scored > m.home_goals_scored THEN 3 "
+    "WHEN m.away_user_id = r.user_id AND m.away_goals_scored = m.home_goals_scored THEN 1 ELSE 0 END) score_away, "
+    "SUM(EXTRACT (EPOCH FROM m.end_ts - m.start_ts)) match_time "
+    "FROM registered r JOIN events.match m ON m.home_user_id = r.user_id OR m.away_user_id = r.user_id "
+    "GROUP BY r.user_id) "
+    "SELECT r.user_name, NULL::DATE, r.country_id, r.timezone, r.registration_ts, s.last_login, "
+    "COALESCE(s.sessions_number, 0), COALESCE(s.time_spent, 0), COALESCE(m.score_home, 0), "
+    "COALESCE(m.score_away, 0), "
+    "COALESCE(m.match_time, 0) * 1.0 / CASE WHEN s.time_spent > 0 THEN s.time_spent ELSE 1 END * 100 "
+    "FROM registered r LEFT JOIN sessions s ON s.user_id = r.user_id LEFT JOIN matches m ON m.user_id = r.user_id "
+    "ORDER BY r.position")
+
+# the same for every requested user and day. time of sessions and matches is the part that overlaps the day, which
+# starts at midnight utc or at midnight in the timezone of the user, and the day buckets of the same semantics are
+# compared. sessions and matches are partitioned by the utc day they end on, and only the partitions from the day
+# before the first requested day on are read, except for the last login
+user_stats_live_day_query = (
+    "WITH registered AS ("
+    "SELECT requested.position, u.user_name, u.user_id, c.country_id, c.timezone, e.event_timestamp registration_ts "
+    "FROM unnest(%(user_names)s::TEXT[]) WITH ORDINALITY requested(user_name, position) "
+    "JOIN users.user u ON u.user_name = requested.user_name "
+    "JOIN events.registration r ON r.user_id = u.user_id "
+    "JOIN events.event e ON e.event_id = r.event_id JOIN country.country c ON c.country_id = r.country_code), "
+    "sessions AS ("
+    "SELECT s.user_id, requested_day.day, "
+    "COUNT(*) FILTER (WHERE bucket.start_day = requested_day.day) sessions_number, "
+    "SUM(EXTRACT (EPOCH FROM LEAST(s.end_ts, (requested_day.day + 1)::TIMESTAMP AT TIME ZONE bucket.timezone) "
+    "- GREATEST(s.start_ts, requested_day.day::TIMESTAMP AT TIME ZONE bucket.timezone))) time_spent "
+    "FROM events.session s CROSS JOIN LATERAL (SELECT "
+    "CASE WHEN %(local_day)s THEN s.timezone ELSE 'UTC' END timezone, "
+    "CASE WHEN %(local_day)s THEN s.start_local_day ELSE s.start_day END start_day, "
+    "CASE WHEN %(local_day)s THEN s.end_local_day ELSE s.end_day END end_day) bucket "
+    "JOIN unnest(%(days)s::DATE[]) requested_day(day) "
+    "ON requested_day.day BETWEEN bucket.start_day AND bucket.end_day "
+    "WHERE s.user_id IN (SELECT user_id FROM registered) "
+    "AND s.end_ts >= (%(first_day)s::DATE - 1)::TIMESTAMP AT TIME ZONE 'UTC' "
+    "GROUP BY s.user_id, requested_day.day), "
+    "matches AS ("
+    "SELECT r.user_id, requested_day.day, "
+    "SUM(CASE WHEN bucket.start_day <> requested_day.day THEN 0 "
+    "WHEN m.home_user_id = r.user_id AND m.home_goals_scored > m.away_goals_scored THEN 3 "
+    "WHEN m.home_user_id = r.user_id AND m.home_goals_scored = m.away_goals_scored THEN 1 ELSE 0 END) score_home, "
+    "SUM(CASE WHEN bucket.start_day <> requested_day.day THEN 0 "
+    "WHEN m.away_user_id = r.user_id AND m.away_goals_scored > m.home_goals_scored THEN 3 "
+    "WHEN m.away_user_id = r.user_id AND m.away_goals_scored = m.home_goals_scored THEN 1 ELSE 0 END) score_away, "
+    "SUM(EXTRACT (EPOCH FROM LEAST(m.end_ts, (requested_day.day + 1)::TIMESTAMP AT TIME ZONE bucket.timezone) "
+    "- GREATEST(m.start_ts, requested_day.day::TIMESTAMP AT TIME ZONE bucket.timezone))) match_time "
+    "FROM registered r JOIN events.match m ON m.home_user_id = r.user_id OR m.away_user_id = r.user_id "
+    "CROSS JOIN LATERAL (SELECT "
+    "CASE WHEN NOT %(local_day)s THEN 'UTC' WHEN m.home_user_id = r.user_id THEN m.home_timezone "
+    "ELSE m.away_timezone END timezone, "
+    "CASE WHEN NOT %(local_day)s THEN m.start_day WHEN m.home_user_id = r.user_id THEN m.home_start_local_day "
+    "ELSE m.away_start_local_day END start_day, "
+    "CASE WHEN NOT %(local_day)s THEN m.end_day WHEN m.home_user_id = r.user_id THEN m.home_end_local_day "
+    "ELSE m.away_end_local_day END end_day) bucket "
+    "JOIN unnest(%(days)s::DATE[]) requested_day(day) "
+    "ON requested_day.day BETWEEN bucket.start_day AND bucket.end_day "
+    "WHERE m.end_ts >= (%(first_day)s::DATE - 1)::TIMESTAMP AT TIME ZONE 'UTC' "
+    "GROUP BY r.user_id, requested_day.day) "
+    "SELECT r.user_name, requested_day.day, r.country_id, r.timezone, r.registration_ts, "
+    "(SELECT MAX(CASE WHEN %(local_day)s THEN l.start_local_day ELSE l.start_day END) FROM events.session l "
+    "WHERE l.user_id = r.user_id "
+    "AND CASE WHEN %(local_day)s THEN l.start_local_day ELSE l.start_day END <= requested_day.day), "
+    "COALESCE(s.sessions_number, 0), COALESCE(s.time_spent, 0), COALESCE(m.score_home, 0), "
+    "COALESCE(m.score_away, 0), "
+    "COALESCE(m.match_time, 0) * 1.0 / CASE WHEN s.time_spent > 0 THEN s.time_spent ELSE 1 END * 100 "
+    "FROM registered r CROSS JOIN unnest(%(days)s::DATE[]) requested_day(day) "
+    "LEFT JOIN sessions s ON s.user_id = r.user_id AND s.day = requested_day.day "
+    "LEFT JOIN matches m ON m.user_id = r.user_id AND m.day = requested_day.day "
+    "ORDER BY r.position, requested_day.day")
+
+
+# yields the user, the date and the statistics for every requested user and date, in the order of the request and
+# the dates in order. the rows of the summaries are read in blocks by a cursor on the server, held past the end of the
+# transaction since the connection is in autocommit. the users of a block missing from the summaries are calculated
+# from the events with a single query, and users that are not in the system at all are yielded without statistics.
+def user_stats_rows(user_names, dates=None, local_day=False):
+    parameters = {'user_names': user_names, 'days': dates, 'first_day': min(dates) if dates else None,
+                  'local_day': local_day}
+    fetch_size = app.config.get('USER_STATS_FETCH_SIZE')
+    with get_connection().cursor(name='user_stats_summary', withhold=True) as summary_cursor:
+        with timed('api_query_duration_seconds', query='user_stats_summary_day' if dates else 'user_stats_summary'):
+            summary_cursor.execute(user_stats_summary_day_query if dates else user_stats_summary_query, parameters)
+        while True:
+            rows = summary_cursor.fetchmany(fetch_size)
+            if not rows:
+                return
+            # the country is null only for the users missing from the summaries
+            missing = list(dict.fromkeys(row[0] for row in rows if row[2] is None))
+            live_rows = {}
+            if missing:
+                with get_connection().cursor() as live_cursor:
+                    with timed('api_query_duration_seconds',
+                               query='user_stats_live_day' if dates else 'user_stats_live'):
+                        live_cursor.execute(user_stats_live_day_query if dates else user_stats_live_query,
+                                            dict(parameters, user_names=missing))
+                    live_rows = {(row[0], row[1]): row[2:] for row in live_cursor}
+            for row in rows:
+                if row[2] is not None:
+                    yield row[0], row[1], row[2:]
+                else:
+                    yield row[0], row[1], live_rows.get((row[0], row[1]))
+
+
+def user_stats_result(user_data, date):
+    (country_id, country_timezone, registration_timestamp, last_login, sessions_number, time_spent,
+     home_goal_score, away_goal_score, active_time_played_percentage) = user_data
+    result = {}
+
+    result['country_id'] = country_id
+    result['country_timezone'] = country_timezone
+    result['timestamp_local'] = str(registration_timestamp.astimezone(pytz.timezone(country_timezone)))
+
+    # last login is stored as a date, the days since then depend on the day of the request
+    if last_login is not None:
+        result['days_since_last_login'] = ((date if date is not None else datetime.date.today()) - last_login).days
+    else:
+        result['days_since_last_login'] = "No last login."
+
+    result['sessions_number'] = sessions_number
+    result['time_spent'] = int(time_spent) #the precision should be to seconds.
+    result['score_home'] = home_goal_score
+    result['score_away'] = away_goal_score
+    result['active_time_played_percentage'] = active_time_played_percentage
+    return result
 
 
 @app.route('/user_stats', methods=['GET'])
@@ -25,269 +476,134 @@ def get_user_stats():
     if 'user_id' not in request.json:
         return "Missing user_id", 400
     if 'date' in request.json:
-        try:
-            date = datetime.date.fromisoformat(request.json['date'])
-        except ValueError:
-            return "Invalid date format, try YYYY-MM-DD", 400
+        date, error = parse_date(request.json['date'])
+        if error:
+            return error, 400
+    local_day, error = parse_local_day(request.json)
+    if error:
+        return error, 400
 
-        start_date = datetime.date(year=2024, month=10, day=7)
-        end_date = datetime.date(year=2024, month=11, day=3)
-        if not (start_date <= date <= end_date):
-            return f"Date must be between bounds {start_date} and {end_date} inclusive", 400
+    # the statistics are cached rather than the response, days_since_last_login depends on the day of the request
+    cache_key = ('user_stats', str(request.json['user_id']), date, local_day)
+    version, user_data = response_cache.get(cache_key)
+    if user_data is None:
+        [(_, _, user_data)] = user_stats_rows([str(request.json['user_id'])], [date] if date else None, local_day)
+        if not user_data:
+            return f"No user with given id {request.json['user_id']} in the system", 400
+        response_cache.put(cache_key, version, user_data)
 
-    # create answers:
-    result = {}
+    return jsonify(user_stats_result(user_data, date)), 200
 
-    # get registration data
-    with conn.cursor() as user_cursor:
-        user_cursor.execute("SELECT country_id, timezone, event_timestamp, u.user_id FROM country.country c "
-                            "JOIN events.registration r ON c.country_id=r.country_code "
-                            "JOIN users.user u ON u.user_id=r.user_id JOIN events.event e ON e.event_id=r.event_id "
-                            "WHERE u.user_name = %s::TEXT", (request.json['user_id'],))
-        country_data = user_cursor.fetchone()
-    if not country_data:
-        return f"No user with given id {request.json['user_id']} in the system", 400
-    country_id = country_data[0]
-    country_timezone = country_data[1]
-    registration_timestamp = country_data[2]
-    user_id = country_data[3]
 
+# statistics of many users, for all time or for each of the given dates, one json object per line
+@app.route('/user_stats/batch', methods=['GET', 'POST'])
+def get_user_stats_batch():
+    # check input data
+    user_names = request.json.get('user_ids')
+    if not isinstance(user_names, list) or not user_names:
+        return "Missing user_ids, pass a list of user ids", 400
+    user_names = list(dict.fromkeys(str(user_name) for user_name in user_names))
+    dates, error = parse_dates(request.json)
+    if error:
+        return error, 400
+    local_day, error = parse_local_day(request.json)
+    if error:
+        return error, 400
+    if len(user_names) * len(dates or [None]) > app.config.get('USER_STATS_BATCH_LIMIT'):
+        return f"At most {app.config.get('USER_STATS_BATCH_LIMIT')} users and dates can be requested at once", 400
 
-    result['country_id'] = country_id
-    result['country_timezone'] = country_timezone
-    result['timestamp_local'] = str(registration_timestamp.astimezone(pytz.timezone(country_timezone)))
+    def results():
+        for user_name, date, user_data in user_stats_rows(user_names, dates, local_day):
+            if user_data:
+                result = user_stats_result(user_data, date)
+            else:
+                result = {'error': f"No user with given id {user_name} in the system"}
+            result['user_id'] = user_name
+            if date is not None:
+                result['date'] = str(date)
+            yield json.dumps(result, default=str, sort_keys=True) + "\n"
 
-    # find last login
-    with conn.cursor() as last_login_cursor:
-        last_login_cursor.execute("SELECT s.user_id, MIN(%s::DATE - e.event_timestamp::DATE) "
-                                  "FROM events.session s JOIN events.event e ON s.event_id = e.event_id "
-                                  "WHERE s.user_id = %s AND s.is_start = 1 AND e.event_timestamp::DATE <= %s::DATE "
-                                  "GROUP BY s.user_id ", (date if date is not None else datetime.datetime.now(),
-                                                          user_id, date if date is not None else datetime.datetime.now()))
-        last_login_data = last_login_cursor.fetchone()
-    if last_login_data is not None:
-        last_login_days = last_login_data[1]
-        result['days_since_last_login'] = last_login_days
-    else:
-        result['days_since_last_login'] = "No last login."
+    return Response(stream_with_context(results()), mimetype='application/x-ndjson')
 
-    #number_of_sessions
-    with conn.cursor() as session_num_cursor:
-        query = ("SELECT COALESCE(SUM(s.is_start), 0) FROM events.event e "
-                 "JOIN events.session s ON e.event_id = s.event_id "
-                 "WHERE s.user_id = %s ")
-        if date:
-            query += "AND e.event_timestamp::DATE = %s::DATE"
-            session_num_cursor.execute(query, (user_id, date))
-        else:
-            session_num_cursor.execute(query, (user_id, ))
-        sessions_number = session_num_cursor.fetchone()[0]
-        result['sessions_number'] = sessions_number
-
-    #time spent
-    with conn.cursor() as time_spent_cursor:
-        if not date:
-            time_spent_cursor.execute("SELECT COALESCE(SUM(EXTRACT (EPOCH FROM e2.event_timestamp-e1.event_timestamp)),0) "
-                                      "FROM events.event e1 JOIN events.session s1 ON  e1.event_id = s1.event_id "
-                                      "JOIN events.session s2 ON s1.session_user_id = s2.session_user_id "
-                                      "AND s1.user_id = s2.user_id "
-                                      "JOIN events.event e2 ON e2.event_id = s2.event_id "
-                                      "WHERE s1.is_start = 1 AND s2.is_start = 0 AND s1.user_id = %s ", (user_id,))
-        else:
-            time_spent_cursor.execute("SELECT COALESCE(SUM("
-                 "CASE "
-                 "WHEN e2.event_timestamp::DATE = e1.event_timestamp::DATE AND e2.event_timestamp::DATE = %s::DATE "
-                    "THEN EXTRACT (EPOCH FROM e2.event_timestamp-e1.event_timestamp) "
-                 "WHEN e2.event_timestamp::DATE = %s::DATE "
-                    "THEN EXTRACT (EPOCH FROM e2.event_timestamp-DATE_TRUNC('day', e2.event_timestamp)) "
-                 "WHEN e1.event_timestamp::DATE = %s::DATE "
-                    "THEN EXTRACT (EPOCH FROM DATE_TRUNC('day', e1.event_timestamp) + INTERVAL '1 day' - e1.event_timestamp)"
-                 "ELSE 0 END), 0) "
-                 "FROM events.event e1 JOIN events.session s1 ON  e1.event_id = s1.event_id "
-                 "JOIN events.session s2 ON s1.session_user_id = s2.session_user_id and s1.user_id = s2.user_id "
-                 "JOIN events.event e2 ON e2.event_id = s2.event_id "
-                 "WHERE s1.is_start = 1 AND s2.is_start = 0 AND s1.user_id = %s ", (date, date, date, user_id))
-
-        time_spent = time_spent_cursor.fetchone()[0]
-        result['time_spent'] = int(time_spent) #the precision should be to seconds.
-
-    # total_won
-    with conn.cursor() as total_won_cursor:
-        if not date:
-            total_won_cursor.execute("SELECT COALESCE(SUM(CASE "
-                                     "WHEN home_user_id = %s AND home_goals_scored > away_goals_scored THEN 3 "
-                                     "WHEN home_user_id = %s AND home_goals_scored = away_goals_scored THEN 1 "
-                                     "ELSE 0 END), 0),"
-                                     "COALESCE(SUM(CASE "
-                                     "WHEN away_user_id = %s AND away_goals_scored > home_goals_scored THEN 3 "
-                                     "WHEN away_user_id = %s AND away_goals_scored = home_goals_scored THEN 1 "
-                                     "ELSE 0 END), 0)  "
-                                     "FROM events.match WHERE home_user_id = %s OR away_user_id = %s ",
-                                     (user_id, user_id, user_id, user_id, user_id, user_id))
-        else:
-            total_won_cursor.execute("SELECT COALESCE(SUM(CASE "
-                                     "WHEN m.home_user_id = %s AND m.home_goals_scored > m.away_goals_scored THEN 3 "
-                                     "WHEN m.home_user_id = %s AND m.home_goals_scored = m.away_goals_scored THEN 1 "
-                                     "ELSE 0 END), 0),"
-                                     "COALESCE(SUM(CASE "
-                                     "WHEN m.away_user_id = %s AND m.away_goals_scored > m.home_goals_scored THEN 3 "
-                                     "WHEN m.away_user_id = %s AND m.away_goals_scored = m.home_goals_scored THEN 1 "
-                                     "ELSE 0 END), 0)  "
-                                     "FROM events.match m JOIN events.event e ON m.event_id_start = e.event_id "
-                                     "WHERE (m.home_user_id = %s OR m.away_user_id = %s) "
-                                     "AND e.event_timestamp::DATE = %s::DATE",
-                                     (user_id, user_id, user_id, user_id, user_id, user_id, date))
-        home_goal_score, away_goal_score = total_won_cursor.fetchone()
-        result['score_home'] = home_goal_score
-        result['score_away'] = away_goal_score
-
-
-    # bonus
-    with conn.cursor() as match_time_cursor:
-        if not date:
-            match_time_cursor.execute("WITH match_time(match_time) AS ( "
-                                      "SELECT COALESCE(SUM(EXTRACT (EPOCH FROM e2.event_timestamp-e1.event_timestamp)),0) "
-                                      "FROM events.match m JOIN events.event e1 ON m.event_id_start = e1.event_id "
-                                      "JOIN events.event e2 ON m.event_id_end = e2.event_id "
-                                      "WHERE m.home_user_id = %s OR m.away_user_id = %s "
-                                      ")"
-                                      "SELECT ((SELECT match_time FROM match_time)*1.0/"
-                                      "COALESCE(SUM(EXTRACT (EPOCH FROM e2.event_timestamp-e1.event_timestamp)),1))*100 "
-                                      "FROM events.event e1 JOIN events.session s1 ON e1.event_id = s1.event_id "
-                                      "JOIN events.session s2 ON s2.session_user_id = s1.session_user_id "
-                                      "AND s2.user_id = s1.user_id JOIN events.event e2 ON s2.event_id = e2.event_id "
-                                      "WHERE s1.user_id = %s AND s1.is_start = 1 AND s2.is_start = 0",
-                                      (user_id, user_id, user_id))
-        else:
-            match_time_cursor.execute("WITH match_time(match_time) AS ( "
-                                      "SELECT COALESCE(SUM("
-                                      "CASE WHEN e1.event_timestamp::DATE = e2.event_timestamp::DATE AND e1.event_timestamp::DATE = %s::DATE "
-                                            "THEN EXTRACT (EPOCH FROM e2.event_timestamp-e1.event_timestamp)"
-                                      "WHEN e2.event_timestamp::DATE = %s::DATE "
-                                            "THEN EXTRACT (EPOCH FROM e2.event_timestamp-DATE_TRUNC('day', e2.event_timestamp))"
-                                      "WHEN e1.event_timestamp::DATE = %s::DATE "
-                                            "THEN EXTRACT (EPOCH FROM DATE_TRUNC('day', e1.event_timestamp)+ INTERVAL '1 day' - e1.event_timestamp) END "
-                                      "),0) "
-                                      "FROM events.match m JOIN events.event e1 ON m.event_id_start = e1.event_id "
-                                      "JOIN events.event e2 ON m.event_id_end = e2.event_id "
-                                      "WHERE (m.home_user_id = %s OR m.away_user_id = %s) "
-                                      "AND (e1.event_timestamp::DATE = %s::DATE OR e2.event_timestamp::DATE = %s::DATE)"
-                                      ")"
-                                      "SELECT ((SELECT match_time FROM match_time)*1.0/"
-                                      "COALESCE(SUM("
-                                      "CASE "
-                                      "WHEN e2.event_timestamp::DATE = e1.event_timestamp::DATE AND e2.event_timestamp::DATE = %s::DATE "
-                                            "THEN EXTRACT (EPOCH FROM e2.event_timestamp-e1.event_timestamp) "
-                                      "WHEN e2.event_timestamp::DATE = %s::DATE "
-                                            "THEN EXTRACT (EPOCH FROM e2.event_timestamp-DATE_TRUNC('day', e2.event_timestamp)) "
-                                      "WHEN e1.event_timestamp::DATE = %s::DATE "
-                                            "THEN EXTRACT (EPOCH FROM DATE_TRUNC('day', e1.event_timestamp) + INTERVAL '1 day' - e1.event_timestamp)"
-                                      "ELSE NULL END), 1))*100 "
-                                      "FROM events.event e1 JOIN events.session s1 ON  e1.event_id = s1.event_id "
-                                      "JOIN events.session s2 ON s1.session_user_id = s2.session_user_id and s1.user_id = s2.user_id "
-                                      "JOIN events.event e2 ON e2.event_id = s2.event_id "
-                                      "WHERE s1.is_start = 1 AND s2.is_start = 0 AND s1.user_id = %s ",
-                                      (date, date, date, user_id, user_id, date, date, date, date, date, user_id))
-        result['active_time_played_percentage'] = match_time_cursor.fetchone()[0]
-
-    return jsonify(result), 200
+
+# the game statistics of every requested day, days without any activity included
+game_stats_days_query = (
+    "SELECT requested.day, COALESCE(g.dau, 0), COALESCE(g.number_of_sessions, 0), "
+    "COALESCE(g.average_sessions_number, 0), COALESCE(g.max_points_users, '{}') "
+    "FROM unnest(%s::DATE[]) requested(day) LEFT JOIN stats.daily_game g ON g.day = requested.day "
+    "AND g.local_day = %s "
+    "ORDER BY requested.day")
+
+
+def game_stats_result(game_data):
+    dau, number_of_sessions, average_sessions_number, max_points_users = game_data
+    result = {}
+    result['dau'] = dau
+    result['number_of_sessions'] = number_of_sessions
+    result['average_sessions_number'] = average_sessions_number
+    result['max_points_users'] = max_points_users
+    return result
 
 
 @app.route("/game_stats", methods=['GET'])
 def get_game_stats():
     date = None
     if 'date' in request.json:
-        try:
-            date = datetime.date.fromisoformat(request.json['date'])
-        except ValueError:
-            return "Invalid date format, try YYYY-MM-DD", 400
-
-        start_date = datetime.date(year=2024, month=10, day=7)
-        end_date = datetime.date(year=2024, month=11, day=3)
-        if not (start_date <= date <= end_date):
-            return f"Date must be between bounds {start_date} and {end_date} inclusive", 400
+        date, error = parse_date(request.json['date'])
+        if error:
+            return error, 400
+    # a series of days, one object per day
+    dates, error = parse_dates(request.json)
+    if error:
+        return error, 400
+    local_day, error = parse_local_day(request.json)
+    if error:
+        return error, 400
 
-    result = {}
+    cache_key = ('game_stats', date, tuple(dates) if dates else None, local_day)
+    version, response = response_cache.get(cache_key)
+    if response is not None:
+        return jsonify(response), 200
 
-    #dau
-    with conn.cursor() as dau_cursor:
-        query = ("SELECT COALESCE(COUNT(DISTINCT(s1.user_id)),0) "
-                 "FROM events.event e1 JOIN events.session s1 ON  e1.event_id = s1.event_id "
-                 "JOIN events.session s2 ON s1.session_user_id = s2.session_user_id and s1.user_id = s2.user_id "
-                 "JOIN events.event e2 ON e2.event_id = s2.event_id "
-                 "WHERE s1.is_start = 1 AND s2.is_start = 0 ")
-        if date:
-            query = query + " AND %s::DATE BETWEEN e1.event_timestamp::DATE AND e2.event_timestamp::DATE "
-            dau_cursor.execute(query, (date, ))
-        else:
-            dau_cursor.execute(query)
-
-        dau = dau_cursor.fetchone()[0]
-        result['dau'] = dau
-
-    #number of sessions
-    with conn.cursor() as number_sessions_cursor:
-        query = "SELECT COALESCE(SUM(s1.is_start), 0) FROM events.session s1 "
-        if date:
-            query = query + (" JOIN events.event e1 ON s1.event_id = e1.event_id "
-                             " JOIN events.session s2 ON s1.session_user_id = s2.session_user_id AND "
-                             "s1.user_id = s2.user_id JOIN events.event e2 ON s2.event_id = e2.event_id "
-                             "WHERE s1.is_start = 1 AND s2.is_start = 0 "
-                             "AND %s::DATE BETWEEN e1.event_timestamp::DATE AND e2.event_timestamp::DATE")
-            number_sessions_cursor.execute(query, (date,))
-        else:
-            number_sessions_cursor.execute(query)
-        result['number_of_sessions'] = number_sessions_cursor.fetchone()[0]
-
-    # average number of sessions per user
-    with (conn.cursor() as average_cursor):
-        if not date:
-            average_cursor.execute("WITH sessions_per_user(user_id, session_num) AS (SELECT user_id, SUM(is_start) FROM events.session GROUP BY user_id)"
-                 "SELECT COALESCE(AVG(session_num),0) FROM sessions_per_user")
+    # the rollups are built by data_collection.py after every load
+    with get_connection().cursor() as game_cursor:
+        if dates:
+            with timed('api_query_duration_seconds', query='game_stats_days'):
+                game_cursor.execute(game_stats_days_query, (dates, local_day))
+            response = []
+            for day, *game_data in game_cursor.fetchall():
+                result = game_stats_result(game_data)
+                result['date'] = str(day)
+                response.append(result)
+        elif date:
+            with timed('api_query_duration_seconds', query='game_stats_days'):
+                game_cursor.execute(game_stats_days_query, ([date], local_day))
+            response = game_stats_result(game_cursor.fetchone()[1:])
         else:
-            average_cursor.execute(
-                "WITH sessions_per_user(user_id, session_num) "
-                "AS (SELECT s1.user_id, SUM(s1.is_start) "
-                "FROM events.session s1 JOIN events.event e1 "
-                "ON s1.event_id = e1.event_id JOIN events.session s2 ON s1.session_user_id = s2.session_user_id "
-                "AND s1.user_id = s2.user_id JOIN events.event e2 ON e2.event_id = s2.event_id "
-                "WHERE s1.is_start = 1 AND s2.is_start = 0 AND %s::DATE BETWEEN e1.event_timestamp::DATE AND e2.event_timestamp::DATE "
-                "GROUP BY s1.user_id) "
-                "SELECT COALESCE(AVG(session_num),0) FROM sessions_per_user", (date,))
-        result['average_sessions_number'] = average_cursor.fetchone()[0]
-
-    # user, users with most points afterall
-    with conn.cursor() as most_points_cursor:
-        if not date:
-            most_points_cursor.execute("WITH user_points(user_id, points) AS ("
-                                        "SELECT user_id, COALESCE(SUM(points),0)"
-                                        "FROM"
-                                        "(SELECT home_user_id as user_id, CASE "
-                                        "WHEN home_goals_scored > away_goals_scored THEN 3 "
-                                        "WHEN home_goals_scored = away_goals_scored THEN 1 "
-                                        "ELSE 0 END as points "
-                                        "FROM events.match "
-                                       
-                                        "UNION ALL "
-                                       
-                                        "SELECT away_user_id, CASE "
-                                        "WHEN away_goals_scored > home_goals_scored THEN 3 "
-                                        "WHEN away_goals_scored = home_goals_scored THEN 1 "
-                                        "ELSE 0 END  "
-                                        "FROM events.match"
-                                       
-                                         ") scores "
-                                        "GROUP BY user_id"
-                                       ")"
-                                       "SELECT u.user_name "
-                                       "FROM user_points up JOIN users.user u ON u.user_id = up.user_id "
-                                       "WHERE points = (SELECT MAX(points) FROM user_points)"
-                                       "")
-            result['max_points_users'] = []
-            for row in most_points_cursor.fetchall():
-                result['max_points_users'].append(row[0])
-
-    return jsonify(result), 200
+            with timed('api_query_duration_seconds', query='game_stats_total'):
+                game_cursor.execute("SELECT dau, number_of_sessions, average_sessions_number, max_points_users "
+                                    "FROM stats.total_game WHERE total_id")
+            response = game_stats_result(game_cursor.fetchone() or (0, 0, 0, []))
+    response_cache.put(cache_key, version, response)
+
+    return jsonify(response), 200
+
+
+@app.route("/cache_stats", methods=['GET'])
+def get_cache_stats():
+    return jsonify(response_cache.statistics()), 200
+
+
+# counters and histograms of the requests and the queries, and the state of the connection pool and the cache
+@app.route("/metrics", methods=['GET'])
+def get_metrics():
+    cache = response_cache.statistics()
+    gauges = {('api_pool_connections_max', ()): app.config.get('DATABASE_POOL_MAX'),
+              ('api_cache_responses', ()): cache['size'],
+              ('api_cache_responses_max', ()): cache['max_size']}
+    counters = {(f'api_cache_{name}_total', ()): cache[name]
+                for name in ('hits', 'misses', 'evictions', 'invalidations')}
+    return Response(metrics.exposition(counters, gauges), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
-    app.run(host= app.config.get('HOST'))
\ No newline at end of file
+    app.run(host= app.config.get('HOST'), threaded=True)
\ No newline at end of file
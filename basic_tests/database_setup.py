@@ -0,0 +1,95 @@
+import os
+import sys
+import importlib
+import unittest
+
+"""
+The databases of the tests that need a database server. A test module creates its databases with database/init.sql
+in setUpModule, connects the modules of the project to one of them, and drops them in tearDownModule.
+The events the tests write to their files are made with event.
+
+The server is given by the usual DATABASE_HOST, DATABASE_PORT, DATABASE_USER and DATABASE_PASSWORD environment
+variables. The test module is skipped if psycopg2 is not installed or there is no server to connect to.
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+# DATABASE_NAME of the environment, given back when the modules are disconnected from a test database
+database_name = os.environ.get('DATABASE_NAME')
+
+# the events written by the tests, at a number of seconds after START, a moment of the event window
+START = 1728463546
+
+
+def event(event_id, event_type, seconds, **event_data):
+    return {'event_id': event_id, 'event_type': event_type, 'event_timestamp': START + seconds,
+            'event_data': event_data}
+
+
+def server_connection(database):
+    return psycopg2.connect(dbname=database,
+                            user=os.environ.get('DATABASE_USER', 'postgres'),
+                            password=os.environ.get('DATABASE_PASSWORD', 'postgres_password'),
+                            host=os.environ.get('DATABASE_HOST', 'localhost'),
+                            port=os.environ.get('DATABASE_PORT', '5432'))
+
+
+# the databases are dropped first if an earlier run left them behind
+def create_databases(*databases):
+    if psycopg2 is None:
+        raise unittest.SkipTest("psycopg2 is not installed")
+    try:
+        server = server_connection('postgres')
+    except psycopg2.OperationalError as error:
+        raise unittest.SkipTest(f"No database server to connect to: {error}")
+    server.autocommit = True
+    with server.cursor() as server_cursor:
+        for database in databases:
+            server_cursor.execute(f"DROP DATABASE IF EXISTS {database}")
+            server_cursor.execute(f"CREATE DATABASE {database}")
+    server.close()
+    with open(os.path.join(ROOT, 'database', 'init.sql')) as init_script:
+        init = init_script.read()
+    for database in databases:
+        schema = server_connection(database)
+        with schema.cursor() as schema_cursor:
+            schema_cursor.execute(init)
+        schema.commit()
+        schema.close()
+
+
+def drop_databases(*databases):
+    server = server_connection('postgres')
+    server.autocommit = True
+    with server.cursor() as server_cursor:
+        for database in databases:
+            server_cursor.execute(f"DROP DATABASE IF EXISTS {database}")
+    server.close()
+
+
+# the modules connect to the database when they are imported, they are imported again if another test imported them
+def connect_modules(database, *names):
+    os.environ['DATABASE_NAME'] = database
+    return [importlib.reload(sys.modules[name]) if name in sys.modules else importlib.import_module(name)
+            for name in names]
+
+
+# the connections of the modules are closed, and the other tests import them again, connected to their own database
+def disconnect_modules(*names):
+    for name in names:
+        module = sys.modules.pop(name, None)
+        if module is None:
+            continue
+        if hasattr(module, 'conn'):
+            module.conn.close()
+        if hasattr(module, 'pool'):
+            module.pool.closeall()
+    if database_name is None:
+        os.environ.pop('DATABASE_NAME', None)
+    else:
+        os.environ['DATABASE_NAME'] = database_name
@@ -0,0 +1,245 @@
+import os
+import sys
+import json
+import math
+import decimal
+import datetime
+import tempfile
+import contextlib
+import unittest
+
+"""
+Checks that analytics.py, which calculates the statistics in memory, and api.py on a database loaded by
+data_collection.py give the same results for the same events file, for every field of /user_stats and /game_stats,
+for all time and for every day of the event window, over utc days and over the local days of the users.
+
+The events are generated with benchmarks/generate_events.py, with duplicates, events outside the window and the
+other events the loader refuses. The size is set with ANALYTICS_TEST_EVENTS (20000 by default).
+The tests create the database ANALYTICS_TEST_DATABASE (events_analytics_test by default) with database/init.sql on
+the server given by the usual DATABASE_HOST, DATABASE_PORT, DATABASE_USER and DATABASE_PASSWORD environment
+variables, and drop it afterwards. They are skipped if there is no server to connect to.
+
+How to run tests:
+python basic_tests/test_analytics.py
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import database_setup
+
+TEST_DATABASE = os.environ.get('ANALYTICS_TEST_DATABASE', 'events_analytics_test')
+EVENTS = int(os.environ.get('ANALYTICS_TEST_EVENTS', '20000'))
+WINDOW_DAYS = [datetime.date(2024, 10, 7) + datetime.timedelta(days=day) for day in range(28)]
+
+
+def setUpModule():
+    global data_collection, api, engine, events_file
+    database_setup.create_databases(TEST_DATABASE)
+    from generate_events import generate_events
+    events_file = tempfile.NamedTemporaryFile('w', suffix='.jsonl')
+    generate_events(events_file, EVENTS)
+    events_file.flush()
+    timezones_filename = os.path.join(ROOT, 'timezones.jsonl')
+
+    [data_collection] = database_setup.connect_modules(TEST_DATABASE, 'data_collection')
+    # the loader prints its progress and a summary
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        data_collection.insert_into_country(timezones_filename)
+        data_collection.insert_into_events(events_file.name)
+        data_collection.refresh_rollups()
+    [api, analytics] = database_setup.connect_modules(TEST_DATABASE, 'api', 'analytics')
+    columns, _ = analytics.read_events(timezones_filename, events_file.name)
+    engine = analytics.AnalyticsEngine(columns)
+
+
+def tearDownModule():
+    events_file.close()
+    database_setup.disconnect_modules('data_collection', 'api')
+    database_setup.drop_databases(TEST_DATABASE)
+
+
+class TestAnalytics(unittest.TestCase):
+
+    def setUp(self):
+        self.client = api.app.test_client()
+
+    # numbers of the database come as decimals, or as strings of decimals
+    def assertSameResult(self, api_result, engine_result, message):
+        self.assertEqual(sorted(api_result), sorted(engine_result), message)
+        for key, value in engine_result.items():
+            api_value = api_result[key]
+            if isinstance(value, float):
+                self.assertAlmostEqual(float(decimal.Decimal(str(api_value))), value, places=6,
+                                       msg=f"{message} {key}")
+            else:
+                self.assertEqual(api_value, value, f"{message} {key}")
+
+    def test_users(self):
+        self.assertEqual(sorted(engine.columns.user_names), sorted(engine.columns.user_ids))
+        self.assertGreater(len(engine.columns.session_users), 0)
+        self.assertGreater(len(engine.columns.match_starts), 0)
+
+    def test_game_stats(self):
+        for timezone in ('utc', 'local'):
+            response = self.client.get('/game_stats', json={'timezone': timezone})
+            self.assertSameResult(response.get_json(), engine.game_stats(None, timezone == 'local'),
+                                  f"game_stats {timezone}")
+            response = self.client.get('/game_stats', json={'timezone': timezone, 'from': str(WINDOW_DAYS[0]),
+                                                            'to': str(WINDOW_DAYS[-1])})
+            for day_result in response.get_json():
+                date = datetime.date.fromisoformat(day_result.pop('date'))
+                self.assertSameResult(day_result, engine.game_stats(date, timezone == 'local'),
+                                      f"game_stats {timezone} {date}")
+
+    # a list of dates is answered sorted and without repeated days, the same as the single days
+    def test_game_stats_dates(self):
+        dates = [WINDOW_DAYS[5], WINDOW_DAYS[0], WINDOW_DAYS[5], WINDOW_DAYS[-1]]
+        for timezone in ('utc', 'local'):
+            response = self.client.get('/game_stats', json={'timezone': timezone,
+                                                            'dates': [str(date) for date in dates]})
+            self.assertEqual(response.status_code, 200)
+            day_results = response.get_json()
+            self.assertEqual([day_result['date'] for day_result in day_results],
+                             [str(date) for date in sorted(set(dates))])
+            for day_result in day_results:
+                date = day_result.pop('date')
+                single = self.client.get('/game_stats', json={'timezone': timezone, 'date': date}).get_json()
+                self.assertEqual(day_result, single, date)
+            # a range of a single day
+            response = self.client.get('/game_stats', json={'timezone': timezone, 'from': str(WINDOW_DAYS[3]),
+                                                            'to': str(WINDOW_DAYS[3])})
+            self.assertSameResult(response.get_json()[0], dict(engine.game_stats(WINDOW_DAYS[3], timezone == 'local'),
+                                                                date=str(WINDOW_DAYS[3])), f"game_stats {timezone}")
+
+    def test_game_stats_refused_dates(self):
+        for request, error in (({'from': str(WINDOW_DAYS[0])}, "Date range needs both from and to"),
+                               ({'to': str(WINDOW_DAYS[0])}, "Date range needs both from and to"),
+                               ({'from': str(WINDOW_DAYS[1]), 'to': str(WINDOW_DAYS[0])},
+                                "Date from must not be after date to"),
+                               ({'from': str(WINDOW_DAYS[0]), 'to': '2024-11-04'},
+                                "Date must be between bounds 2024-10-07 and 2024-11-03 inclusive"),
+                               ({'dates': []}, "Dates must be a list of dates"),
+                               ({'dates': str(WINDOW_DAYS[0])}, "Dates must be a list of dates"),
+                               ({'dates': [str(WINDOW_DAYS[0]), 'not a date']}, "Invalid date format, try YYYY-MM-DD")):
+            response = self.client.get('/game_stats', json=request)
+            self.assertEqual(response.status_code, 400, request)
+            self.assertEqual(response.get_data(as_text=True), error, request)
+
+    # the batch of the users, and of an unknown user, for all time and for every day of the window. returns the
+    # number of the live queries it took
+    def assertUserStatsBatch(self, user_names):
+        live_queries = 0
+        for timezone in ('utc', 'local'):
+            for dates in ({}, {'from': str(WINDOW_DAYS[0]), 'to': str(WINDOW_DAYS[-1])}):
+                live_query = 'user_stats_live_day' if dates else 'user_stats_live'
+                before = self.query_count(live_query)
+                response = self.client.post('/user_stats/batch', json={'user_ids': user_names + ['not a user'],
+                                                                       'timezone': timezone, **dates})
+                lines = response.get_data(as_text=True).splitlines()
+                live_queries += self.query_count(live_query) - before
+                self.assertEqual([json.loads(line)['user_id'] for line in lines],
+                                 [user_name for user_name in user_names + ['not a user']
+                                  for _ in (WINDOW_DAYS if dates else [None])])
+                for line in lines:
+                    user_result = json.loads(line)
+                    user_name = user_result.pop('user_id')
+                    date = user_result.pop('date', None)
+                    date = datetime.date.fromisoformat(date) if date else None
+                    if user_name == 'not a user':
+                        self.assertEqual(user_result, {'error': "No user with given id not a user in the system"})
+                        continue
+                    self.assertSameResult(user_result, engine.user_stats(user_name, date, timezone == 'local'),
+                                          f"user_stats {timezone} {user_name} {date}")
+        return live_queries
+
+    # the number of the queries of the name api.py ran so far
+    def query_count(self, query):
+        histogram = api.metrics.histograms.get(('api_query_duration_seconds', (('query', query),)))
+        return sum(histogram[0]) if histogram else 0
+
+    def test_user_stats(self):
+        # the unknown user is looked up once in each of the four batches
+        self.assertEqual(self.assertUserStatsBatch(engine.columns.user_names), 4)
+
+    # users missing from the summaries are calculated from the events, all of them with a single query per block of
+    # rows, with the same results and in the order of the request
+    def test_user_stats_live(self):
+        with data_collection.conn.cursor() as stats_cursor:
+            stats_cursor.execute("DELETE FROM stats.user_summary WHERE user_name = ANY(%s)",
+                                 (engine.columns.user_names[::2],))
+        data_collection.conn.commit()
+        # every block has users missing from the summaries
+        fetch_size = api.app.config.get('USER_STATS_FETCH_SIZE')
+        blocks = sum(math.ceil((len(engine.columns.user_names) + 1) * days / fetch_size)
+                     for days in (1, len(WINDOW_DAYS)))
+        try:
+            self.assertEqual(self.assertUserStatsBatch(engine.columns.user_names), 2 * blocks)
+        finally:
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                data_collection.refresh_rollups()
+
+    # a summarised user after a user missing from the summaries, and the other way round, keep their places
+    def test_user_stats_order(self):
+        missing_user, summarised_user, other_user = engine.columns.user_names[:3]
+        with data_collection.conn.cursor() as stats_cursor:
+            stats_cursor.execute("DELETE FROM stats.user_summary WHERE user_name = %s", (missing_user,))
+        data_collection.conn.commit()
+        try:
+            for user_names in ([missing_user, summarised_user], [summarised_user, missing_user, other_user]):
+                response = self.client.post('/user_stats/batch', json={'user_ids': user_names,
+                                                                       'dates': [str(WINDOW_DAYS[3])]})
+                results = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+                self.assertEqual([result.pop('user_id') for result in results], user_names)
+                for user_name, result in zip(user_names, results):
+                    self.assertEqual(result.pop('date'), str(WINDOW_DAYS[3]))
+                    self.assertSameResult(result, engine.user_stats(user_name, WINDOW_DAYS[3]), user_name)
+        finally:
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                data_collection.refresh_rollups()
+
+    # a user missing from the summaries gets the same answer from a single query over the events
+    def test_user_stats_single_live(self):
+        user_names = engine.columns.user_names[:10]
+        requests = [{'user_id': user_name, 'timezone': timezone, **date} for user_name in user_names
+                    for timezone in ('utc', 'local') for date in ({}, {'date': str(WINDOW_DAYS[3])})]
+        summarised = [self.client.get('/user_stats', json=request).get_json() for request in requests]
+        with data_collection.conn.cursor() as stats_cursor:
+            stats_cursor.execute("DELETE FROM stats.user_summary WHERE user_name = ANY(%s)", (user_names,))
+            # the new data version drops the cached answers
+            stats_cursor.execute("UPDATE events.data_version SET version = version + 1")
+        data_collection.conn.commit()
+        api.response_cache.version_check_seconds = 0
+        try:
+            for request, summarised_result in zip(requests, summarised):
+                live_query = 'user_stats_live_day' if 'date' in request else 'user_stats_live'
+                before = self.query_count(live_query)
+                response = self.client.get('/user_stats', json=request)
+                self.assertEqual(self.query_count(live_query) - before, 1)
+                self.assertEqual(response.get_json(), summarised_result, request)
+        finally:
+            api.response_cache.version_check_seconds = api.app.config.get('DATA_VERSION_CHECK_SECONDS')
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                data_collection.refresh_rollups()
+
+    def test_user_stats_single(self):
+        for user_name in engine.columns.user_names[:20]:
+            for date in (None, WINDOW_DAYS[3]):
+                for timezone in ('utc', 'local'):
+                    response = self.client.get('/user_stats', json={'user_id': user_name, 'timezone': timezone,
+                                                                    **({'date': str(date)} if date else {})})
+                    self.assertEqual(response.status_code, 200)
+                    self.assertSameResult(response.get_json(), engine.user_stats(user_name, date, timezone == 'local'),
+                                          f"user_stats {timezone} {user_name} {date}")
+        # user ids that are not strings are looked up as strings
+        response = self.client.get('/user_stats', json={'user_id': 12345})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_data(as_text=True), "No user with given id 12345 in the system")
+
+    def test_unknown_user(self):
+        self.assertIsNone(engine.user_stats('not a user'))
+
+
+if __name__ == '__main__':
+    unittest.main(argv=sys.argv[:1])
@@ -0,0 +1,209 @@
+import os
+import sys
+import io
+import gzip
+import json
+import random
+import tempfile
+import importlib
+import unittest
+
+"""
+Checks that event_reader.py reads the same lines as reading the file line by line, at any chunk and batch size, from
+plain and gzip compressed files, with the offset after every line, and that it refuses the same lines for the same
+reason, and keeps the same events, as checking every line decoded with json. Both with orjson, if it is installed,
+and with json.
+
+The events are generated with benchmarks/generate_events.py, with duplicates, events outside the window and the
+other events the loader refuses, together with a few malformed lines, among them lines with keys of the wrong
+type. No database is needed.
+
+How to run tests:
+python basic_tests/test_event_reader.py
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import event_reader
+from analytics import event_window
+from generate_events import generate_events
+
+WINDOW = event_window()
+MALFORMED = [b'', b'not json', b'[1, 2]', b'{"event_id": 1, "event_type": "match"}',
+             b'{"event_id": 2, "event_type": "registration", "event_data": {}, "event_timestamp": 1, "x": 1',
+             b'{"\\u0065vent_id": 3, "event_type": "match", "event_data": {}, "event_timestamp": 1728463546}',
+             b'{"event_id": 4, "event_type": "match", "event_data": {"event_timestamp": 1}, '
+             b'"event_timestamp": 1728463546}',
+             b'{"event_id": 5, "event_type": "match", "event_data": {}, "event_timestamp": null}',
+             b'{"event_id": 6, "event_type": "match", "event_data": {}, "event_timestamp": "1728463546"}',
+             b'{"event_id": 7, "event_type": "match", "event_data": {}, "event_timestamp": true}',
+             b'{"event_id": 8, "event_type": null, "event_data": {}, "event_timestamp": 1728463546}',
+             b'{"event_id": 9, "event_type": "match", "event_data": null, "event_timestamp": 1728463546}',
+             b'{"event_id": "10", "event_type": "match", "event_data": {}, "event_timestamp": 1728463546}',
+             b'{"event_id": 9223372036854775808, "event_type": "match", "event_data": {}, '
+             b'"event_timestamp": 1728463546}']
+
+
+# the reason of the refusal of every line when the whole line is decoded
+def expected_refusal(line):
+    try:
+        event = json.loads(line)
+    except ValueError:
+        return None, 'malformed'
+    if not isinstance(event, dict) or any(key not in event for key in event_reader.REQUIRED_EVENT_KEYS):
+        return None, 'malformed'
+    if (isinstance(event['event_id'], bool) or not isinstance(event['event_id'], int)
+            or not -2 ** 63 <= event['event_id'] < 2 ** 63
+            or isinstance(event['event_timestamp'], bool) or not isinstance(event['event_timestamp'], (int, float))
+            or not isinstance(event['event_type'], str) or not isinstance(event['event_data'], dict)):
+        return None, 'malformed'
+    if not (WINDOW[0] <= event['event_timestamp'] <= WINDOW[1]):
+        return event, 'out_of_window'
+    return event, None
+
+
+class TestEventReader(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        generated = io.StringIO()
+        generate_events(generated, 3000)
+        cls.lines = generated.getvalue().encode().splitlines() + MALFORMED
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.filename = os.path.join(cls.directory.name, 'events.jsonl')
+        # the last line has no line end
+        with open(cls.filename, 'wb') as events:
+            events.write(b'\n'.join(cls.lines))
+        cls.gzip_filename = cls.filename + '.gz'
+        with open(cls.filename, 'rb') as events, gzip.open(cls.gzip_filename, 'wb') as compressed:
+            compressed.write(events.read())
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def read_batches(self, filename, sort=False, chunk_bytes=event_reader.READER_CHUNK_BYTES,
+                     batch_lines=event_reader.READER_BATCH_LINES):
+        with event_reader.event_lines(filename, sort, chunk_bytes=chunk_bytes) as lines:
+            return list(event_reader.read_event_batches(lines, *WINDOW, batch_lines=batch_lines))
+
+    def read(self, filename, sort=False):
+        return [item for batch in self.read_batches(filename, sort) for item in batch]
+
+    def test_lines_and_offsets(self):
+        with open(self.filename, 'rb') as events:
+            offsets = []
+            while events.readline():
+                offsets.append(events.tell())
+        for chunk_bytes, batch_lines in ((event_reader.READER_CHUNK_BYTES, event_reader.READER_BATCH_LINES),
+                                         (7, 3), (1000, 1)):
+            batches = self.read_batches(self.filename, chunk_bytes=chunk_bytes, batch_lines=batch_lines)
+            self.assertTrue(all(0 < len(batch) <= batch_lines for batch in batches))
+            items = [item for batch in batches for item in batch]
+            self.assertEqual([line for _, line, _, _ in items], self.lines)
+            # the offset after the last line counts a line end that is not there
+            self.assertEqual([offset for offset, _, _, _ in items][:-1], offsets[:-1])
+
+    def test_gzip(self):
+        self.assertEqual(self.read(self.gzip_filename), self.read(self.filename))
+
+    # the insertion continues from the offset of its checkpoint
+    def test_resume(self):
+        items = self.read(self.filename)
+        offset = items[len(items) // 2][0]
+        for filename in (self.filename, self.gzip_filename):
+            with event_reader.event_lines(filename, offset=offset) as lines:
+                resumed = [item for batch in event_reader.read_event_batches(lines, *WINDOW, offset) for item in batch]
+            self.assertEqual(resumed, items[len(items) // 2 + 1:])
+
+    def test_refusals(self):
+        for line, (_, _, event, refusal) in zip(self.lines, self.read(self.filename)):
+            expected_event, expected = expected_refusal(line)
+            self.assertEqual(refusal, expected, line)
+            if refusal is None:
+                self.assertEqual(event, expected_event)
+            elif refusal == 'out_of_window':
+                self.assertEqual(event['event_id'], expected_event['event_id'])
+                self.assertEqual(event['event_type'], expected_event['event_type'])
+        refusals = [refusal for _, _, _, refusal in self.read(self.filename)]
+        self.assertGreater(refusals.count('out_of_window'), 0)
+        self.assertGreater(refusals.count(None), 0)
+
+    # runs of a few hundred bytes are written to disk and merged
+    def test_sort(self):
+        shuffled = self.lines[:]
+        random.Random(1).shuffle(shuffled)
+        shuffled_filename = os.path.join(self.directory.name, 'shuffled.jsonl.gz')
+        with gzip.open(shuffled_filename, 'wb') as compressed:
+            compressed.write(b'\n'.join(shuffled) + b'\n')
+        keys = [event_reader.sort_key(line, line_no) for line_no, line in enumerate(shuffled)]
+        expected = [line for _, line in sorted(zip(keys, shuffled))]
+        for run_bytes in (event_reader.SORT_RUN_BYTES, 300):
+            with tempfile.TemporaryDirectory() as directory:
+                sorted_lines = [line for lines in event_reader.sort_lines(shuffled_filename, directory, run_bytes, 7)
+                                for line in lines]
+                if run_bytes == 300:
+                    self.assertGreater(len(os.listdir(directory)), 100)
+            self.assertEqual(sorted_lines, expected)
+        events = [event for _, _, event, refusal in self.read(shuffled_filename, sort=True) if refusal is None]
+        self.assertEqual(events, sorted(events, key=lambda event: (event['event_timestamp'], event['event_id'])))
+        self.assertEqual(len(events), len([refusal for _, _, _, refusal in self.read(self.filename)
+                                           if refusal is None]))
+
+    # duplicates keep the order of the file, lines the parser refuses come first
+    def test_sort_key(self):
+        lines = [b'{"event_id": 2, "event_type": "match", "event_data": {}, "event_timestamp": 5}',
+                 b'{"event_id": 1, "event_type": "match", "event_data": {}, "event_timestamp": 5.0}',
+                 b'{"event_id": 1, "event_type": "registration", "event_data": {}, "event_timestamp": 5}',
+                 b'{"event_id": 3, "event_type": "match", "event_data": {}, "event_timestamp": 4}',
+                 b'{"event_id": "4", "event_type": "match", "event_data": {}, "event_timestamp": 4}',
+                 b'not json']
+        order = sorted(range(len(lines)), key=lambda line_no: event_reader.sort_key(lines[line_no], line_no))
+        self.assertEqual(order, [4, 5, 3, 1, 2, 0])
+        # the json module accepts NaN and integers too large for a float, they are sorted at either end
+        lines += [b'{"event_id": 6, "event_type": "match", "event_data": {}, "event_timestamp": NaN}',
+                  b'{"event_id": 7, "event_type": "match", "event_data": {}, "event_timestamp": 1' + b'0' * 400 + b'}',
+                  b'{"event_id": 8, "event_type": "match", "event_data": {}, "event_timestamp": -1' + b'0' * 400 + b'}']
+        orjson_loads = event_reader.loads
+        event_reader.loads = json.loads
+        try:
+            order = sorted(range(len(lines)), key=lambda line_no: event_reader.sort_key(lines[line_no], line_no))
+        finally:
+            event_reader.loads = orjson_loads
+        self.assertEqual(order, [4, 5, 6, 8, 3, 1, 2, 0, 7])
+
+    # the size of a run counts the memory of its lines in python, not only their bytes
+    def test_sort_run_bytes(self):
+        run_bytes = 20 * event_reader.RUN_ENTRY_BYTES
+        with tempfile.TemporaryDirectory() as directory:
+            for _ in event_reader.sort_lines(self.filename, directory, run_bytes):
+                pass
+            run_filenames = os.listdir(directory)
+            self.assertGreater(len(run_filenames), 1)
+            for run_filename in run_filenames:
+                with open(os.path.join(directory, run_filename), 'rb') as run_file:
+                    self.assertLessEqual(len(run_file.readlines()), 20)
+
+    def test_json_decoder(self):
+        global event_reader
+        orjson_reader = event_reader
+        orjson = sys.modules.get('orjson')
+        # the import of orjson fails
+        sys.modules['orjson'] = None
+        try:
+            event_reader = importlib.reload(orjson_reader)
+            self.assertIs(event_reader.loads, json.loads)
+            json_items = self.read(self.filename)
+        finally:
+            if orjson is None:
+                del sys.modules['orjson']
+            else:
+                sys.modules['orjson'] = orjson
+            event_reader = importlib.reload(orjson_reader)
+        self.assertEqual(json_items, self.read(self.filename))
+
+
+if __name__ == '__main__':
+    unittest.main(argv=sys.argv[:1])
@@ -0,0 +1,202 @@
+import os
+import sys
+import json
+import tempfile
+import contextlib
+import collections
+import unittest
+
+"""
+Checks that the bulk insertion of data_collection.py, the parallel insertion, and a row by row insertion that is
+interrupted and resumed from its last checkpoint, write the same users, events, sessions and matches as the row by
+row insertion, on a file of benchmarks/generate_events.py with the refused cases of the generator, a few event ids
+used again by events of another type, and a few malformed lines. The tables are compared by user_name, since the user
+ids depend on the order of insertion.
+
+The refusals are compared by their total: a ping sent again after a session of a single ping is refused as a
+duplicate by one insertion and by the session tracker by the other.
+
+The tests create the databases PARITY_TEST_DATABASE (events_parity_test by default) and the same name followed by
+_bulk, _parallel and _resume with database/init.sql on the server given by the usual DATABASE_HOST, DATABASE_PORT,
+DATABASE_USER and DATABASE_PASSWORD environment variables, and drop them afterwards. They are skipped if there is no
+server to connect to.
+
+How to run tests:
+python basic_tests/test_load_parity.py
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import database_setup
+from database_setup import event
+from generate_events import generate_events
+
+TEST_DATABASE = os.environ.get('PARITY_TEST_DATABASE', 'events_parity_test')
+PARITY_EVENTS = int(os.environ.get('PARITY_EVENTS', default=5000))
+RESUME_CHECKPOINT_LINES = 500
+PARALLEL_WORKERS = 2
+DATABASES = [TEST_DATABASE + suffix for suffix in ('', '_bulk', '_parallel', '_resume')]
+
+
+# lines added at the end of the generated file, then the malformed lines. the event ids of a registration and of a
+# match start are used again by a session ping and by a match, which the parallel insertion sends to other
+# processes, and the event id of the first ping of a session is used again by a registration while the session is
+# still open
+CROSS_DUPLICATES = [
+    event(10 ** 12, 'registration', 0, user_id='parity_1', country='DE', device_os='iOS'),
+    event(10 ** 12 + 1, 'registration', 1, user_id='parity_2', country='DE', device_os='iOS'),
+    event(10 ** 12 + 2, 'match', 10, match_id='parity_match', home_user_id='parity_1', away_user_id='parity_2',
+          home_goals_scored=None, away_goals_scored=None),
+    event(10 ** 12, 'session_ping', 20, user_id='parity_1'),
+    event(10 ** 12 + 1, 'match', 30, match_id='parity_other_match', home_user_id='parity_2',
+          away_user_id='parity_1', home_goals_scored=None, away_goals_scored=None),
+    event(10 ** 12 + 2, 'session_ping', 40, user_id='parity_2'),
+    event(10 ** 12 + 3, 'match', 100, match_id='parity_match', home_user_id='parity_1', away_user_id='parity_2',
+          home_goals_scored=1, away_goals_scored=2),
+    event(10 ** 12 + 10, 'session_ping', 200, user_id='parity_1'),
+    event(10 ** 12 + 11, 'session_ping', 260, user_id='parity_1'),
+    event(10 ** 12 + 12, 'session_ping', 320, user_id='parity_1'),
+    event(10 ** 12 + 10, 'registration', 330, user_id='parity_3', country='DE', device_os='iOS'),
+]
+
+MALFORMED = [b'not json', b'{"event_id": 1, "event_type": "session_ping"}', b'\xff\xfe', b'{"event_id": \x00}']
+
+TABLE_QUERIES = {
+    'user': ("SELECT u.user_name, r.event_id, d.device_os, r.country_code, e.event_timestamp "
+             "FROM users.user u LEFT JOIN events.registration r ON r.user_id = u.user_id "
+             "LEFT JOIN device.device d ON d.device_id = r.device_id "
+             "LEFT JOIN events.event e ON e.event_id = r.event_id ORDER BY 1, 2"),
+    'event': "SELECT event_id, event_timestamp, event_type_id FROM events.event ORDER BY 1",
+    'session': ("SELECT u.user_name, s.event_id_start, s.event_id_end, s.start_ts, s.end_ts, s.timezone "
+                "FROM events.session s JOIN users.user u ON u.user_id = s.user_id ORDER BY 1, 2"),
+    'match': ("SELECT m.match_id, m.event_id_start, m.event_id_end, home.user_name, away.user_name, "
+              "m.home_goals_scored, m.away_goals_scored, m.start_ts, m.end_ts "
+              "FROM events.match m JOIN users.user home ON home.user_id = m.home_user_id "
+              "JOIN users.user away ON away.user_id = m.away_user_id ORDER BY 1, 2"),
+}
+
+
+def setUpModule():
+    global data_collection
+    database_setup.create_databases(*DATABASES)
+    [data_collection] = database_setup.connect_modules(TEST_DATABASE, 'data_collection')
+
+
+def tearDownModule():
+    database_setup.disconnect_modules('data_collection')
+    database_setup.drop_databases(*DATABASES)
+
+
+def tables(connection):
+    with connection.cursor() as table_cursor:
+        rows = {}
+        for table, query in TABLE_QUERIES.items():
+            table_cursor.execute(query)
+            rows[table] = table_cursor.fetchall()
+    return rows
+
+
+class TestLoadParity(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.events_filename = os.path.join(cls.directory.name, 'events.jsonl')
+        with open(cls.events_filename, 'w') as output:
+            generate_events(output, PARITY_EVENTS, seed=3)
+            output.write(''.join(json.dumps(line) + '\n' for line in CROSS_DUPLICATES))
+        with open(cls.events_filename, 'ab') as output:
+            output.write(b''.join(line + b'\n' for line in MALFORMED))
+        cls.row_tables, cls.row_refused = cls.load(TEST_DATABASE, 'insert_into_events')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    # loads the file into the database with a new state of the loader, as a new process would, and returns the tables
+    # and the refusals
+    @classmethod
+    def load(cls, database, insert, **arguments):
+        data_collection.conn.close()
+        database_setup.connect_modules(database, 'data_collection')
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            data_collection.insert_into_country(os.path.join(ROOT, 'timezones.jsonl'))
+            getattr(data_collection, insert)(cls.events_filename, **arguments)
+        return tables(data_collection.conn), collections.Counter(data_collection.rejection_log.counts)
+
+    def test_row_by_row(self):
+        for table in TABLE_QUERIES:
+            self.assertTrue(self.row_tables[table], table)
+        self.assertEqual(self.row_refused['malformed'], len(MALFORMED))
+        matches = [row for row in self.row_tables['match'] if row[0] == 'parity_match']
+        self.assertEqual(len(matches), 1)
+        # the first occurrence of an event id is kept
+        sessions = [row[:3] for row in self.row_tables['session'] if row[0] == 'parity_1']
+        self.assertEqual(sessions, [('parity_1', 10 ** 12 + 10, 10 ** 12 + 12)])
+        self.assertNotIn('parity_3', [row[0] for row in self.row_tables['user']])
+
+    def test_bulk(self):
+        bulk_tables, bulk_refused = self.load(TEST_DATABASE + '_bulk', 'bulk_insert_into_events')
+        for table in TABLE_QUERIES:
+            self.assertEqual(self.row_tables[table], bulk_tables[table], table)
+        self.assertEqual(sum(self.row_refused.values()), sum(bulk_refused.values()))
+
+    # the event ids used by the lines of another process are refused before the workers start, as the row by row
+    # insertion refuses them
+    def test_parallel(self):
+        parallel_tables, parallel_refused = self.load(TEST_DATABASE + '_parallel', 'parallel_insert_into_events',
+                                                      workers=PARALLEL_WORKERS)
+        for table in TABLE_QUERIES:
+            self.assertEqual(self.row_tables[table], parallel_tables[table], table)
+        self.assertEqual(self.row_refused, parallel_refused)
+
+    # the row by row insertion fails after a few checkpoints, as if the process died, and a new process resumes it
+    def test_resume(self):
+        checkpoint_lines = os.environ.get('CHECKPOINT_LINES')
+        os.environ['CHECKPOINT_LINES'] = str(RESUME_CHECKPOINT_LINES)
+        data_collection.conn.close()
+        try:
+            database_setup.connect_modules(TEST_DATABASE + '_resume', 'data_collection')
+        finally:
+            if checkpoint_lines is None:
+                os.environ.pop('CHECKPOINT_LINES')
+            else:
+                os.environ['CHECKPOINT_LINES'] = checkpoint_lines
+        insert_event = data_collection.insert_event
+        inserted = []
+
+        def failing_insert_event(opened_cursor, line):
+            if len(inserted) == RESUME_CHECKPOINT_LINES * 5 // 2:
+                raise RuntimeError("insertion interrupted")
+            inserted.append(line['event_id'])
+            return insert_event(opened_cursor, line)
+        data_collection.insert_event = failing_insert_event
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            data_collection.insert_into_country(os.path.join(ROOT, 'timezones.jsonl'))
+            with self.assertRaises(RuntimeError):
+                data_collection.insert_into_events(self.events_filename)
+        # the events after the last checkpoint are lost with the connection
+        data_collection.conn.close()
+        checkpoint = database_setup.server_connection(TEST_DATABASE + '_resume')
+        with checkpoint.cursor() as checkpoint_cursor:
+            checkpoint_cursor.execute("SELECT byte_offset FROM events.load_checkpoint")
+            [(byte_offset,)] = checkpoint_cursor.fetchall()
+            checkpoint_cursor.execute("SELECT COUNT(*) FROM events.event")
+            [(events,)] = checkpoint_cursor.fetchall()
+        checkpoint.close()
+        self.assertGreater(byte_offset, 0)
+        self.assertLess(byte_offset, os.path.getsize(self.events_filename))
+        self.assertTrue(0 < events < len(inserted))
+
+        resumed_tables, _ = self.load(TEST_DATABASE + '_resume', 'insert_into_events', resume=True)
+        for table in TABLE_QUERIES:
+            self.assertEqual(self.row_tables[table], resumed_tables[table], table)
+        with data_collection.conn.cursor() as checkpoint_cursor:
+            checkpoint_cursor.execute("SELECT COUNT(*) FROM events.load_checkpoint")
+            self.assertEqual(checkpoint_cursor.fetchone(), (0,))
+
+
+if __name__ == '__main__':
+    unittest.main(argv=sys.argv[:1])
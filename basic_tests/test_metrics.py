@@ -0,0 +1,110 @@
+import os
+import sys
+import unittest
+
+"""
+Checks that /metrics of api.py counts the requests by endpoint and status, and reports the duration of the requests
+and of every named query as histograms in the text format of prometheus, and that a connection that fails to be set
+up is given back to the pool.
+
+The tests create the empty database METRICS_TEST_DATABASE (events_metrics_test by default) with database/init.sql
+on the server given by the usual DATABASE_HOST, DATABASE_PORT, DATABASE_USER and DATABASE_PASSWORD environment
+variables, and drop it afterwards. They are skipped if there is no server to connect to.
+
+How to run tests:
+python basic_tests/test_metrics.py
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import database_setup
+
+TEST_DATABASE = os.environ.get('METRICS_TEST_DATABASE', 'events_metrics_test')
+
+
+# the samples of the text format by name and labels
+def parse_metrics(text):
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    return samples
+
+
+def setUpModule():
+    global api
+    database_setup.create_databases(TEST_DATABASE)
+    [api] = database_setup.connect_modules(TEST_DATABASE, 'api')
+
+
+def tearDownModule():
+    database_setup.disconnect_modules('api')
+    database_setup.drop_databases(TEST_DATABASE)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.client = api.app.test_client()
+
+    def metrics(self):
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        return parse_metrics(response.get_data(as_text=True))
+
+    def test_requests(self):
+        before = self.metrics()
+        self.client.get('/game_stats', json={'date': '2024-10-10'})
+        self.client.get('/game_stats', json={'date': 'not a date'})
+        self.client.get('/user_stats', json={'user_id': 'not a user', 'date': '2024-10-10'})
+        after = self.metrics()
+
+        def increase(sample):
+            return after.get(sample, 0) - before.get(sample, 0)
+
+        self.assertEqual(increase('api_requests_total{endpoint="/game_stats",method="GET",status="200"}'), 1)
+        self.assertEqual(increase('api_requests_total{endpoint="/game_stats",method="GET",status="400"}'), 1)
+        self.assertEqual(increase('api_requests_total{endpoint="/user_stats",method="GET",status="400"}'), 1)
+        self.assertEqual(increase('api_request_duration_seconds_count{endpoint="/game_stats"}'), 2)
+        self.assertEqual(increase('api_request_duration_seconds_bucket{endpoint="/game_stats",le="+Inf"}'), 2)
+        self.assertEqual(increase('api_query_duration_seconds_count{query="game_stats_days"}'), 1)
+        # a user missing from the summaries is calculated from the events
+        self.assertEqual(increase('api_query_duration_seconds_count{query="user_stats_summary_day"}'), 1)
+        self.assertEqual(increase('api_query_duration_seconds_count{query="user_stats_live_day"}'), 1)
+        self.assertEqual(after['api_pool_connections_in_use'], 0)
+        self.assertEqual(after['api_pool_connections_max'], api.app.config.get('DATABASE_POOL_MAX'))
+
+    def test_histogram_buckets(self):
+        self.client.get('/game_stats', json={})
+        samples = self.metrics()
+        buckets = [samples['api_request_duration_seconds_bucket'
+                           + api.format_labels((('endpoint', '/game_stats'), ('le', api.format_bound(bound))))]
+                   for bound in api.app.config.get('METRICS_BUCKETS') + (float('inf'),)]
+        self.assertEqual(buckets, sorted(buckets))
+        self.assertEqual(buckets[-1], samples['api_request_duration_seconds_count{endpoint="/game_stats"}'])
+
+    # a connection that cannot be switched to autocommit is closed and its slot given back, the request gets a 503
+    def test_connection_setup_failure(self):
+        getconn = api.pool.getconn
+
+        def getconn_in_transaction():
+            conn = getconn()
+            conn.autocommit = False
+            with conn.cursor() as open_cursor:
+                open_cursor.execute("SELECT 1")
+            return conn
+        api.pool.getconn = getconn_in_transaction
+        try:
+            for _ in range(api.app.config.get('DATABASE_POOL_MAX') + 1):
+                self.assertEqual(self.client.get('/game_stats', json={'date': '2024-10-12'}).status_code, 503)
+        finally:
+            api.pool.getconn = getconn
+        self.assertEqual(api.pool._used, {})
+        self.assertEqual(self.client.get('/game_stats', json={'date': '2024-10-12'}).status_code, 200)
+        self.assertEqual(self.metrics()['api_pool_connections_in_use'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main(argv=sys.argv[:1])
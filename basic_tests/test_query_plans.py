@@ -0,0 +1,299 @@
+import os
+import sys
+import json
+import datetime
+import importlib
+import unittest
+
+"""
+Checks the query plans of the hot queries of api.py and data_collection.py against a synthetic dataset.
+A test fails if a query reads one of the large tables with a sequential scan, or reads the partitions of sessions
+and matches of days it does not need.
+
+The tests create the database PLAN_TEST_DATABASE (events_plan_test by default) with database/init.sql on the server
+given by the usual DATABASE_HOST, DATABASE_PORT, DATABASE_USER and DATABASE_PASSWORD environment variables, and
+drop it afterwards. They are skipped if there is no server to connect to.
+Sequential scans are disabled for the session, so a sequential scan left in a plan means that no index can serve
+the query, whatever the size of the data. The size is set with PLAN_TEST_USERS (2000 by default).
+
+How to run tests:
+python basic_tests/test_query_plans.py
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import database_setup
+
+TEST_DATABASE = os.environ.get('PLAN_TEST_DATABASE', 'events_plan_test')
+USERS = int(os.environ.get('PLAN_TEST_USERS', '2000'))
+
+# tables that grow with the events. the other tables have a row per country, device, type or day.
+LARGE_TABLES = {('users', 'user'), ('events', 'event'), ('events', 'registration'), ('events', 'session'),
+                ('events', 'match'), ('stats', 'user_day'), ('stats', 'user_summary'),
+                ('stats', 'user_day_sessions'), ('stats', 'user_day_points')}
+
+SYNTHETIC_DATA = [
+    "INSERT INTO country.country(country_id, timezone) VALUES ('US', 'America/New_York'), ('DE', 'Europe/Berlin')",
+    "INSERT INTO users.user(user_id, user_name) SELECT n, 'user-' || n FROM generate_series(1, %(users)s) n",
+    "SELECT setval('users.user_user_id_seq', %(users)s)",
+    # registrations have the event ids of their users
+    ("INSERT INTO events.event(event_id, event_timestamp, event_type_id) "
+     "SELECT n, TIMESTAMPTZ '2024-10-07 00:00:00+00' + n * INTERVAL '1 second', 1 "
+     "FROM generate_series(1, %(users)s) n"),
+    ("INSERT INTO events.registration(event_id, user_id, device_id, country_code) "
+     "SELECT n, n, 1 + n %% 3, CASE WHEN n %% 2 = 0 THEN 'US' ELSE 'DE' END FROM generate_series(1, %(users)s) n"),
+    # ten sessions of ten minutes per user spread over the event window
+    ("INSERT INTO events.event(event_id, event_timestamp, event_type_id) "
+     "SELECT event_id, TIMESTAMPTZ '2024-10-07 00:00:00+00' + (n * 97 %% (27 * 86400)) * INTERVAL '1 second' "
+     "+ offset_seconds * INTERVAL '1 second', 2 "
+     "FROM generate_series(1, %(users)s * 10) n, "
+     "LATERAL (VALUES (1000000000 + n, 0), (2000000000 + n, 600)) session_event(event_id, offset_seconds)"),
+    ("INSERT INTO events.session(event_id_start, event_id_end, user_id, start_ts, end_ts, timezone) "
+     "SELECT 1000000000 + n, 2000000000 + n, 1 + n %% %(users)s, "
+     "TIMESTAMPTZ '2024-10-07 00:00:00+00' + (n * 97 %% (27 * 86400)) * INTERVAL '1 second', "
+     "TIMESTAMPTZ '2024-10-07 00:00:00+00' + (n * 97 %% (27 * 86400) + 600) * INTERVAL '1 second', "
+     "CASE WHEN (1 + n %% %(users)s) %% 2 = 0 THEN 'America/New_York' ELSE 'Europe/Berlin' END "
+     "FROM generate_series(1, %(users)s * 10) n"),
+    # two matches of fifteen minutes per user
+    ("INSERT INTO events.event(event_id, event_timestamp, event_type_id) "
+     "SELECT event_id, TIMESTAMPTZ '2024-10-07 00:00:00+00' + (n * 89 %% (27 * 86400)) * INTERVAL '1 second' "
+     "+ offset_seconds * INTERVAL '1 second', 3 "
+     "FROM generate_series(1, %(users)s * 2) n, "
+     "LATERAL (VALUES (3000000000 + n, 0), (4000000000 + n, 900)) match_event(event_id, offset_seconds)"),
+    ("INSERT INTO events.match(match_id, event_id_start, event_id_end, home_user_id, away_user_id, "
+     "home_goals_scored, away_goals_scored, start_ts, end_ts, home_timezone, away_timezone) "
+     "SELECT 'match-' || n, 3000000000 + n, 4000000000 + n, 1 + n %% %(users)s, 1 + (n + 1) %% %(users)s, "
+     "n %% 4, n %% 3, TIMESTAMPTZ '2024-10-07 00:00:00+00' + (n * 89 %% (27 * 86400)) * INTERVAL '1 second', "
+     "TIMESTAMPTZ '2024-10-07 00:00:00+00' + (n * 89 %% (27 * 86400) + 900) * INTERVAL '1 second', "
+     "CASE WHEN (1 + n %% %(users)s) %% 2 = 0 THEN 'America/New_York' ELSE 'Europe/Berlin' END, "
+     "CASE WHEN (1 + (n + 1) %% %(users)s) %% 2 = 0 THEN 'America/New_York' ELSE 'Europe/Berlin' END "
+     "FROM generate_series(1, %(users)s * 2) n"),
+]
+
+
+def explain(opened_cursor, query, parameters=None):
+    if isinstance(query, bytes):
+        query = query.decode()
+    opened_cursor.execute("EXPLAIN (VERBOSE, FORMAT JSON) " + opened_cursor.mogrify(query, parameters).decode())
+    plan = opened_cursor.fetchone()[0]
+    return plan[0]['Plan'] if isinstance(plan, list) else json.loads(plan)[0]['Plan']
+
+
+# the partitions of the partitioned tables, partition -> table. filled by setUpModule
+partitions = {}
+
+
+# the tables read anywhere in the plan, and whether they are read whole. with sequential scans disabled, the planner
+# reads a table whole by scanning one of its indexes without a condition instead.
+def scanned_tables(plan):
+    scans = []
+    if 'Relation Name' in plan:
+        full_scan = (plan['Node Type'] == 'Seq Scan'
+                     or plan['Node Type'] in ('Index Scan', 'Index Only Scan') and 'Index Cond' not in plan)
+        scans.append(((plan['Schema'], plan['Relation Name']), full_scan))
+    for subplan in plan.get('Plans', []):
+        scans += scanned_tables(subplan)
+    return scans
+
+
+# the large tables read whole anywhere in the plan. a partition read whole is a day chosen by partition pruning, the
+# partitioned table is read whole only when all its partitions are.
+def sequential_scans(plan):
+    scans = []
+    full_scans = {table for table, full_scan in scanned_tables(plan) if full_scan}
+    for table in full_scans & LARGE_TABLES:
+        scans.append(f"{table[0]}.{table[1]}")
+    for table in set(partitions.values()):
+        table_partitions = {partition for partition in partitions if partitions[partition] == table}
+        if table_partitions <= full_scans:
+            scans.append(f"{table[0]}.{table[1]}")
+    return scans
+
+
+# the days of the partitions of the table read anywhere in the plan
+def scanned_days(plan, table):
+    return {datetime.datetime.strptime(partition[1][-8:], '%Y%m%d').date()
+            for partition, _ in scanned_tables(plan) if partitions.get(partition) == table}
+
+
+class ExplainingCursor():
+    # passes the queries to the cursor, after recording the plan of every query that reads a table
+    def __init__(self, opened_cursor):
+        self.opened_cursor = opened_cursor
+        self.plans = []
+
+    def execute(self, query, parameters=None):
+        text = query.decode() if isinstance(query, bytes) else query
+        if text.lstrip().split(None, 1)[0].upper() in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH'):
+            self.plans.append((text, explain(self.opened_cursor, query, parameters)))
+        return self.opened_cursor.execute(query, parameters)
+
+    def __getattr__(self, name):
+        return getattr(self.opened_cursor, name)
+
+
+def setUpModule():
+    global data_collection
+    database_setup.create_databases(TEST_DATABASE)
+    [data_collection] = database_setup.connect_modules(TEST_DATABASE, 'data_collection')
+    data_collection.create_partitions(*data_collection.event_window())
+    with data_collection.conn.cursor() as setup_cursor:
+        for table, table_partitions in data_collection.existing_partitions(setup_cursor).items():
+            for partition in table_partitions.values():
+                partitions[tuple(partition.split('.'))] = tuple(table.split('.'))
+        for step in SYNTHETIC_DATA:
+            setup_cursor.execute(step, {'users': USERS})
+    data_collection.conn.commit()
+    data_collection.refresh_rollups()
+    data_collection.conn.autocommit = True
+    with data_collection.conn.cursor() as setup_cursor:
+        setup_cursor.execute("ANALYZE")
+    data_collection.conn.autocommit = False
+
+
+def tearDownModule():
+    database_setup.disconnect_modules('data_collection', 'api')
+    database_setup.drop_databases(TEST_DATABASE)
+
+
+class TestQueryPlans(unittest.TestCase):
+
+    def setUp(self):
+        self.cursor = data_collection.conn.cursor()
+        self.cursor.execute("SET enable_seqscan = off")
+
+    def tearDown(self):
+        data_collection.conn.rollback()
+        self.cursor.close()
+
+    def assertNoSequentialScans(self, query, plan):
+        self.assertEqual(sequential_scans(plan), [], f"Sequential scan in the plan of: {query}")
+
+
+class TestApiQueryPlans(TestQueryPlans):
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            cls.api = importlib.import_module('api')
+        except ImportError as error:
+            raise unittest.SkipTest(f"api.py cannot be imported: {error}")
+
+    # every query is checked with utc days and with the local days of the users
+    def test_user_stats_summary(self):
+        for local_day in (False, True):
+            plan = explain(self.cursor, self.api.user_stats_summary_query,
+                           {'user_names': ['user-1', 'user-2'], 'local_day': local_day})
+            self.assertNoSequentialScans('user_stats_summary_query', plan)
+
+    def test_user_stats_summary_day(self):
+        for local_day in (False, True):
+            plan = explain(self.cursor, self.api.user_stats_summary_day_query,
+                           {'user_names': ['user-1', 'user-2'], 'days': [datetime.date(2024, 10, 10)],
+                            'local_day': local_day})
+            self.assertNoSequentialScans('user_stats_summary_day_query', plan)
+
+    def test_user_stats_live(self):
+        for local_day in (False, True):
+            plan = explain(self.cursor, self.api.user_stats_live_query,
+                           {'user_names': ['user-1', 'user-2'], 'local_day': local_day})
+            self.assertNoSequentialScans('user_stats_live_query', plan)
+
+    def test_user_stats_live_day(self):
+        for local_day in (False, True):
+            plan = explain(self.cursor, self.api.user_stats_live_day_query,
+                           {'user_names': ['user-1', 'user-2'],
+                            'days': [datetime.date(2024, 10, 10), datetime.date(2024, 10, 12)],
+                            'first_day': datetime.date(2024, 10, 10), 'local_day': local_day})
+            self.assertNoSequentialScans('user_stats_live_day_query', plan)
+
+    def test_user_stats_live_day_partitions(self):
+        for local_day in (False, True):
+            plan = explain(self.cursor, self.api.user_stats_live_day_query,
+                           {'user_names': ['user-1', 'user-2'],
+                            'days': [datetime.date(2024, 10, 10), datetime.date(2024, 10, 12)],
+                            'first_day': datetime.date(2024, 10, 10), 'local_day': local_day})
+            # the last login reads the sessions of every day before, the matches are read from the day before the
+            # first requested day on
+            self.assertGreaterEqual(min(scanned_days(plan, ('events', 'match'))), datetime.date(2024, 10, 9))
+
+    def test_game_stats_days(self):
+        for local_day in (False, True):
+            plan = explain(self.cursor, self.api.game_stats_days_query,
+                           ([datetime.date(2024, 10, 10), datetime.date(2024, 10, 11)], local_day))
+            self.assertNoSequentialScans('game_stats_days_query', plan)
+
+
+class TestLoaderQueryPlans(TestQueryPlans):
+
+    # every query the row by row insertion runs for the events below is explained before it is executed
+    def test_insert_events(self):
+        data_collection.load_lookups()
+        explaining_cursor = ExplainingCursor(self.cursor)
+        timestamp = datetime.datetime(2024, 10, 20, 12, tzinfo=datetime.timezone.utc).timestamp()
+        events = [
+            {'event_id': 5000000001, 'event_type': 'registration', 'event_timestamp': timestamp,
+             'event_data': {'user_id': 'plan-user', 'country': 'US', 'device_os': 'ios'}},
+            # already registered, and registered with a country that does not exist
+            {'event_id': 5000000002, 'event_type': 'registration', 'event_timestamp': timestamp,
+             'event_data': {'user_id': 'user-1', 'country': 'US', 'device_os': 'ios'}},
+            {'event_id': 5000000003, 'event_type': 'registration', 'event_timestamp': timestamp,
+             'event_data': {'user_id': 'plan-user-2', 'country': 'XX', 'device_os': 'ios'}},
+            {'event_id': 5000000004, 'event_type': 'session_ping', 'event_timestamp': timestamp + 10,
+             'event_data': {'user_id': 'plan-user'}},
+            {'event_id': 5000000005, 'event_type': 'session_ping', 'event_timestamp': timestamp + 70,
+             'event_data': {'user_id': 'plan-user'}},
+            {'event_id': 5000000006, 'event_type': 'session_ping', 'event_timestamp': timestamp + 80,
+             'event_data': {'user_id': 'not-registered'}},
+            {'event_id': 5000000007, 'event_type': 'match', 'event_timestamp': timestamp + 100,
+             'event_data': {'match_id': 'plan-match', 'home_user_id': 'plan-user', 'away_user_id': 'user-1',
+                            'home_goals_scored': None, 'away_goals_scored': None}},
+            {'event_id': 5000000008, 'event_type': 'match', 'event_timestamp': timestamp + 200,
+             'event_data': {'match_id': 'plan-match', 'home_user_id': 'plan-user', 'away_user_id': 'user-1',
+                            'home_goals_scored': 2, 'away_goals_scored': 1}},
+            # a match end without a start, looked up in the database
+            {'event_id': 5000000009, 'event_type': 'match', 'event_timestamp': timestamp + 300,
+             'event_data': {'match_id': 'match-1', 'home_user_id': 'user-2', 'away_user_id': 'user-3',
+                            'home_goals_scored': 2, 'away_goals_scored': 1}},
+            # closes the session of plan-user
+            {'event_id': 5000000010, 'event_type': 'session_ping', 'event_timestamp': timestamp + 400,
+             'event_data': {'user_id': 'user-1'}},
+        ]
+        for event in events:
+            data_collection.insert_event(explaining_cursor, event)
+        data_collection.match_index.flush(explaining_cursor)
+        data_collection.session_tracker.close_all(explaining_cursor)
+        self.assertTrue(explaining_cursor.plans)
+        for query, plan in explaining_cursor.plans:
+            self.assertNoSequentialScans(query, plan)
+
+    # the refresh of the days touched by an incremental load, which are a small part of the days loaded before. the
+    # days after the synthetic data stand for them. every step reads its tables through indexes, and of the sessions
+    # and matches at most the partition of the day before them. the all time game totals are summed up from every row
+    # of stats.user_summary and are left out.
+    def test_refresh_rollups(self):
+        parameters = {'first_day': datetime.date(2024, 11, 4), 'last_day': datetime.date(2024, 11, 6),
+                      'last_summarised_user_id': USERS}
+        for step in data_collection.rollup_steps:
+            if 'stats.total_game' not in step:
+                plan = explain(self.cursor, step, parameters)
+                self.assertNoSequentialScans(step, plan)
+                for table in (('events', 'session'), ('events', 'match')):
+                    self.assertLessEqual(scanned_days(plan, table), {datetime.date(2024, 11, 3)}, step)
+
+    # the queries postgres runs to check the foreign keys when the loader deletes an event or a user
+    def test_foreign_key_checks(self):
+        for table, column in (('events.registration', 'event_id'), ('events.match', 'event_id_start'),
+                              ('events.match', 'event_id_end'), ('events.session', 'event_id_start'),
+                              ('events.session', 'event_id_end'), ('events.registration', 'user_id'),
+                              ('events.match', 'home_user_id'), ('events.match', 'away_user_id'),
+                              ('events.session', 'user_id'), ('stats.user_day', 'user_id'),
+                              ('stats.user_summary', 'user_id'), ('stats.user_day_sessions', 'user_id'),
+                              ('stats.user_day_points', 'user_id')):
+            query = f"SELECT 1 FROM {table} WHERE {column} = %s FOR KEY SHARE"
+            self.assertNoSequentialScans(query, explain(self.cursor, query, (1,)))
+
+
+if __name__ == '__main__':
+    unittest.main(argv=sys.argv[:1])
@@ -0,0 +1,156 @@
+import os
+import sys
+import json
+import tempfile
+import contextlib
+import unittest
+
+"""
+Checks that data_collection.py counts every refused event by its code, and writes it to the rejection file with its
+event_id, event_type, code and reason, for the row by row insertion and for the bulk insertion.
+
+The tests create the databases REJECTION_TEST_DATABASE (events_rejection_test by default) and the same name followed
+by _bulk with database/init.sql on the server given by the usual DATABASE_HOST, DATABASE_PORT, DATABASE_USER and
+DATABASE_PASSWORD environment variables, and drop them afterwards. They are skipped if there is no server to connect
+to.
+
+How to run tests:
+python basic_tests/test_rejection_log.py
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import database_setup
+from database_setup import event
+
+TEST_DATABASE = os.environ.get('REJECTION_TEST_DATABASE', 'events_rejection_test')
+
+
+def end(event_id, seconds, match_id, home, away, home_goals=1, away_goals=0):
+    return event(event_id, 'match', seconds, match_id=match_id, home_user_id=home, away_user_id=away,
+                 home_goals_scored=home_goals, away_goals_scored=away_goals)
+
+
+# events with the refusal expected for each of them
+EVENTS = [
+    (event(1, 'registration', 0, user_id='u1', country='DE', device_os='iOS'), None),
+    (event(2, 'registration', 1, user_id='u2', country='JP', device_os='Android'), None),
+    (event(3, 'registration', 2, user_id='u1', country='DE', device_os='iOS'), 'registration 2'),
+    (event(4, 'registration', 3, user_id='u3', country='XX', device_os='iOS'), 'registration 3'),
+    (event(5, 'registration', 4, user_id='u4', country='DE'), 'registration 1'),
+    (event(6, 'session_ping', 5, user_id='u9'), 'session_ping 2'),
+    (event(7, 'session_ping', 6), 'session_ping 1'),
+    (end(8, 7, 'm0', 'u1', 'u1', None, None), 'match 2'),
+    (end(9, 8, 'm0', 'u1', 'u2', 1, None), 'match 3'),
+    (end(10, 9, 'm9', 'u1', 'u2'), 'match 4'),
+    (end(11, 100, 'm1', 'u1', 'u2', None, None), None),
+    (end(12, 101, 'm1', 'u1', 'u2', None, None), 'match 9'),
+    (end(13, 200, 'm1', 'u2', 'u1'), 'match 6'),
+    (end(14, 50, 'm1', 'u1', 'u2'), 'match 7'),
+    (end(15, 300, 'm1', 'u1', 'u2'), None),
+    (end(16, 400, 'm1', 'u1', 'u2'), 'match 5'),
+    (event(17, 'unknown', 500), 'unknown_type'),
+    (event(1, 'registration', 501, user_id='u5', country='DE', device_os='iOS'), 'duplicate'),
+    (event(19, 'registration', -100 * 86400, user_id='u6', country='DE', device_os='iOS'), 'out_of_window'),
+    (event(20, 'match', 502, match_id='m2', home_user_id='u1'), 'match 1'),
+    # values of registrations that are null or not strings
+    (event(23, 'registration', 10, user_id='u7', country=None, device_os='iOS'), 'registration 3'),
+    (event(24, 'registration', 11, user_id='u8', country='DE', device_os=None), 'registration 3'),
+    (event(25, 'registration', 12, user_id='u10', country=49, device_os='iOS'), 'registration 3'),
+    (event(26, 'registration', 13, user_id=None, country='DE', device_os='iOS'), 'registration 1'),
+    # a ping sent twice, and a ping with the event id of a registration
+    (event(30, 'session_ping', 600, user_id='u1'), None),
+    (event(31, 'session_ping', 660, user_id='u1'), None),
+    (event(31, 'session_ping', 660, user_id='u1'), 'session_ping 3'),
+    (event(2, 'session_ping', 700, user_id='u2'), 'session_ping 3'),
+    (event(32, 'session_ping', 760, user_id='u2'), None),
+]
+
+# lines refused as malformed before they are events, by the reader and by the bulk insertion. the last two are not
+# valid utf-8 and hold a NUL
+MALFORMED = ['not json', '[1, 2]', '{"event_id": 21, "event_type": "session_ping", "event_data": {}}',
+             '{"event_id": 21, "event_type": "session_ping", "event_data": {}, "event_timestamp": null}',
+             '{"event_id": 22, "event_type": 7, "event_data": {}, "event_timestamp": 1728463546}',
+             '{"event_id": "27", "event_type": "session_ping", "event_data": {}, "event_timestamp": 1728463546}',
+             '{"event_id": 27.5, "event_type": "session_ping", "event_data": {}, "event_timestamp": 1728463546}',
+             '{"event_id": 18446744073709551616, "event_type": "session_ping", "event_data": {}, '
+             '"event_timestamp": 1728463546}',
+             '{"event_id": 28, "event_type": "session_ping", "event_data": [], "event_timestamp": 1728463546}',
+             '{"event_id": 29, "event_type": "session_ping", "event_data": {}, "event_timestamp": "1728463546"}',
+             '{"event_id": 33, "event_type": "session_ping", "event_data": {"user_id": "\udcff"}, '
+             '"event_timestamp": 1728463546}',
+             '{"event_id": 34, "event_type": "session_ping", "event_data": {"user_id": "\x00"}, '
+             '"event_timestamp": 1728463546}']
+
+
+def setUpModule():
+    global data_collection
+    database_setup.create_databases(TEST_DATABASE, TEST_DATABASE + '_bulk')
+    [data_collection] = database_setup.connect_modules(TEST_DATABASE, 'data_collection')
+
+
+def tearDownModule():
+    database_setup.disconnect_modules('data_collection')
+    database_setup.drop_databases(TEST_DATABASE, TEST_DATABASE + '_bulk')
+
+
+class TestRejectionLog(unittest.TestCase):
+
+    def setUp(self):
+        data_collection.rejection_log.counts.clear()
+        data_collection.stage_timer.seconds.clear()
+        data_collection.stage_timer.lines = 0
+        self.directory = tempfile.TemporaryDirectory()
+        self.events_filename = os.path.join(self.directory.name, 'events.jsonl')
+        data_collection.rejection_log.filename = os.path.join(self.directory.name, 'rejections.jsonl')
+
+    def tearDown(self):
+        data_collection.rejection_log.filename = None
+        self.directory.cleanup()
+
+    def load(self, lines, bulk):
+        with open(self.events_filename, 'wb') as events:
+            events.write(b''.join(line.encode('utf-8', 'surrogateescape') + b'\n' for line in lines))
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            data_collection.insert_into_country(os.path.join(ROOT, 'timezones.jsonl'))
+            if bulk:
+                data_collection.bulk_insert_into_events(self.events_filename)
+            else:
+                data_collection.insert_into_events(self.events_filename)
+        with open(data_collection.rejection_log.filename) as rejections:
+            return [json.loads(line) for line in rejections]
+
+    def assertRefused(self, rejected, expected):
+        keys = [row['rejection'] or f"{row['event_type']} {row['code']}" for row in rejected]
+        self.assertEqual(sorted(keys), sorted(expected))
+        self.assertEqual(dict(data_collection.rejection_log.counts), {key: expected.count(key) for key in expected})
+        for row in rejected:
+            self.assertEqual(sorted(row), ['code', 'event_id', 'event_type', 'reason', 'rejection'])
+            self.assertIsNotNone(row['reason'])
+            if row['rejection'] is None:
+                self.assertIn(row['code'], range(1, 10))
+
+    def test_row_by_row(self):
+        expected = [refusal for _, refusal in EVENTS if refusal is not None] + ['malformed'] * len(MALFORMED)
+        rejected = self.load([json.dumps(line) for line, _ in EVENTS] + MALFORMED, bulk=False)
+        self.assertRefused(rejected, expected)
+        self.assertEqual(data_collection.stage_timer.lines, len(EVENTS) + len(MALFORMED))
+        for stage in ('parse', 'event insert', 'strategy registration', 'strategy match', 'cleanup close sessions'):
+            self.assertIn(stage, data_collection.stage_timer.seconds)
+
+    def test_bulk(self):
+        data_collection.conn.close()
+        data_collection.conn = database_setup.server_connection(TEST_DATABASE + '_bulk')
+        try:
+            rejected = self.load([json.dumps(line) for line, _ in EVENTS] + MALFORMED, bulk=True)
+        finally:
+            data_collection.conn.close()
+            data_collection.conn = database_setup.server_connection(TEST_DATABASE)
+        expected = [refusal for _, refusal in EVENTS if refusal is not None] + ['malformed'] * len(MALFORMED)
+        self.assertRefused(rejected, expected)
+        self.assertIn('copy to staging', data_collection.stage_timer.seconds)
+
+
+if __name__ == '__main__':
+    unittest.main(argv=sys.argv[:1])
@@ -0,0 +1,121 @@
+import os
+import sys
+import unittest
+
+"""
+Checks that api.py answers repeated requests from its response cache, evicts the least recently used response when
+the cache is full, and drops every cached response once the data version in the database changes, so that new data
+is served at once.
+
+The tests create the database CACHE_TEST_DATABASE (events_cache_test by default) with database/init.sql on the
+server given by the usual DATABASE_HOST, DATABASE_PORT, DATABASE_USER and DATABASE_PASSWORD environment variables,
+fill a few rows of the daily rollups, and drop it afterwards. They are skipped if there is no server to connect to.
+
+How to run tests:
+python basic_tests/test_response_cache.py
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import database_setup
+
+TEST_DATABASE = os.environ.get('CACHE_TEST_DATABASE', 'events_cache_test')
+
+
+def setUpModule():
+    global api, database
+    database_setup.create_databases(TEST_DATABASE)
+    database = database_setup.server_connection(TEST_DATABASE)
+    with database.cursor() as setup_cursor:
+        setup_cursor.execute("INSERT INTO stats.daily_game(local_day, day, dau, number_of_sessions, "
+                             "average_sessions_number, max_points_users) "
+                             "SELECT FALSE, day, 10, 20, 2, '{u1}' "
+                             "FROM generate_series(DATE '2024-10-07', DATE '2024-11-03', INTERVAL '1 day') day")
+    database.commit()
+    [api] = database_setup.connect_modules(TEST_DATABASE, 'api')
+
+
+def tearDownModule():
+    database.close()
+    database_setup.disconnect_modules('api')
+    database_setup.drop_databases(TEST_DATABASE)
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.client = api.app.test_client()
+        # the data version is read on every request
+        api.response_cache.version_check_seconds = 0
+        api.response_cache.responses.clear()
+
+    def tearDown(self):
+        api.response_cache.version_check_seconds = api.app.config.get('DATA_VERSION_CHECK_SECONDS')
+        api.response_cache.size = api.app.config.get('RESPONSE_CACHE_SIZE')
+
+    def statistics(self):
+        return self.client.get('/cache_stats').get_json()
+
+    def dau(self, date):
+        response = self.client.get('/game_stats', json={'date': date})
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()['dau']
+
+    # changes the rollups as a load would, and publishes the new data version if asked to
+    def load(self, dau, publish):
+        with database.cursor() as load_cursor:
+            load_cursor.execute("UPDATE stats.daily_game SET dau = %s", (dau,))
+            if publish:
+                load_cursor.execute("UPDATE events.data_version SET version = version + 1")
+        database.commit()
+
+    def test_hits(self):
+        before = self.statistics()
+        self.assertEqual(self.dau('2024-10-10'), self.dau('2024-10-10'))
+        # the same request in other words is the same response
+        self.client.get('/game_stats', json={'dates': ['2024-10-11', '2024-10-10', '2024-10-11']})
+        self.client.get('/game_stats', json={'from': '2024-10-10', 'to': '2024-10-11'})
+        after = self.statistics()
+        self.assertEqual(after['hits'] - before['hits'], 2)
+        self.assertEqual(after['misses'] - before['misses'], 2)
+        self.assertEqual(after['size'], 2)
+
+    def test_invalidation(self):
+        self.load(10, publish=True)
+        self.assertEqual(self.dau('2024-10-12'), 10)
+        # rollups changed without a new data version are not seen, the cached response is served
+        self.load(11, publish=False)
+        self.assertEqual(self.dau('2024-10-12'), 10)
+        before = self.statistics()
+        self.load(12, publish=True)
+        self.assertEqual(self.dau('2024-10-12'), 12)
+        after = self.statistics()
+        self.assertEqual(after['invalidations'] - before['invalidations'], 1)
+        self.assertEqual(after['data_version'], before['data_version'] + 1)
+        self.assertEqual(after['size'], 1)
+
+    # the version is read at most once every version_check_seconds, until then the cached response is served
+    def test_version_check_interval(self):
+        self.load(20, publish=True)
+        api.response_cache.version_check_seconds = 3600
+        self.assertEqual(self.dau('2024-10-13'), 20)
+        self.load(21, publish=True)
+        self.assertEqual(self.dau('2024-10-13'), 20)
+        api.response_cache.version_check_seconds = 0
+        self.assertEqual(self.dau('2024-10-13'), 21)
+
+    def test_eviction(self):
+        api.response_cache.size = 2
+        before = self.statistics()
+        for date in ('2024-10-14', '2024-10-15', '2024-10-14', '2024-10-16', '2024-10-14', '2024-10-15'):
+            self.dau(date)
+        after = self.statistics()
+        # 2024-10-15 was the least recently used when 2024-10-16 came, then 2024-10-16 when it came back
+        self.assertEqual(after['evictions'] - before['evictions'], 2)
+        self.assertEqual(after['hits'] - before['hits'], 2)
+        self.assertEqual(after['size'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main(argv=sys.argv[:1])
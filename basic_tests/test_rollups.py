@@ -0,0 +1,166 @@
+import os
+import sys
+import datetime
+import tempfile
+import contextlib
+import unittest
+
+"""
+Checks that the rollups data_collection.py refreshes after every incremental load, for the days the load touched,
+are the same as the rollups rebuilt from all the events at once. The game statistics of every day and of all time
+are compared, and so are the statistics of every user per day and of all time, which must also add up. Once the
+partitions of the first days are dropped, the rollups of those days and the all time totals stay the same, however
+the rollups are refreshed afterwards.
+
+The events are generated with benchmarks/generate_events.py and loaded with --incremental in ROLLUP_TEST_PARTS
+files (3 by default), split in the order of the lines, so sessions and matches continue from one file to the next.
+The size is set with ROLLUP_TEST_EVENTS (10000 by default).
+The tests create the database ROLLUP_TEST_DATABASE (events_rollup_test by default) with database/init.sql on the
+server given by the usual DATABASE_HOST, DATABASE_PORT, DATABASE_USER and DATABASE_PASSWORD environment variables,
+and drop it afterwards. They are skipped if there is no server to connect to.
+
+How to run tests:
+python basic_tests/test_rollups.py
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import database_setup
+from generate_events import generate_events
+
+TEST_DATABASE = os.environ.get('ROLLUP_TEST_DATABASE', 'events_rollup_test')
+EVENTS = int(os.environ.get('ROLLUP_TEST_EVENTS', '10000'))
+PARTS = int(os.environ.get('ROLLUP_TEST_PARTS', '3'))
+
+# the rollups by user_name instead of user_id, with the users of the leaderboards in order
+ROLLUP_QUERIES = {
+    'daily_game': ("SELECT local_day, day, dau, number_of_sessions, average_sessions_number, "
+                   "ARRAY(SELECT unnest(max_points_users) ORDER BY 1) FROM stats.daily_game ORDER BY 1, 2"),
+    'total_game': ("SELECT dau, number_of_sessions, average_sessions_number, "
+                   "ARRAY(SELECT unnest(max_points_users) ORDER BY 1) FROM stats.total_game"),
+    'user_day_sessions': ("SELECT u.user_name, r.local_day, r.day, r.sessions FROM stats.user_day_sessions r "
+                          "JOIN users.user u ON u.user_id = r.user_id ORDER BY 1, 2, 3"),
+    'user_day_points': ("SELECT u.user_name, r.local_day, r.day, r.points FROM stats.user_day_points r "
+                        "JOIN users.user u ON u.user_id = r.user_id ORDER BY 1, 2, 3"),
+    'user_day': ("SELECT u.user_name, r.local_day, r.day, r.sessions_number, r.time_spent, r.score_home, "
+                 "r.score_away, r.match_time FROM stats.user_day r JOIN users.user u ON u.user_id = r.user_id "
+                 "ORDER BY 1, 2, 3"),
+    'user_summary': ("SELECT user_name, country_id, timezone, registration_ts, last_login, last_login_local, "
+                     "sessions_number, time_spent, score_home, score_away, match_time "
+                     "FROM stats.user_summary ORDER BY 1"),
+}
+
+
+def setUpModule():
+    global data_collection, directory, refreshed
+    database_setup.create_databases(TEST_DATABASE)
+    [data_collection] = database_setup.connect_modules(TEST_DATABASE, 'data_collection')
+    directory = tempfile.TemporaryDirectory()
+    events_filename = os.path.join(directory.name, 'events.jsonl')
+    with open(events_filename, 'w') as output:
+        generate_events(output, EVENTS)
+    with open(events_filename) as events:
+        lines = events.readlines()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        data_collection.insert_into_country(os.path.join(ROOT, 'timezones.jsonl'))
+        for part in range(PARTS):
+            part_filename = os.path.join(directory.name, f"events_{part}.jsonl")
+            with open(part_filename, 'w') as part_file:
+                part_file.writelines(lines[part * len(lines) // PARTS:(part + 1) * len(lines) // PARTS])
+            first_timestamp, last_timestamp = data_collection.insert_into_events(part_filename, incremental=True)
+            data_collection.refresh_rollups(first_timestamp, last_timestamp)
+    refreshed = rollups()
+
+
+def tearDownModule():
+    directory.cleanup()
+    database_setup.disconnect_modules('data_collection')
+    database_setup.drop_databases(TEST_DATABASE)
+
+
+def rollups():
+    with data_collection.conn.cursor() as rollup_cursor:
+        rows = {}
+        for table, query in ROLLUP_QUERIES.items():
+            rollup_cursor.execute(query)
+            rows[table] = rollup_cursor.fetchall()
+    data_collection.conn.rollback()
+    return rows
+
+
+class TestRollups(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            data_collection.refresh_rollups()
+        cls.rebuilt = rollups()
+
+    def test_refreshed_as_rebuilt(self):
+        for table in ROLLUP_QUERIES:
+            self.assertTrue(self.rebuilt[table], table)
+            self.assertEqual(refreshed[table], self.rebuilt[table], table)
+
+    # every day of the window that has sessions has a row, over utc days and over local days
+    def test_days(self):
+        days = {(local_day, day) for local_day, day, *_ in self.rebuilt['daily_game']}
+        session_days = {(local_day, day) for _, local_day, day, _ in self.rebuilt['user_day_sessions']}
+        self.assertEqual(days, session_days)
+        self.assertEqual({local_day for local_day, _ in days}, {False, True})
+
+    # the all time statistics of a user are the sum of the days, over utc days and over local days, and the last
+    # login is the last day with a session
+    def test_user_summary(self):
+        summaries = {user_name: summary for user_name, *summary in self.rebuilt['user_summary']}
+        for local_day in (False, True):
+            totals = {user_name: [0, 0, 0, 0, 0, None] for user_name in summaries}
+            for user_name, row_local_day, day, *statistics in self.rebuilt['user_day']:
+                if row_local_day != local_day:
+                    continue
+                total = totals[user_name]
+                for position, value in enumerate(statistics):
+                    total[position] += value
+                if statistics[0] > 0:
+                    total[5] = max(total[5] or day, day)
+            for user_name, (_, _, _, last_login, last_login_local, *statistics) in summaries.items():
+                self.assertEqual(totals[user_name][:4], statistics[:4], user_name)
+                self.assertAlmostEqual(float(totals[user_name][4]), float(statistics[4]), places=3, msg=user_name)
+                self.assertEqual(totals[user_name][5], last_login_local if local_day else last_login, user_name)
+
+
+class TestDroppedPartitions(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            data_collection.refresh_rollups()
+            cls.before = rollups()
+            data_collection.drop_partitions(datetime.date(2024, 10, 15))
+            # dropping fewer days afterwards does not thaw the frozen days
+            data_collection.drop_partitions(datetime.date(2024, 10, 10))
+
+    def refreshed(self, *timestamps):
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            data_collection.refresh_rollups(*timestamps)
+        return rollups()
+
+    def test_frozen_days(self):
+        with data_collection.conn.cursor() as partition_cursor:
+            partitions = data_collection.existing_partitions(partition_cursor)
+            partition_cursor.execute("SELECT before_day FROM stats.frozen_days")
+            self.assertEqual(partition_cursor.fetchall(), [(datetime.date(2024, 10, 16),)])
+        data_collection.conn.rollback()
+        for table_partitions in partitions.values():
+            self.assertEqual(min(table_partitions), datetime.date(2024, 10, 15))
+
+    def test_rebuilt(self):
+        self.assertEqual(self.refreshed(), self.before)
+
+    def test_refreshed(self):
+        self.assertEqual(self.refreshed(*data_collection.event_window()), self.before)
+
+
+if __name__ == '__main__':
+    unittest.main(argv=sys.argv[:1])
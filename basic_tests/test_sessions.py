@@ -0,0 +1,151 @@
+import os
+import sys
+import json
+import datetime
+import tempfile
+import contextlib
+import unittest
+
+"""
+Checks the sessions data_collection.py writes from the session pings, row by row and in bulk, and that analytics.py
+keeps the same sessions: a ping sent again, in the middle of its session or after the session is written, is refused
+as a duplicate without splitting the session, and so is a late ping before the last ping of the session. An event
+that uses the event id of a ping of an open session is refused as a duplicate, and the session is kept. Every
+session is a single row with its duration and its utc and local days, in the partition of the utc day it ends on,
+and a session of a single ping is not written.
+
+The tests create the databases SESSION_TEST_DATABASE (events_session_test by default) and the same name followed by
+_bulk with database/init.sql on the server given by the usual DATABASE_HOST, DATABASE_PORT, DATABASE_USER and
+DATABASE_PASSWORD environment variables, and drop them afterwards. They are skipped if there is no server to connect
+to.
+
+How to run tests:
+python basic_tests/test_sessions.py
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pytz
+import database_setup
+from database_setup import START, event
+
+TEST_DATABASE = os.environ.get('SESSION_TEST_DATABASE', 'events_session_test')
+
+
+def ping(event_id, seconds, user_name):
+    return event(event_id, 'session_ping', seconds, user_id=user_name)
+
+
+EVENTS = [
+    event(1, 'registration', 0, user_id='u1', country='DE', device_os='iOS'),
+    event(2, 'registration', 1, user_id='u2', country='DE', device_os='iOS'),
+    event(3, 'registration', 2, user_id='u3', country='DE', device_os='iOS'),
+    # the ping in the middle of the session of u1 is sent again before the session goes on, and the event id of its
+    # first ping is used by a registration
+    ping(10, 100, 'u1'), ping(11, 160, 'u1'), ping(12, 220, 'u1'), ping(13, 280, 'u1'),
+    ping(11, 160, 'u1'), event(10, 'registration', 290, user_id='u6', country='DE', device_os='iOS'),
+    ping(14, 340, 'u1'),
+    # u3 sends a ping late, before the last ping of the session
+    ping(30, 100, 'u3'), ping(31, 160, 'u3'), ping(32, 220, 'u3'), ping(33, 130, 'u3'), ping(34, 280, 'u3'),
+    # the session of u2 is written when the events move past it, then its pings come again
+    ping(20, 400, 'u2'), ping(21, 460, 'u2'), ping(22, 520, 'u2'),
+    event(4, 'registration', 1000, user_id='u4', country='DE', device_os='iOS'),
+    ping(21, 460, 'u2'), ping(20, 400, 'u2'), ping(22, 520, 'u2'),
+    # and a new session of u2 follows
+    ping(23, 1100, 'u2'), ping(24, 1160, 'u2'),
+    # a session of a single ping
+    event(5, 'registration', 1500, user_id='u5', country='DE', device_os='iOS'), ping(50, 2000, 'u5'),
+    # sessions over midnight in berlin, where the users are, and over midnight utc
+    ping(40, 47600, 'u4'), ping(41, 47660, 'u4'), ping(42, 54800, 'u4'), ping(43, 54860, 'u4'),
+]
+
+# user, first and last ping of the sessions written
+SESSIONS = [('u1', 10, 14, START + 100, START + 340), ('u2', 20, 22, START + 400, START + 520),
+            ('u2', 23, 24, START + 1100, START + 1160), ('u3', 30, 34, START + 100, START + 280),
+            ('u4', 40, 41, START + 47600, START + 47660), ('u4', 42, 43, START + 54800, START + 54860)]
+REFUSED = {'session_ping 3': 4, 'session_ping 4': 1, 'duplicate': 1}
+
+
+# the duration, the timezone, the utc and local days of the start and the end, and the partition of every session
+def session_days(start, end):
+    berlin = pytz.timezone('Europe/Berlin')
+    start_time = datetime.datetime.fromtimestamp(start, datetime.timezone.utc)
+    end_time = datetime.datetime.fromtimestamp(end, datetime.timezone.utc)
+    return (end - start, 'Europe/Berlin', start_time.date(), end_time.date(), start_time.astimezone(berlin).date(),
+            end_time.astimezone(berlin).date(), f"events.session_{end_time:%Y%m%d}")
+
+
+SESSION_DAYS = [session_days(start, end) for _, _, _, start, end in SESSIONS]
+
+
+def setUpModule():
+    global data_collection, analytics
+    database_setup.create_databases(TEST_DATABASE, TEST_DATABASE + '_bulk')
+    [data_collection, analytics] = database_setup.connect_modules(TEST_DATABASE, 'data_collection', 'analytics')
+
+
+def tearDownModule():
+    database_setup.disconnect_modules('data_collection')
+    database_setup.drop_databases(TEST_DATABASE, TEST_DATABASE + '_bulk')
+
+
+class TestSessions(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.events_filename = os.path.join(cls.directory.name, 'events.jsonl')
+        with open(cls.events_filename, 'w') as events:
+            events.write(''.join(json.dumps(line) + '\n' for line in EVENTS))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def setUp(self):
+        data_collection.rejection_log.counts.clear()
+
+    def load(self, bulk):
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            data_collection.insert_into_country(os.path.join(ROOT, 'timezones.jsonl'))
+            if bulk:
+                data_collection.bulk_insert_into_events(self.events_filename)
+            else:
+                data_collection.insert_into_events(self.events_filename)
+        with data_collection.conn.cursor() as session_cursor:
+            session_cursor.execute("SELECT u.user_name, s.event_id_start, s.event_id_end, "
+                                   "EXTRACT(EPOCH FROM s.start_ts)::BIGINT, EXTRACT(EPOCH FROM s.end_ts)::BIGINT, "
+                                   "s.duration, s.timezone, s.start_day, s.end_day, s.start_local_day, "
+                                   "s.end_local_day, s.tableoid::REGCLASS::TEXT "
+                                   "FROM events.session s JOIN users.user u ON u.user_id = s.user_id "
+                                   "ORDER BY u.user_name, s.start_ts")
+            sessions = session_cursor.fetchall()
+        self.assertEqual([session[5:] for session in sessions], SESSION_DAYS)
+        return [session[:5] for session in sessions]
+
+    def test_row_by_row(self):
+        self.assertEqual(self.load(bulk=False), SESSIONS)
+        self.assertEqual(dict(data_collection.rejection_log.counts), REFUSED)
+
+    def test_bulk(self):
+        data_collection.conn.close()
+        data_collection.conn = database_setup.server_connection(TEST_DATABASE + '_bulk')
+        try:
+            self.assertEqual(self.load(bulk=True), SESSIONS)
+        finally:
+            data_collection.conn.close()
+            data_collection.conn = database_setup.server_connection(TEST_DATABASE)
+        self.assertEqual(dict(data_collection.rejection_log.counts), REFUSED)
+
+    def test_analytics(self):
+        columns, refused = analytics.read_events(os.path.join(ROOT, 'timezones.jsonl'), self.events_filename)
+        sessions = sorted((columns.user_names[user], start, end) for user, start, end
+                          in zip(columns.session_users, columns.session_starts, columns.session_ends))
+        self.assertEqual(sessions, [(user_name, start, end) for user_name, _, _, start, end in SESSIONS])
+        self.assertEqual(refused['session_ping'], REFUSED['session_ping 3'] + REFUSED['session_ping 4'])
+        self.assertEqual(refused['duplicate'], REFUSED['duplicate'])
+
+
+if __name__ == '__main__':
+    unittest.main(argv=sys.argv[:1])
@@ -0,0 +1,229 @@
+import argparse
+import collections
+import datetime
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import psycopg2
+
+"""
+Measures the throughput and the latency of /user_stats and /game_stats under concurrent clients.
+
+Unless --skip-load is given, a generated events file (or --file) is loaded with the bulk insertion into a new
+database BENCHMARK_DATABASE (events_benchmark by default), see ingest_benchmark.py. api.py is then started on that
+database and every client sends requests one after the other for --duration seconds, choosing the endpoint by the
+weights of --mix: undated and dated /user_stats of a random registered user, and undated, dated and date range
+/game_stats. --local-share of the requests ask for the local days of the users. The requests of the first --warmup
+seconds are left out of the results.
+
+The results are the requests per second and the 50th, 95th and 99th percentile of the latency of every kind of
+request and of all of them, and the hits and misses of the response cache of the api. Run with RESPONSE_CACHE_SIZE=0
+to measure the queries without the cache. --output writes the results as json together with the commit of the tree,
+so the results of two versions can be compared.
+
+How to run:
+python benchmarks/api_benchmark.py --events 1000000 --clients 16 --duration 30 --output api.json
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+from ingest_benchmark import BENCHMARK_DATABASE, benchmark, connection_parameters
+from generate_events import generate_events
+
+WINDOW_DAYS = [datetime.date(2024, 10, 7) + datetime.timedelta(days=day) for day in range(28)]
+REQUEST_KINDS = ['user_stats', 'user_stats_dated', 'game_stats', 'game_stats_dated', 'game_stats_range']
+DEFAULT_MIX = {'user_stats': 4, 'user_stats_dated': 4, 'game_stats': 1, 'game_stats_dated': 1, 'game_stats_range': 1}
+
+
+def parse_mix(values):
+    mix = {}
+    for value in values:
+        kind, _, weight = value.partition('=')
+        if kind not in REQUEST_KINDS:
+            raise argparse.ArgumentTypeError(f"Unknown request kind {kind}, use one of {', '.join(REQUEST_KINDS)}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+# the path and the json body of a random request of the given kind
+def random_request(rng, kind, user_names, local_share):
+    body = {'timezone': 'local'} if rng.random() < local_share else {}
+    if kind.startswith('user_stats'):
+        body['user_id'] = rng.choice(user_names)
+        if kind == 'user_stats_dated':
+            body['date'] = rng.choice(WINDOW_DAYS).isoformat()
+        return '/user_stats', body
+    if kind == 'game_stats_dated':
+        body['date'] = rng.choice(WINDOW_DAYS).isoformat()
+    elif kind == 'game_stats_range':
+        first_day, last_day = sorted(rng.sample(WINDOW_DAYS, 2))
+        body['from'] = first_day.isoformat()
+        body['to'] = last_day.isoformat()
+    return '/game_stats', body
+
+
+def send(port, path, body):
+    connection = http.client.HTTPConnection('localhost', port, timeout=60)
+    try:
+        connection.request('GET', path, json.dumps(body), {'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+
+# runs in its own thread. appends (kind, start, seconds, status) of every request to latencies until the deadline
+def client(port, seed, mix, user_names, local_share, deadline, latencies):
+    rng = random.Random(seed)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    while time.perf_counter() < deadline:
+        kind = rng.choices(kinds, weights=weights)[0]
+        path, body = random_request(rng, kind, user_names, local_share)
+        started = time.perf_counter()
+        try:
+            status = send(port, path, body)
+        except OSError:
+            status = None
+        latencies.append((kind, started, time.perf_counter() - started, status))
+
+
+# nearest rank percentile of sorted values
+def percentile(values, share):
+    return values[max(0, min(len(values) - 1, int(share * len(values) + 0.5) - 1))]
+
+
+def summarise(latencies, seconds):
+    seconds_sorted = sorted(latency for latency, _ in latencies)
+    errors = sum(1 for _, status in latencies if status != 200)
+    if not seconds_sorted:
+        return {'requests': 0, 'errors': 0}
+    return {'requests': len(seconds_sorted), 'errors': errors, 'requests_per_second': len(seconds_sorted) / seconds,
+            'mean_ms': sum(seconds_sorted) / len(seconds_sorted) * 1000,
+            'p50_ms': percentile(seconds_sorted, 0.5) * 1000, 'p95_ms': percentile(seconds_sorted, 0.95) * 1000,
+            'p99_ms': percentile(seconds_sorted, 0.99) * 1000, 'max_ms': seconds_sorted[-1] * 1000}
+
+
+def start_api(database, port):
+    environment = dict(os.environ, DATABASE_NAME=database)
+    api = subprocess.Popen([sys.executable, '-m', 'flask', '--app', 'api', 'run', '--port', str(port),
+                            '--with-threads'], cwd=ROOT, env=environment,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        if api.poll() is not None:
+            raise RuntimeError(f"api.py exited with code {api.returncode}")
+        try:
+            connection = http.client.HTTPConnection('localhost', port, timeout=1)
+            connection.request('GET', '/cache_stats')
+            if connection.getresponse().status == 200:
+                return api
+        except OSError:
+            time.sleep(0.1)
+    api.terminate()
+    raise RuntimeError("api.py did not start")
+
+
+def cache_statistics(port):
+    connection = http.client.HTTPConnection('localhost', port, timeout=10)
+    connection.request('GET', '/cache_stats')
+    return json.loads(connection.getresponse().read())
+
+
+def run(database, port, clients, duration, warmup, mix, local_share, seed):
+    with psycopg2.connect(**connection_parameters(database)) as user_conn, user_conn.cursor() as user_cursor:
+        user_cursor.execute("SELECT user_name FROM users.user ORDER BY user_id")
+        user_names = [user_name for user_name, in user_cursor.fetchall()]
+    user_conn.close()
+    if not user_names:
+        raise RuntimeError(f"No users in database {database}")
+
+    api = start_api(database, port)
+    try:
+        latencies = []
+        started = time.perf_counter()
+        measured_from = started + warmup
+        deadline = measured_from + duration
+        threads = [threading.Thread(target=client, args=(port, seed * 1000 + number, mix, user_names, local_share,
+                                                         deadline, latencies))
+                   for number in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        cache = cache_statistics(port)
+    finally:
+        api.terminate()
+        api.wait()
+
+    measured = [(kind, seconds, status) for kind, start, seconds, status in latencies if start >= measured_from]
+    # the last requests may finish after the deadline
+    seconds = max(deadline, max((start + seconds for _, start, seconds, _ in latencies), default=deadline)) \
+        - measured_from
+    by_kind = collections.defaultdict(list)
+    for kind, latency, status in measured:
+        by_kind[kind].append((latency, status))
+    return {'all': summarise([(latency, status) for _, latency, status in measured], seconds),
+            'by_kind': {kind: summarise(by_kind[kind], seconds) for kind in mix},
+            'cache': cache}
+
+
+def tree_version():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark /user_stats and /game_stats under concurrent clients.')
+    parser.add_argument('--file', help='events file to load, generated if not given')
+    parser.add_argument('--events', type=int, default=100000, help='approximate number of events to generate')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the generated events and of the requests')
+    parser.add_argument('--skip-load', action='store_true', help='use the data already in the benchmark database')
+    parser.add_argument('--clients', type=int, default=8, help='number of concurrent clients')
+    parser.add_argument('--duration', type=float, default=30, help='seconds the requests are measured')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds of requests left out of the results')
+    parser.add_argument('--mix', nargs='+', type=str, help='weights of the request kinds, as kind=weight')
+    parser.add_argument('--local-share', type=float, default=0.2, help='share of the requests over local days')
+    parser.add_argument('--port', type=int, default=5077, help='port the api is started on')
+    parser.add_argument('--output', help='file to write the results to, as json')
+    arguments = parser.parse_args()
+    try:
+        mix = parse_mix(arguments.mix) if arguments.mix else DEFAULT_MIX
+    except argparse.ArgumentTypeError as error:
+        parser.error(str(error))
+
+    load = None
+    if not arguments.skip_load:
+        with tempfile.TemporaryDirectory() as directory:
+            events_filename = arguments.file
+            if events_filename is None:
+                events_filename = os.path.join(directory, 'events.jsonl')
+                with open(events_filename, 'w') as output:
+                    generate_events(output, arguments.events, arguments.seed)
+            load = benchmark(events_filename, 'bulk', database=BENCHMARK_DATABASE)
+        print(f"Loaded {load['lines']} lines in {load['insert_seconds']:.1f} s, rows {load['rows']}")
+
+    results = run(BENCHMARK_DATABASE, arguments.port, arguments.clients, arguments.duration, arguments.warmup, mix,
+                  arguments.local_share, arguments.seed)
+    for kind, result in [('all', results['all'])] + list(results['by_kind'].items()):
+        if result['requests']:
+            print(f"{kind:17} {result['requests']:7} requests {result['errors']:5} errors "
+                  f"{result['requests_per_second']:8.1f} req/s  p50 {result['p50_ms']:7.1f} ms  "
+                  f"p95 {result['p95_ms']:7.1f} ms  p99 {result['p99_ms']:7.1f} ms")
+    print(f"cache hits {results['cache']['hits']} misses {results['cache']['misses']}")
+    if arguments.output:
+        with open(arguments.output, 'w') as output:
+            json.dump({'version': tree_version(), 'events': arguments.file or arguments.events,
+                       'seed': arguments.seed, 'clients': arguments.clients, 'duration': arguments.duration,
+                       'warmup': arguments.warmup, 'mix': mix, 'local_share': arguments.local_share,
+                       'load': load, **results}, output, indent=2)
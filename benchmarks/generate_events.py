@@ -0,0 +1,179 @@
+import argparse
+import collections
+import datetime
+import heapq
+import json
+import random
+import uuid
+
+"""
+Writes a synthetic events file in the format of events.jsonl, for the benchmarks of the loader and the api.
+The same seed and size always give the same file.
+
+Events are produced in the order of their timestamps: registrations, sessions of pings 60 seconds apart and matches
+with a start and an end, in the proportions of EVENT_SHARES. Unless --clean is given, the file also contains the
+cases the loader refuses, in the proportions of DIRTY_SHARES: duplicate event ids, timestamps outside the event
+window, matches of a user against himself and registrations with an unknown country. A share of the matches never
+ends (UNTERMINATED_MATCHES).
+Only the activities in flight are kept in memory, so files of 1e8 events can be written.
+
+How to run:
+python benchmarks/generate_events.py events_1e6.jsonl --events 1000000 --seed 1
+"""
+
+# event window of data_collection.py, in utc
+WINDOW_START = int(datetime.datetime(2024, 10, 7, tzinfo=datetime.timezone.utc).timestamp())
+WINDOW_END = int(datetime.datetime(2024, 11, 3, tzinfo=datetime.timezone.utc).timestamp())
+
+# the countries of timezones.jsonl and the devices of database/init.sql
+COUNTRIES = ['US', 'JP', 'DE', 'IT', 'RS']
+DEVICES = ['iOS', 'Android', 'Web']
+
+# share of the events of each kind, and of the events refused by the loader
+EVENT_SHARES = {'registration': 0.01, 'session_ping': 0.9, 'match': 0.07}
+DIRTY_SHARES = {'duplicate': 0.005, 'out_of_window': 0.002, 'self_match': 0.001, 'unknown_country': 0.001}
+UNTERMINATED_MATCHES = 0.05
+
+MEAN_SESSION_PINGS = 15
+MAX_SESSION_PINGS = 240
+MATCH_SECONDS = (60, 1200)
+DUPLICATE_WINDOW = 1000
+
+# events per activity of each kind
+ACTIVITY_EVENTS = {'registration': 1, 'session_ping': MEAN_SESSION_PINGS, 'match': 2 - UNTERMINATED_MATCHES,
+                   'duplicate': 1, 'out_of_window': 1, 'self_match': 2, 'unknown_country': 1}
+
+
+class EventWriter():
+    # numbers the events in the order they are written, and keeps the last lines for the duplicates
+    def __init__(self, output):
+        self.output = output
+        self.event_id = 0
+        self.recent_lines = collections.deque(maxlen=DUPLICATE_WINDOW)
+        self.counts = collections.Counter()
+
+    def write(self, kind, event_type, timestamp, event_data):
+        line = json.dumps({'event_id': self.event_id, 'event_type': event_type, 'event_timestamp': timestamp,
+                           'event_data': event_data}) + "\n"
+        self.event_id += 1
+        self.output.write(line)
+        self.recent_lines.append(line)
+        self.counts[kind] += 1
+
+    def write_duplicate(self, rng):
+        if self.recent_lines:
+            self.output.write(self.recent_lines[rng.randrange(len(self.recent_lines))])
+            self.counts['duplicate'] += 1
+
+
+def generate_events(output, events, seed=1, clean=False):
+    rng = random.Random(seed)
+    writer = EventWriter(output)
+    shares = dict(EVENT_SHARES, **({} if clean else DIRTY_SHARES))
+    # activities start at random moments of the window, as many as needed for the requested number of events
+    activity_weights = {kind: share / ACTIVITY_EVENTS[kind] for kind, share in shares.items()}
+    activity_kinds = list(activity_weights)
+    mean_events = sum(shares.values()) / sum(activity_weights.values())
+    last_start = WINDOW_END - MAX_SESSION_PINGS * 60 - MATCH_SECONDS[1]
+    rate = events / mean_events / (last_start - WINDOW_START)
+
+    registered = []
+    in_session = set()
+    # events waiting for their moment: (moment, sequence, kind, data). the data of a session is the user, the number
+    # of the next ping and the number of pings, of other events the type, timestamp and data of the event
+    pending = []
+    sequence = 0
+
+    def schedule(timestamp, kind, data):
+        nonlocal sequence
+        heapq.heappush(pending, (timestamp, sequence, kind, data))
+        sequence += 1
+
+    def new_user_name():
+        return str(uuid.UUID(int=rng.getrandbits(128)))
+
+    def write_pending(until):
+        while pending and pending[0][0] <= until:
+            moment, _, kind, data = heapq.heappop(pending)
+            if kind == 'session_ping':
+                user_name, ping, pings = data
+                writer.write(kind, 'session_ping', moment,
+                             {'user_id': user_name, 'type': "session_start" if ping == 0 else ""})
+                if ping + 1 < pings:
+                    schedule(moment + 60, kind, (user_name, ping + 1, pings))
+                else:
+                    in_session.discard(user_name)
+            elif kind == 'duplicate':
+                writer.write_duplicate(rng)
+            else:
+                writer.write(kind, *data)
+
+    moment = float(WINDOW_START)
+    while True:
+        moment += rng.expovariate(rate)
+        if moment > last_start:
+            break
+        timestamp = int(moment)
+        write_pending(timestamp)
+        kind = rng.choices(activity_kinds, weights=[activity_weights[kind] for kind in activity_kinds])[0]
+        # sessions and matches need registered users
+        if kind in ('session_ping', 'match', 'self_match') and len(registered) < 2:
+            kind = 'registration'
+        if kind == 'registration':
+            user_name = new_user_name()
+            registered.append(user_name)
+            schedule(timestamp, kind, ('registration', timestamp,
+                                       {'country': rng.choice(COUNTRIES), 'user_id': user_name,
+                                        'device_os': rng.choice(DEVICES)}))
+        elif kind == 'unknown_country':
+            schedule(timestamp, kind, ('registration', timestamp,
+                                       {'country': 'XX', 'user_id': new_user_name(),
+                                        'device_os': rng.choice(DEVICES)}))
+        elif kind == 'out_of_window':
+            # the line is among the lines of its moment, but its timestamp is up to 30 days out of the window
+            outside = rng.choice([WINDOW_START - rng.randint(1, 30 * 86400), WINDOW_END + rng.randint(1, 30 * 86400)])
+            schedule(timestamp, kind, ('registration', outside,
+                                       {'country': rng.choice(COUNTRIES), 'user_id': new_user_name(),
+                                        'device_os': rng.choice(DEVICES)}))
+        elif kind == 'duplicate':
+            schedule(timestamp, kind, None)
+        elif kind == 'session_ping':
+            user_name = rng.choice(registered)
+            # a user has one session at a time
+            if user_name in in_session:
+                continue
+            in_session.add(user_name)
+            pings = min(1 + int(rng.expovariate(1 / (MEAN_SESSION_PINGS - 1))), MAX_SESSION_PINGS)
+            schedule(timestamp, kind, (user_name, 0, pings))
+        else:
+            home_user_name, away_user_name = rng.sample(registered, 2)
+            if kind == 'self_match':
+                away_user_name = home_user_name
+            match_id = new_user_name()
+            match_data = {'match_id': match_id, 'home_user_id': home_user_name, 'away_user_id': away_user_name,
+                          'home_goals_scored': None, 'away_goals_scored': None}
+            schedule(timestamp, kind, ('match', timestamp, match_data))
+            if kind == 'self_match' or rng.random() >= UNTERMINATED_MATCHES:
+                end_timestamp = timestamp + rng.randint(*MATCH_SECONDS)
+                schedule(end_timestamp, kind, ('match', end_timestamp,
+                                               dict(match_data, home_goals_scored=rng.randint(0, 5),
+                                                    away_goals_scored=rng.randint(0, 5))))
+            else:
+                writer.counts['unterminated_match'] += 1
+    write_pending(float('inf'))
+    return writer.counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic events file.')
+    parser.add_argument('output', help='file to write the events to')
+    parser.add_argument('--events', type=int, default=100000, help='approximate number of events')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the random generator')
+    parser.add_argument('--clean', action='store_true', help='leave out the events the loader refuses')
+    arguments = parser.parse_args()
+
+    with open(arguments.output, 'w') as output:
+        counts = generate_events(output, arguments.events, arguments.seed, arguments.clean)
+    print(f"{sum(counts.values()) - counts['unterminated_match']} events written to {arguments.output}")
+    for kind, count in sorted(counts.items()):
+        print(f"{kind}: {count}")
@@ -0,0 +1,185 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+"""
+Measures how fast data_collection.py inserts an events file: events per second, round trips to the database per
+event and peak memory of the loader, for the row by row insertion, the bulk insertion and the parallel insertion.
+
+Every run loads the file into a new database BENCHMARK_DATABASE (events_benchmark by default) created with
+database/init.sql on the server given by the usual DATABASE_HOST, DATABASE_PORT, DATABASE_USER and
+DATABASE_PASSWORD environment variables. The loader runs in its own process, so its peak memory is its own.
+Round trips are the statements and transaction ends sent by the loader process. The statements of the worker
+processes of the parallel insertion are not counted, their peak memory is reported separately.
+
+How to run:
+python benchmarks/ingest_benchmark.py --events 1000000 --modes row bulk workers --output ingest.json
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from generate_events import generate_events
+
+BENCHMARK_DATABASE = os.environ.get('BENCHMARK_DATABASE', 'events_benchmark')
+
+
+def connection_parameters(database):
+    return {'dbname': database,
+            'user': os.environ.get('DATABASE_USER', 'postgres'),
+            'password': os.environ.get('DATABASE_PASSWORD', 'postgres_password'),
+            'host': os.environ.get('DATABASE_HOST', 'localhost'),
+            'port': os.environ.get('DATABASE_PORT', '5432')}
+
+
+# a new database with the schema of database/init.sql
+def create_database(database):
+    server = psycopg2.connect(**connection_parameters('postgres'))
+    server.autocommit = True
+    with server.cursor() as server_cursor:
+        server_cursor.execute(f"DROP DATABASE IF EXISTS {database}")
+        server_cursor.execute(f"CREATE DATABASE {database}")
+    server.close()
+    schema = psycopg2.connect(**connection_parameters(database))
+    with schema.cursor() as schema_cursor, open(os.path.join(ROOT, 'database', 'init.sql')) as init_script:
+        schema_cursor.execute(init_script.read())
+    schema.commit()
+    schema.close()
+
+
+def drop_database(database):
+    server = psycopg2.connect(**connection_parameters('postgres'))
+    server.autocommit = True
+    with server.cursor() as server_cursor:
+        server_cursor.execute(f"DROP DATABASE IF EXISTS {database}")
+    server.close()
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    def execute(self, query, parameters=None):
+        self.connection.round_trips += 1
+        return super().execute(query, parameters)
+
+    def executemany(self, query, parameters):
+        self.connection.round_trips += len(parameters)
+        return super().executemany(query, parameters)
+
+    def copy_expert(self, sql, file, size=8192):
+        self.connection.round_trips += 1
+        return super().copy_expert(sql, file, size)
+
+
+class CountingConnection(psycopg2.extensions.connection):
+    # counts the statements of its cursors and the ends of transactions
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.round_trips = 0
+        self.cursor_factory = CountingCursor
+
+    def commit(self):
+        self.round_trips += 1
+        return super().commit()
+
+    def rollback(self):
+        self.round_trips += 1
+        return super().rollback()
+
+
+# runs in its own process, which can start the workers of the parallel insertion. inserts the events file into the
+# database and puts the measurements in the results queue
+def load_events(results, events_filename, database, mode, workers=1, quiet=True):
+    if quiet:
+        # the loader prints its progress and a summary
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+    os.environ['DATABASE_NAME'] = database
+    import data_collection
+    data_collection.conn.close()
+    data_collection.conn = psycopg2.connect(connection_factory=CountingConnection, **connection_parameters(database))
+
+    data_collection.insert_into_country(os.path.join(ROOT, 'timezones.jsonl'))
+    data_collection.conn.round_trips = 0
+    started = time.perf_counter()
+    if mode == 'bulk':
+        data_collection.bulk_insert_into_events(events_filename)
+    elif mode == 'workers':
+        data_collection.parallel_insert_into_events(events_filename, workers)
+    else:
+        data_collection.insert_into_events(events_filename)
+    insert_seconds = time.perf_counter() - started
+    round_trips = data_collection.conn.round_trips
+    started = time.perf_counter()
+    data_collection.refresh_rollups()
+    rollup_seconds = time.perf_counter() - started
+
+    with data_collection.conn.cursor() as count_cursor:
+        count_cursor.execute("SELECT (SELECT COUNT(*) FROM events.event), (SELECT COUNT(*) FROM users.user), "
+                             "(SELECT COUNT(*) FROM events.session), (SELECT COUNT(*) FROM events.match)")
+        rows = dict(zip(('events', 'users', 'sessions', 'matches'), count_cursor.fetchone()))
+    data_collection.conn.close()
+    # kilobytes on linux
+    results.put({'insert_seconds': insert_seconds, 'rollup_seconds': rollup_seconds, 'round_trips': round_trips,
+                 'peak_memory_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                 'worker_peak_memory_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+                 'rows': rows})
+
+
+def benchmark(events_filename, mode, workers=1, database=BENCHMARK_DATABASE, quiet=True):
+    with open(events_filename, 'rb') as events:
+        lines = sum(1 for _ in events)
+    create_database(database)
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    loader = context.Process(target=load_events, args=(results, events_filename, database, mode, workers, quiet))
+    loader.start()
+    result = results.get()
+    loader.join()
+    result.update({'mode': mode, 'workers': workers if mode == 'workers' else 1, 'lines': lines,
+                   'events_per_second': lines / result['insert_seconds'],
+                   'round_trips_per_event': result['round_trips'] / lines})
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the insertion of an events file.')
+    parser.add_argument('--file', help='events file to insert, generated if not given')
+    parser.add_argument('--events', type=int, default=100000, help='approximate number of events to generate')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the generated events')
+    parser.add_argument('--modes', nargs='+', choices=['row', 'bulk', 'workers'], default=['row', 'bulk'],
+                        help='insertions to benchmark')
+    parser.add_argument('--workers', type=int, default=4, help='number of processes of the parallel insertion')
+    parser.add_argument('--output', help='file to write the results to, as json')
+    parser.add_argument('--keep-database', action='store_true', help='keep the database of the last run')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the loader')
+    arguments = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        events_filename = arguments.file
+        if events_filename is None:
+            events_filename = os.path.join(directory, 'events.jsonl')
+            with open(events_filename, 'w') as output:
+                generate_events(output, arguments.events, arguments.seed)
+        results = []
+        for mode in arguments.modes:
+            result = benchmark(events_filename, mode, arguments.workers, quiet=not arguments.verbose)
+            results.append(result)
+            print(f"{mode:8} {result['lines']} lines in {result['insert_seconds']:.1f} s, "
+                  f"{result['events_per_second']:.0f} events/s, "
+                  f"{result['round_trips_per_event']:.3f} round trips/event, "
+                  f"peak memory {result['peak_memory_mb']:.0f} MB"
+                  + (f" (workers {result['worker_peak_memory_mb']:.0f} MB)" if mode == 'workers' else "")
+                  + f", rollups in {result['rollup_seconds']:.1f} s")
+    if not arguments.keep_database:
+        drop_database(BENCHMARK_DATABASE)
+    if arguments.output:
+        with open(arguments.output, 'w') as output:
+            json.dump({'events': arguments.file or arguments.events, 'seed': arguments.seed, 'results': results},
+                      output, indent=2)
@@ -2,6 +2,18 @@ import os
 class Configuration():
     DATABASE_HOST = 'localhost' if 'DATABASE_HOST' not in os.environ else os.environ['DATABASE_HOST']
     DATABASE_PORT = '5432' if 'DATABASE_PORT' not in os.environ else os.environ['DATABASE_PORT']
+    DATABASE_POOL_MIN = int(os.environ.get('DATABASE_POOL_MIN', '1'))
+    DATABASE_POOL_MAX = int(os.environ.get('DATABASE_POOL_MAX', '10'))
+    # seconds a request waits for a free connection
+    DATABASE_POOL_TIMEOUT = float(os.environ.get('DATABASE_POOL_TIMEOUT', '5'))
+    # users times dates accepted by /user_stats/batch, and rows read from the database at once while streaming
+    USER_STATS_BATCH_LIMIT = int(os.environ.get('USER_STATS_BATCH_LIMIT', '100000'))
+    USER_STATS_FETCH_SIZE = 1000
+    # responses kept by the api, and seconds between the checks whether data_collection.py loaded new data
+    RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', '10000'))
+    DATA_VERSION_CHECK_SECONDS = float(os.environ.get('DATA_VERSION_CHECK_SECONDS', '5'))
+    # upper bounds in seconds of the latency histograms of /metrics
+    METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
     HOST = 'localhost' if 'PRODUCTION' not in os.environ else '0.0.0.0'
 
     SQLALCHEMY_DATABASE_URI = f'postgresql+psycopg2://postgres:postgres_root_password@{DATABASE_HOST}:{DATABASE_PORT}/auth_db'
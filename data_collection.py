@@ -1,10 +1,18 @@
+import argparse
+import collections
+import contextlib
 import datetime
+import io
+import multiprocessing
 import os
-import sys
+import tempfile
 import time
+import zlib
 
 import psycopg2
+import psycopg2.extras
 import json
+from event_reader import loads, open_events, read_lines, event_lines, read_event_batches
 
 conn = psycopg2.connect(
     dbname=os.environ.get('DATABASE_NAME', default='events_db'),
@@ -14,6 +22,328 @@ conn = psycopg2.connect(
     port=os.environ.get('DATABASE_PORT', default='5432')
 )
 
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', default=100000))
+
+
+class UserCache():
+    # user_name -> user_id of the most recently used users. the least recently used user is evicted when full.
+    def __init__(self, size):
+        self.size = size
+        self.user_ids = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # in parallel loading all registrations are inserted before the other events. a user registered later in the
+        # file than the line being inserted is treated as not registered yet.
+        self.registration_lines = {}
+        self.line_no = 0
+
+    def get(self, opened_cursor, user_name):
+        if self.registration_lines.get(user_name, 0) > self.line_no:
+            return None
+        user_id = self.user_ids.get(user_name)
+        if user_id is not None:
+            self.hits += 1
+            self.user_ids.move_to_end(user_name)
+            return user_id
+        self.misses += 1
+        opened_cursor.execute("SELECT user_id FROM users.user WHERE user_name = %s", (user_name,))
+        user_data = opened_cursor.fetchone()
+        if user_data is None:
+            return None
+        self.put(user_name, user_data[0])
+        return user_data[0]
+
+    def put(self, user_name, user_id):
+        self.user_ids[user_name] = user_id
+        self.user_ids.move_to_end(user_name)
+        if len(self.user_ids) > self.size:
+            self.user_ids.popitem(last=False)
+            self.evictions += 1
+
+    def statistics(self):
+        return (f"User cache: {self.hits} hits, {self.misses} misses, {self.evictions} evictions, "
+                f"{len(self.user_ids)}/{self.size} users")
+
+
+user_cache = UserCache(USER_CACHE_SIZE)
+
+
+# refused events. every refusal is counted, and written to the rejection file if there is one, in blocks of
+# REJECTION_BLOCK_ROWS json lines instead of a line on the console per event.
+REJECTION_BLOCK_ROWS = int(os.environ.get('REJECTION_BLOCK_ROWS', default=10000))
+
+# the refusals of the event itself have a name, the refusals of the strategy functions the event type and the code
+# they returned. the bulk insertion uses the same names and codes.
+rejection_reasons = {
+    'malformed': "line is not valid json, or one of the required keys is missing or of the wrong type",
+    'out_of_window': "event timestamp is outside of the event window",
+    'unknown_type': "event type does not exist",
+    'duplicate': "event id is a duplicate",
+    'registration 1': "values missing from event data",
+    'registration 2': "user is already registered",
+    'registration 3': "device or country does not exist",
+    'session_ping 1': "user_id missing from event data",
+    'session_ping 2': "user is not registered",
+    'session_ping 3': "event id is a duplicate of a ping of the session, or of an event",
+    'session_ping 4': "ping is earlier than the last ping of the session of the user",
+    'match 1': "values missing from event data",
+    'match 2': "match of the user against himself",
+    'match 3': "either no goals or both goals should be set",
+    'match 4': "match end without match start",
+    'match 5': "match already over",
+    'match 6': "users in match end differ from users in match start",
+    'match 7': "end time is before start time",
+    'match 9': "users not registered, or duplicate match start",
+}
+
+
+class RejectionLog():
+    def __init__(self, block_rows):
+        self.block_rows = block_rows
+        self.filename = None
+        self.rows = []
+        self.counts = collections.Counter()
+
+    # code is the code returned by a strategy function, rejection the name of a refusal of the event itself
+    def refuse(self, event_id, event_type, code=None, rejection=None):
+        self.counts[rejection if rejection is not None else f"{event_type} {code}"] += 1
+        if self.filename is not None:
+            self.write(event_id, event_type, code, rejection)
+
+    def write(self, event_id, event_type, code, rejection):
+        reason = rejection_reasons.get(rejection if rejection is not None else f"{event_type} {code}")
+        self.rows.append(json.dumps({'event_id': event_id, 'event_type': event_type, 'code': code,
+                                     'rejection': rejection, 'reason': reason}))
+        if len(self.rows) >= self.block_rows:
+            self.flush()
+
+    # the workers of the parallel insertion append to the same file. a single write to a file opened for appending
+    # is not interleaved with the writes of the other processes.
+    def flush(self):
+        if self.rows:
+            rejections = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(rejections, ('\n'.join(self.rows) + '\n').encode())
+            finally:
+                os.close(rejections)
+            self.rows.clear()
+
+
+rejection_log = RejectionLog(REJECTION_BLOCK_ROWS)
+
+
+class StageTimer():
+    # wall time of the stages of the load, in the order they first ran, and the number of lines read
+    def __init__(self):
+        self.seconds = {}
+        self.lines = 0
+
+    # adds the time since started to the stage and returns the current time, the start of the next stage
+    def add(self, stage, started):
+        now = time.perf_counter()
+        self.seconds[stage] = self.seconds.get(stage, 0) + now - started
+        return now
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, started)
+
+
+stage_timer = StageTimer()
+
+# the small tables are read once, before the events are inserted
+device_ids = {}
+country_ids = set()
+type_ids = {}
+
+
+def load_lookups():
+    with conn.cursor() as lookup_cursor:
+        lookup_cursor.execute("SELECT device_os, device_id FROM device.device")
+        device_ids.clear()
+        device_ids.update(lookup_cursor.fetchall())
+        lookup_cursor.execute("SELECT country_id FROM country.country")
+        country_ids.clear()
+        country_ids.update(row[0] for row in lookup_cursor.fetchall())
+        lookup_cursor.execute("SELECT LOWER(type_name), type_id FROM events.type")
+        type_ids.clear()
+        type_ids.update(lookup_cursor.fetchall())
+    conn.rollback()
+
+
+# sessions and matches are partitioned by the utc day they end on. the partitions of the days of the event window are
+# created before the events are inserted, in a transaction of their own, since creating a partition locks the
+# partitioned table until the end of the transaction.
+partitioned_tables = ("events.session", "events.match")
+
+
+def partition_name(table, day):
+    return f"{table}_{day:%Y%m%d}"
+
+
+# the partitions of every table by day
+def existing_partitions(opened_cursor):
+    opened_cursor.execute("SELECT i.inhparent::REGCLASS::TEXT, i.inhrelid::REGCLASS::TEXT FROM pg_inherits i "
+                          "WHERE i.inhparent = ANY(%s::REGCLASS[])", (list(partitioned_tables),))
+    partitions = collections.defaultdict(dict)
+    for table, partition in opened_cursor.fetchall():
+        partitions[table][datetime.datetime.strptime(partition[-8:], '%Y%m%d').date()] = partition
+    return partitions
+
+
+def create_partitions(unix_date_start, unix_date_end):
+    first_day = datetime.datetime.fromtimestamp(unix_date_start, datetime.timezone.utc).date()
+    last_day = datetime.datetime.fromtimestamp(unix_date_end, datetime.timezone.utc).date()
+    created = 0
+    with conn.cursor() as partition_cursor:
+        partitions = existing_partitions(partition_cursor)
+        for table in partitioned_tables:
+            day = first_day
+            while day <= last_day:
+                if day not in partitions[table]:
+                    start = datetime.datetime.combine(day, datetime.time(), datetime.timezone.utc)
+                    partition_cursor.execute(f"CREATE TABLE {partition_name(table, day)} PARTITION OF {table} "
+                                             "FOR VALUES FROM (%s) TO (%s)",
+                                             (start, start + datetime.timedelta(days=1)))
+                    created += 1
+                day += datetime.timedelta(days=1)
+    conn.commit()
+    if created:
+        print(f"Created {created} partitions from {first_day} to {last_day}")
+
+
+# the sessions and matches of the days before the given day are dropped with their partitions, instead of deleted row
+# by row. their events are kept, so that the event ids are still refused as duplicates. the rollups of these days
+# are kept as well, but a later rebuild of the rollups only covers the days still in the database.
+# the rollups of a day read the sessions and matches from the partition of the day before on, for the local days, so
+# the days up to before_day can no longer be computed and are frozen
+def drop_partitions(before_day):
+    dropped = 0
+    with conn.cursor() as partition_cursor:
+        for table, partitions in existing_partitions(partition_cursor).items():
+            for day, partition in partitions.items():
+                if day < before_day:
+                    partition_cursor.execute(f"DROP TABLE {partition}")
+                    dropped += 1
+        partition_cursor.execute("INSERT INTO stats.frozen_days(before_day) VALUES (%(before_day)s::DATE + 1) "
+                                 "ON CONFLICT(frozen_id) DO UPDATE "
+                                 "SET before_day = GREATEST(stats.frozen_days.before_day, EXCLUDED.before_day)",
+                                 {'before_day': before_day})
+    conn.commit()
+    print(f"Dropped {dropped} partitions before {before_day}")
+
+
+MATCH_BATCH_SIZE = 1000
+
+
+class OpenMatch():
+    __slots__ = ('home_user_name', 'away_user_name', 'home_user_id', 'away_user_id', 'start_event_id',
+                 'start_timestamp')
+
+    def __init__(self, home_user_name, away_user_name, home_user_id, away_user_id, event_id, event_timestamp):
+        self.home_user_name = home_user_name
+        self.away_user_name = away_user_name
+        self.home_user_id = home_user_id
+        self.away_user_id = away_user_id
+        self.start_event_id = event_id
+        self.start_timestamp = event_timestamp
+
+
+# timezone of the registration country of a user. the local day buckets of sessions and matches are taken in it
+user_timezone = ("COALESCE((SELECT c.timezone FROM events.registration r JOIN country.country c "
+                 "ON c.country_id = r.country_code WHERE r.user_id = {user_id}), 'UTC')")
+
+
+class MatchIndex():
+    # matches that started but did not end yet, by match_id. ended matches wait in pending_matches until they are
+    # written to events.match in a batch.
+    def __init__(self):
+        self.open_matches = {}
+        self.pending_matches = {}
+
+    def start(self, opened_cursor, match_id, home_user_name, away_user_name, event_id, event_timestamp):
+        if match_id is None or match_id in self.open_matches or match_id in self.pending_matches:
+            return 9
+        home_user_id = user_cache.get(opened_cursor, home_user_name)
+        away_user_id = user_cache.get(opened_cursor, away_user_name)
+        if home_user_id is None or away_user_id is None:
+            return 9
+        opened_cursor.execute("SELECT 1 FROM events.match WHERE match_id = %s", (match_id,))
+        if opened_cursor.fetchone():
+            return 9
+        self.open_matches[match_id] = OpenMatch(home_user_name, away_user_name, home_user_id, away_user_id,
+                                                event_id, event_timestamp)
+        return 0
+
+    def end(self, opened_cursor, match_id, home_user_name, away_user_name, event_id, event_timestamp,
+            home_goals_scored, away_goals_scored):
+        started_match = self.open_matches.get(match_id)
+        if started_match is None:
+            if match_id in self.pending_matches:
+                return 5
+            # all matches in the database have ended
+            opened_cursor.execute("SELECT 1 FROM events.match WHERE match_id = %s", (match_id,))
+            return 5 if opened_cursor.fetchone() else 4
+        if started_match.home_user_name != home_user_name or started_match.away_user_name != away_user_name:
+            return 6
+        if event_timestamp < started_match.start_timestamp:
+            return 7
+        del self.open_matches[match_id]
+        self.pending_matches[match_id] = (match_id, started_match.start_event_id, event_id,
+                                          started_match.home_user_id, started_match.away_user_id,
+                                          home_goals_scored, away_goals_scored,
+                                          started_match.start_timestamp, event_timestamp)
+        if len(self.pending_matches) >= MATCH_BATCH_SIZE:
+            self.flush(opened_cursor)
+        return 0
+
+    def flush(self, opened_cursor):
+        if self.pending_matches:
+            psycopg2.extras.execute_values(opened_cursor,
+                                           "INSERT INTO events.match(match_id, event_id_start, event_id_end, "
+                                           "home_user_id, away_user_id, home_goals_scored, away_goals_scored, "
+                                           "start_ts, end_ts, home_timezone, away_timezone) "
+                                           "SELECT m.match_id, m.event_id_start, m.event_id_end, m.home_user_id, "
+                                           "m.away_user_id, m.home_goals_scored, m.away_goals_scored, "
+                                           "to_timestamp(m.start_ts), to_timestamp(m.end_ts), "
+                                           + user_timezone.format(user_id="m.home_user_id") + ", "
+                                           + user_timezone.format(user_id="m.away_user_id") + " "
+                                           "FROM (VALUES %s) m(match_id, event_id_start, event_id_end, "
+                                           "home_user_id, away_user_id, home_goals_scored, away_goals_scored, "
+                                           "start_ts, end_ts)", list(self.pending_matches.values()),
+                                           template="(%s, %s::BIGINT, %s::BIGINT, %s::BIGINT, %s::BIGINT, "
+                                                    "%s::INT, %s::INT, %s::DOUBLE PRECISION, "
+                                                    "%s::DOUBLE PRECISION)")
+            self.pending_matches.clear()
+
+    # pending matches must be flushed before the state is saved
+    def state(self):
+        return [[match_id, started_match.home_user_name, started_match.away_user_name, started_match.home_user_id,
+                 started_match.away_user_id, started_match.start_event_id, started_match.start_timestamp]
+                for match_id, started_match in self.open_matches.items()]
+
+    def restore(self, state):
+        self.open_matches.clear()
+        self.pending_matches.clear()
+        for match_id, *started_match in state:
+            self.open_matches[match_id] = OpenMatch(*started_match)
+
+    # matches that never ended are not written, only their start events need to be removed
+    def discard_open(self, opened_cursor):
+        if self.open_matches:
+            opened_cursor.execute("DELETE FROM events.event WHERE event_id = ANY(%s)",
+                                  ([started_match.start_event_id for started_match in self.open_matches.values()],))
+            self.open_matches.clear()
+
+
+match_index = MatchIndex()
+
+
 def match(opened_cursor, event_data, event_id, event_timestamp):
     # missing values check
     if ('match_id' not in event_data
@@ -21,74 +351,25 @@ def match(opened_cursor, event_data, event_id, event_timestamp):
             or 'away_user_id' not in event_data
             or 'home_goals_scored' not in event_data
             or 'away_goals_scored' not in event_data):
-        print(f"Values missing from event data upon attempt to insert match {event_id}")
         return 1
     # users must be different
     if event_data['home_user_id'] == event_data['away_user_id']:
-        print(f"Match of the user against himself {event_id}")
         return 2
     # either no goals are set or both goals are set
     if event_data['home_goals_scored'] is not None or event_data['away_goals_scored'] is not None:
         if event_data['home_goals_scored'] is None or event_data['away_goals_scored'] is None:
-            print(f"Either no goals should be set or both goals should be set {event_id}")
             return 3
-        # update the existing match
-        opened_cursor.execute("SELECT home.user_name, away.user_name, e.event_timestamp::TIMESTAMP, m.event_id_end "
-                              "FROM events.match m  JOIN users.user home ON m.home_user_id = home.user_id "
-                              "JOIN users.user away ON m.away_user_id = away.user_id "
-                              "JOIN events.event e ON e.event_id = m.event_id_start "
-                              "WHERE m.match_id = %s", (event_data['match_id'],))
-        match_data = opened_cursor.fetchone()
-        # match end without start
-        if not match_data:
-            print(f"Match end without match start. Event id:{event_id}, Match id:{event_data['match_id']}")
-            return 4
-        match_start_home_user = match_data[0]
-        match_start_away_user = match_data[1]
-        match_start_timestamp = match_data[2]
-        match_start_end_event_id = match_data[3]
-
-        #match already ended.
-        if match_start_end_event_id is not None:
-            print(f"Match already over. {event_id} is therefore invalid for match id:{event_data['match_id']}")
-            return 5
-        #different users in the same match. Error. Right now, the policy is to refuse the row. May change if required.
-        if match_start_home_user != event_data['home_user_id'] or match_start_away_user != event_data['away_user_id']:
-            print(f"Users in match end differ from users in match start. "
-                  f"Event id:{event_id}, Match id:{event_data['match_id']} refused.")
-            return 6
-        #end before start. Mistake.
-        if datetime.datetime.fromtimestamp(event_timestamp) < match_start_timestamp:
-            print(f"End time is before start time. Event id:{event_id}, Match id:{event_data['match_id']}")
-            return 7
-        # the match has started, and this is its ending
-        opened_cursor.execute("UPDATE events.match "
-                              "SET event_id_end=%s, home_goals_scored=%s, away_goals_scored=%s "
-                              "WHERE match_id=%s "
-                              "RETURNING * ",
-                              (event_id, event_data['home_goals_scored'],
-                               event_data['away_goals_scored'], event_data['match_id']))
-        if not opened_cursor.fetchone():
-            print(f"Fatal error for event_id {event_id}. Match_id:{event_data['match_id']}.")
-            return 8
-        return 0
-
-    opened_cursor.execute(
-        "INSERT INTO events.match(event_id_start, match_id, home_user_id, away_user_id)"
-        "SELECT event_id, match_id, home_user, away_user "
-        "FROM ("
-        "SELECT %s as event_id, %s as match_id, "
-        "(SELECT(user_id) FROM users.user WHERE user_name=%s) as home_user, "
-        "(SELECT(user_id) FROM users.user WHERE user_name=%s) as away_user ) "
-        "WHERE home_user IS NOT NULL AND away_user IS NOT NULL AND match_id IS NOT NULL "
-        "ON CONFLICT(match_id) DO NOTHING "
-        "RETURNING *", (event_id, event_data['match_id'], event_data['home_user_id'], event_data['away_user_id']))
+        # end the started match
+        # 4: match end without start, 5: match already ended, 6: different users in the same match, the policy is
+        # to refuse the row, 7: end before start
+        return match_index.end(opened_cursor, event_data['match_id'], event_data['home_user_id'],
+                               event_data['away_user_id'], event_id, event_timestamp,
+                               event_data['home_goals_scored'], event_data['away_goals_scored'])
 
     #this is not the first insertion, although it should be.
-    if not opened_cursor.fetchone():
-        print(f"The data may have non-existent home_user, "
-              f"away_user, match_id, or be the duplicate match_id insertion attempt. "
-              f"Event {event_id} match {event_data['match_id']}")
+    if match_index.start(opened_cursor, event_data['match_id'], event_data['home_user_id'],
+                         event_data['away_user_id'], event_id, event_timestamp) != 0:
+        # non-existent home_user, away_user, match_id, or duplicate match_id insertion attempt
         return 9
     return 0
 
@@ -155,32 +436,28 @@ def match(opened_cursor, event_data, event_id, event_timestamp):
 
 def registration(opened_cursor, event_data, event_id, event_timestamp):
     # refuse incomplete data
-    if 'user_id' not in event_data or 'country' not in event_data or 'device_os' not in event_data:
-        print(f"Values missing from event data upon attempt to insert registration {event_id}")
+    if ('user_id' not in event_data or 'country' not in event_data or 'device_os' not in event_data
+            or event_data['user_id'] is None):
         return 1
     # attempt adding new user with this registration
-    opened_cursor.execute("INSERT INTO users.user(user_name) VALUES (%s) ON CONFLICT(user_name) DO NOTHING RETURNING *",
-                          (event_data['user_id'],))
+    opened_cursor.execute("INSERT INTO users.user(user_name) VALUES (%s) ON CONFLICT(user_name) DO NOTHING "
+                          "RETURNING user_id", (event_data['user_id'],))
+    user_data = opened_cursor.fetchone()
     # if insertion failed, rollback the entire insertion
-    if not opened_cursor.fetchone():
-        print(f"User {event_data['user_id']} is already registered. Event {event_id}")
+    if not user_data:
         return 2
+    # a device or country that is not a string, null included, does not exist either
+    device_os, country = event_data['device_os'], event_data['country']
+    device_id = device_ids.get(device_os.lower()) if isinstance(device_os, str) else None
+    country_id = country.upper() if isinstance(country, str) else None
+    if device_id is None or country_id not in country_ids:
+        opened_cursor.execute("DELETE FROM users.user WHERE user_id = %s", (user_data[0],))
+        return 3
     # insert into registration.
     opened_cursor.execute("INSERT INTO events.registration(event_id, user_id, device_id, country_code) "
-                          "SELECT %s , user_id, device_id, country_id "
-                          "FROM (SELECT "
-                          "(SELECT user_id FROM users.user WHERE user_name = %s) as user_id, "
-                          "(SELECT device_id FROM device.device WHERE device_os = LOWER(%s)) as device_id, "
-                          "(SELECT country_id FROM country.country WHERE country_id = UPPER(%s)) as country_id)"
-                          "WHERE user_id IS NOT NULL AND device_id IS NOT NULL AND country_id IS NOT NULL "
-                          "ON CONFLICT(event_id) DO NOTHING "
-                          "RETURNING *",
-                          (event_id, event_data['user_id'], event_data['device_os'], event_data['country']))
-    if opened_cursor.fetchone():
-        return 0
-    print(f"Registration failed for event {event_id}. Check that device {event_data['device_os']} "
-          f"and country {event_data['country']} exist. Conflict may have occurred.")
-    return 3
+                          "VALUES (%s, %s, %s, %s)", (event_id, user_data[0], device_id, country_id))
+    user_cache.put(event_data['user_id'], user_data[0])
+    return 0
 
 '''
 def session_ping(opened_cursor, event_data, event_id, event_timestamp):
@@ -200,120 +477,915 @@ def session_ping(opened_cursor, event_data, event_id, event_timestamp):
     return 2
 '''
 
+
+class OpenSession():
+    __slots__ = ('user_id', 'start_event_id', 'start_timestamp', 'last_event_id', 'last_timestamp')
+
+    def __init__(self, user_id, event_id, event_timestamp):
+        self.user_id = user_id
+        self.start_event_id = event_id
+        self.start_timestamp = event_timestamp
+        self.last_event_id = None
+        self.last_timestamp = event_timestamp
+
+    # a ping sent again falls on the pings of the session: at or before the last one, every 60 seconds from the start
+    def covers(self, event_timestamp):
+        return (self.start_timestamp <= event_timestamp <= self.last_timestamp
+                and (event_timestamp - self.start_timestamp) % 60 == 0)
+
+
+class SessionTracker():
+    # open sessions by user_name. the dictionary is kept in the order of the last ping of each session, so the
+    # sessions that can no longer continue are always at the front and memory is bounded by the active users.
+    # the event ids of the first and last ping of the open sessions are taken, as if they were already written.
+    def __init__(self):
+        self.open_sessions = collections.OrderedDict()
+        self.open_event_ids = set()
+
+    # returns 3 for a ping seen before: a ping of the open session of the user, an event already written or taken by
+    # an open session, or a ping inside a session of the user already written. returns 4 for a ping before the last
+    # ping of the open session, which can neither continue nor end it. neither changes the open session, so a ping
+    # sent again or late does not split it. returns 2 if the user is not registered.
+    def ping(self, opened_cursor, user_name, event_id, event_timestamp):
+        session = self.open_sessions.get(user_name)
+        if event_id in self.open_event_ids or (session is not None and session.covers(event_timestamp)):
+            return 3
+        if session is not None and session.last_timestamp + 60 == event_timestamp:
+            if session.last_event_id is not None:
+                self.open_event_ids.discard(session.last_event_id)
+            session.last_event_id = event_id
+            session.last_timestamp = event_timestamp
+            self.open_event_ids.add(event_id)
+            self.open_sessions.move_to_end(user_name)
+            return 0
+        user_id = session.user_id if session is not None else user_cache.get(opened_cursor, user_name)
+        opened_cursor.execute("SELECT EXISTS (SELECT 1 FROM events.event WHERE event_id = %s) "
+                              "OR EXISTS (SELECT 1 FROM events.session WHERE user_id = %s "
+                              "AND start_ts < to_timestamp(%s) AND end_ts > to_timestamp(%s))",
+                              (event_id, user_id, event_timestamp, event_timestamp))
+        if opened_cursor.fetchone()[0]:
+            return 3
+        if user_id is None:
+            return 2
+        if session is not None and event_timestamp < session.last_timestamp:
+            return 4
+        if session is not None:
+            self.close(opened_cursor, user_name)
+        self.open_sessions[user_name] = OpenSession(user_id, event_id, event_timestamp)
+        self.open_event_ids.add(event_id)
+        return 0
+
+    # close the sessions that cannot be continued by a ping at the given moment. returns the number of sessions closed
+    def close_expired(self, opened_cursor, event_timestamp):
+        closed = 0
+        while self.open_sessions:
+            user_name, session = next(iter(self.open_sessions.items()))
+            if session.last_timestamp + 60 >= event_timestamp:
+                break
+            self.close(opened_cursor, user_name)
+            closed += 1
+        return closed
+
+    def state(self):
+        return [[user_name, session.user_id, session.start_event_id, session.start_timestamp,
+                 session.last_event_id, session.last_timestamp]
+                for user_name, session in self.open_sessions.items()]
+
+    def restore(self, state):
+        self.open_sessions.clear()
+        self.open_event_ids.clear()
+        for user_name, user_id, start_event_id, start_timestamp, last_event_id, last_timestamp in state:
+            session = OpenSession(user_id, start_event_id, start_timestamp)
+            session.last_event_id = last_event_id
+            session.last_timestamp = last_timestamp
+            self.open_sessions[user_name] = session
+            self.open_event_ids.update(event_id for event_id in (start_event_id, last_event_id)
+                                       if event_id is not None)
+
+    def close_all(self, opened_cursor):
+        while self.open_sessions:
+            self.close(opened_cursor, next(iter(self.open_sessions)))
+
+    # write the first and the last ping of the session, and the session itself. a session with a single ping has no
+    # valid end and is not written at all.
+    def close(self, opened_cursor, user_name):
+        session = self.open_sessions.pop(user_name)
+        self.open_event_ids.discard(session.start_event_id)
+        if session.last_event_id is None:
+            return
+        self.open_event_ids.discard(session.last_event_id)
+        opened_cursor.execute("INSERT INTO events.event(event_id, event_timestamp, event_type_id) "
+                              "VALUES(%s, to_timestamp(%s), %s) "
+                              "ON CONFLICT(event_id) DO NOTHING RETURNING *",
+                              (session.start_event_id, session.start_timestamp, type_ids['session_ping']))
+        # a ping whose event id was written after the ping was seen is refused together with its session
+        if not opened_cursor.fetchone():
+            rejection_log.refuse(session.start_event_id, 'session_ping', code=3)
+            return
+        opened_cursor.execute("INSERT INTO events.event(event_id, event_timestamp, event_type_id) "
+                              "VALUES(%s, to_timestamp(%s), %s) "
+                              "ON CONFLICT(event_id) DO NOTHING RETURNING *",
+                              (session.last_event_id, session.last_timestamp, type_ids['session_ping']))
+        if not opened_cursor.fetchone():
+            rejection_log.refuse(session.last_event_id, 'session_ping', code=3)
+            opened_cursor.execute("DELETE FROM events.event WHERE event_id = %s", (session.start_event_id,))
+            return
+        opened_cursor.execute("INSERT INTO events.session(event_id_start, event_id_end, user_id, start_ts, end_ts, "
+                              "timezone) VALUES(%s, %s, %s, to_timestamp(%s), to_timestamp(%s), "
+                              + user_timezone.format(user_id="%s") + ")",
+                              (session.start_event_id, session.last_event_id, session.user_id,
+                               session.start_timestamp, session.last_timestamp, session.user_id))
+
+
+session_tracker = SessionTracker()
+
+
 def session_ping(opened_cursor, event_data, event_id, event_timestamp):
     #missing data
     if 'user_id' not in event_data:
-        print(f"Missing user_id in event_data for session_ping with event_id {event_id}")
         return 1
-    #check if belongs to started session
-    opened_cursor.execute("SELECT s.session_user_id "
-                          "FROM events.session s JOIN events.event e ON s.event_id = e.event_id "
-                          "JOIN users.user u ON u.user_id = s.user_id "
-                          "WHERE u.user_name = %s AND e.event_timestamp + INTERVAL '1 minute' = %s ",
-                          (event_data['user_id'], datetime.datetime
-                           .fromtimestamp(event_timestamp).astimezone(datetime.timezone.utc)))
-    session_data = opened_cursor.fetchone()
-    #if session_user_id is null, this is the start of new session. must insert new row
-    if session_data is None:
-        opened_cursor.execute("INSERT INTO events.session (event_id, user_id, session_user_id, is_start) "
-                              "SELECT %s, u.user_id, COALESCE(MAX(session_user_id)+1, 1), 1 "
-                              "FROM users.user u LEFT JOIN events.session s ON u.user_id = s.user_id "
-                              "WHERE u.user_name = %s "
-                              "GROUP BY u.user_id "
-                              "ON CONFLICT DO NOTHING "
-                              "RETURNING *", (event_id, event_data['user_id']))
-        if not opened_cursor.fetchone():
-            print(f"User {event_data['user_id']} is most likely mnot registered and therefore cannot have a session")
-            return 2
-        return 0
-    session_user_id = session_data[0]
-    opened_cursor.execute("SELECT u.user_id, ARRAY_AGG(e.event_id ORDER BY e.event_timestamp) "
-                          "FROM events.session s JOIN events.event e ON s.event_id = e.event_id "
-                          "JOIN users.user u ON u.user_id = s.user_id "
-                          "WHERE u.user_name = %s AND s.session_user_id = %s "
-                          "GROUP BY u.user_id ", (event_data['user_id'], session_user_id))
-    agg_data = opened_cursor.fetchone()
-    user_id = agg_data[0]
-    last_sessions = agg_data[1]
-    #print(last_sessions)
-    if len(last_sessions) > 1:
-        opened_cursor.execute("DELETE FROM events.event WHERE event.event_id = %s ", (last_sessions[-1],))
-
-    opened_cursor.execute("INSERT INTO events.session(event_id, user_id, session_user_id, is_start) "
-                          "VALUES(%s, %s, %s, 0) "
-                          "ON CONFLICT DO NOTHING RETURNING *", (event_id, user_id, session_user_id))
-    if not opened_cursor.fetchone():
-        print(f"Fatal error. Something went wrong with insertion. Check duplicate event_id {event_id}")
-        return 3
-    return 0
+    # the ping only changes the state of the tracker, rows are written once the session closes
+    return session_tracker.ping(opened_cursor, event_data['user_id'], event_id, event_timestamp)
+
 
 def empty_func(opened_cursor, event_data, event_id, event_timestamp):
     return 0
 
 
 event_data_functions = {"session_ping": session_ping, "registration": registration, "match": match, "none": empty_func}
+# these strategies insert the rows into events.event themselves
+events_written_by_strategy = {"session_ping"}
 
 
 def insert_into_country(filename):
-    with open(filename, 'r') as timezones, conn.cursor() as insert_timezones:
-        line = timezones.readline()
-        while line:
-            line = json.loads(line)
-            try:
-                insert_timezones.execute("INSERT INTO country.Country(country_id, timezone) "
-                                         "VALUES (%s, %s) ON CONFLICT (country_id) DO NOTHING RETURNING *",
-                                         (line.get('country').upper(), line.get('timezone')))
-                conn.commit()
-                print(insert_timezones.fetchall())
-            except Exception as e:
-                print(e)
-                conn.rollback()
-            line = timezones.readline()
+    with open_events(filename) as timezones, conn.cursor() as insert_timezones:
+        for lines in read_lines(timezones):
+            for line in lines:
+                if not line.strip():
+                    continue
+                line = loads(line)
+                try:
+                    insert_timezones.execute("INSERT INTO country.Country(country_id, timezone) "
+                                             "VALUES (%s, %s) ON CONFLICT (country_id) DO NOTHING",
+                                             (line.get('country').upper(), line.get('timezone')))
+                    conn.commit()
+                except Exception as e:
+                    print(e)
+                    conn.rollback()
 
 
-def insert_into_events(filename):
+def event_window():
     date_start = datetime.datetime(year=2024, month=10, day=7, hour=0, minute=0, second=0, microsecond=0)
     date_end = datetime.datetime(year=2024, month=11, day=3, hour=0, minute=0, second=0, microsecond=0)
 
-    unix_date_start = time.mktime(date_start.timetuple())
-    unix_date_end = time.mktime(date_end.timetuple())
-
-    with open(filename, 'r') as events, conn.cursor() as insert_events:
-        line = events.readline()
-        while line:
-            line = json.loads(line)
-            # refuse incomplete data
-            if 'event_id' not in line or 'event_data' not in line or 'event_timestamp' not in line or 'event_type' not in line:
-                continue
-            # database-independent check should be done before accessing the database
-            if not (unix_date_start <= line['event_timestamp'] <= unix_date_end):
-                line = events.readline()
-                continue
-            # clean everything that may have been added to the connection but not committed
-            conn.rollback()
-            # attempt to insert a new event. upon failure no rows shall be returned and the transaction will be rolled back
-            insert_events.execute("INSERT INTO events.Event(event_id, event_timestamp, event_type_id) "
-                                  "VALUES(%s, to_timestamp(%s), (SELECT type_id FROM events.Type WHERE UPPER(type_name)=%s))"
-                                  "ON CONFLICT(event_id) DO NOTHING RETURNING *",
-                                  (line.get('event_id'), line.get('event_timestamp'), line.get('event_type').upper()))
-            if insert_events.fetchone():
-                # use of Strategy design pattern to define multiple ways this insertion can go
-                # see dictionary event_data_functions, it contains necessary callable objects.
-                if event_data_functions[line.get('event_type', 'none').lower()](insert_events, line.get('event_data'),
-                                                                            line.get('event_id'), line.get('event_timestamp')) == 0:
-                    # only if complete insertion works, the transaction is committed.
-                    conn.commit()
-            # print(line)
+    return time.mktime(date_start.timetuple()), time.mktime(date_end.timetuple())
+
+
+# the events are committed together with a checkpoint every CHECKPOINT_LINES lines of the file
+CHECKPOINT_LINES = int(os.environ.get('CHECKPOINT_LINES', default=10000))
+
+
+# inserts one event that passed the database-independent checks. returns the result of the strategy function,
+# or None if the event itself could not be inserted. nothing is committed, the caller commits periodically.
+def insert_event(opened_cursor, line):
+    started = time.perf_counter()
+    # sessions that this event proves to be over are written
+    session_tracker.close_expired(opened_cursor, line['event_timestamp'])
+    started = stage_timer.add('strategy session_ping', started)
+    event_type = line['event_type'].lower()
+    if event_type not in type_ids:
+        rejection_log.refuse(line['event_id'], event_type, rejection='unknown_type')
+        return None
+    # event rows of session pings are written by the session tracker
+    if event_type in events_written_by_strategy:
+        result = event_data_functions[event_type](opened_cursor, line['event_data'],
+                                                  line['event_id'], line['event_timestamp'])
+        stage_timer.add('strategy ' + event_type, started)
+        if result != 0:
+            rejection_log.refuse(line['event_id'], event_type, code=result)
+        return result
+    # the first ping of the event id is still in an open session
+    if line['event_id'] in session_tracker.open_event_ids:
+        stage_timer.add('event insert', started)
+        rejection_log.refuse(line['event_id'], event_type, rejection='duplicate')
+        return None
+    # attempt to insert a new event. upon failure no rows shall be returned
+    opened_cursor.execute("INSERT INTO events.Event(event_id, event_timestamp, event_type_id) "
+                          "VALUES(%s, to_timestamp(%s), %s)"
+                          "ON CONFLICT(event_id) DO NOTHING RETURNING *",
+                          (line['event_id'], line['event_timestamp'], type_ids[event_type]))
+    if not opened_cursor.fetchone():
+        stage_timer.add('event insert', started)
+        rejection_log.refuse(line['event_id'], event_type, rejection='duplicate')
+        return None
+    started = stage_timer.add('event insert', started)
+    # use of Strategy design pattern to define multiple ways this insertion can go
+    # see dictionary event_data_functions, it contains necessary callable objects.
+    result = event_data_functions[event_type](opened_cursor, line['event_data'],
+                                              line['event_id'], line['event_timestamp'])
+    started = stage_timer.add('strategy ' + event_type, started)
+    # only if complete insertion works, the event is kept. strategy functions do not write anything else on failure.
+    if result != 0:
+        opened_cursor.execute("DELETE FROM events.event WHERE event_id = %s", (line['event_id'],))
+        stage_timer.add('event insert', started)
+        rejection_log.refuse(line['event_id'], event_type, code=result)
+    return result
+
+
+# the file is over, so are the sessions that are still open. matches that are still open will never end.
+# in incremental insertion they are carried over to the next file instead.
+def finish_events(opened_cursor, checkpoint_name=None, carry_over=False):
+    started = time.perf_counter()
+    match_index.flush(opened_cursor)
+    started = stage_timer.add('cleanup write ended matches', started)
+    if carry_over:
+        opened_cursor.execute("INSERT INTO events.carry_over(open_sessions, open_matches) VALUES (%s, %s) "
+                              "ON CONFLICT(carry_over_id) DO UPDATE SET open_sessions = EXCLUDED.open_sessions, "
+                              "open_matches = EXCLUDED.open_matches, saved_at = now()",
+                              (psycopg2.extras.Json(session_tracker.state()),
+                               psycopg2.extras.Json(match_index.state())))
+        started = stage_timer.add('cleanup carry over', started)
+    else:
+        session_tracker.close_all(opened_cursor)
+        started = stage_timer.add('cleanup close sessions', started)
+        match_index.discard_open(opened_cursor)
+        started = stage_timer.add('cleanup discard open matches', started)
+    if checkpoint_name is not None:
+        opened_cursor.execute("DELETE FROM events.load_checkpoint WHERE file_name = %s", (checkpoint_name,))
+    conn.commit()
+    rejection_log.flush()
+    stage_timer.add('commit', started)
+
+
+# the checkpoint is committed with the events before it, so the database and the state in memory always match.
+# without checkpoint_name, the events are committed without a checkpoint.
+def save_checkpoint(opened_cursor, checkpoint_name, byte_offset):
+    started = time.perf_counter()
+    match_index.flush(opened_cursor)
+    if checkpoint_name is not None:
+        opened_cursor.execute("INSERT INTO events.load_checkpoint(file_name, byte_offset, open_sessions, "
+                              "open_matches) VALUES (%s, %s, %s, %s) "
+                              "ON CONFLICT(file_name) DO UPDATE SET byte_offset = EXCLUDED.byte_offset, "
+                              "open_sessions = EXCLUDED.open_sessions, open_matches = EXCLUDED.open_matches, "
+                              "saved_at = now()",
+                              (checkpoint_name, byte_offset, psycopg2.extras.Json(session_tracker.state()),
+                               psycopg2.extras.Json(match_index.state())))
+    conn.commit()
+    rejection_log.flush()
+    stage_timer.add('checkpoint', started)
+
+
+# returns the offset in the file to continue from
+def restore_checkpoint(opened_cursor, checkpoint_name):
+    opened_cursor.execute("SELECT byte_offset, open_sessions, open_matches FROM events.load_checkpoint "
+                          "WHERE file_name = %s", (checkpoint_name,))
+    checkpoint = opened_cursor.fetchone()
+    conn.rollback()
+    if checkpoint is None:
+        print(f"No checkpoint for {checkpoint_name}, insertion starts from the beginning of the file")
+        return 0
+    session_tracker.restore(checkpoint[1])
+    match_index.restore(checkpoint[2])
+    print(f"Insertion continues from byte {checkpoint[0]} of {checkpoint_name}")
+    return checkpoint[0]
+
+
+# sessions and matches left open by the previous incremental insertion
+def restore_carry_over(opened_cursor):
+    opened_cursor.execute("SELECT open_sessions, open_matches FROM events.carry_over")
+    carry_over = opened_cursor.fetchone()
+    conn.rollback()
+    if carry_over is not None:
+        session_tracker.restore(carry_over[0])
+        match_index.restore(carry_over[1])
+        print(f"{len(carry_over[0])} sessions and {len(carry_over[1])} matches carried over from the previous file")
+
+
+# with sort, the events are inserted in the order of their timestamps instead of the order of the file. the offsets
+# of a sorted file are not positions in the file, so it cannot be resumed.
+def insert_into_events(filename, resume=False, incremental=False, sort=False):
+    unix_date_start, unix_date_end = event_window()
+    load_lookups()
+    create_partitions(unix_date_start, unix_date_end)
+    checkpoint_name = os.path.abspath(filename)
+
+    with conn.cursor() as insert_events:
+        offset = 0
+        # the checkpoint already contains what was carried over
+        if resume:
+            offset = restore_checkpoint(insert_events, checkpoint_name)
+        elif incremental:
+            restore_carry_over(insert_events)
+        # sessions and matches carried over are written in this load, starting from their first event
+        loaded_timestamps = [session[3] for session in session_tracker.state()]
+        loaded_timestamps += [started_match[6] for started_match in match_index.state()]
+        first_timestamp = min(loaded_timestamps, default=None)
+        last_timestamp = max(loaded_timestamps, default=None)
+        lines_since_checkpoint = 0
+        # the offset of the checkpoint is in the decompressed file, a compressed file is decompressed again up to it
+        started = time.perf_counter()
+        with event_lines(filename, sort, offset) as lines:
+            if sort:
+                started = stage_timer.add('sort runs', started)
+            # incomplete data and the database-independent checks are refused by the reader, before accessing the
+            # database
+            for batch in read_event_batches(lines, unix_date_start, unix_date_end, offset):
+                stage_timer.add('parse', started)
+                stage_timer.lines += len(batch)
+                for offset, _, event, refusal in batch:
+                    if refusal == 'malformed':
+                        rejection_log.refuse(None, None, rejection=refusal)
+                    elif refusal is not None:
+                        rejection_log.refuse(event['event_id'], event['event_type'].lower(), rejection=refusal)
+                    else:
+                        insert_event(insert_events, event)
+                        if first_timestamp is None or event['event_timestamp'] < first_timestamp:
+                            first_timestamp = event['event_timestamp']
+                        if last_timestamp is None or event['event_timestamp'] > last_timestamp:
+                            last_timestamp = event['event_timestamp']
+                    lines_since_checkpoint += 1
+                    if lines_since_checkpoint == CHECKPOINT_LINES:
+                        save_checkpoint(insert_events, None if sort else checkpoint_name, offset)
+                        lines_since_checkpoint = 0
+                started = time.perf_counter()
+        finish_events(insert_events, checkpoint_name, carry_over=incremental)
+    print(user_cache.statistics())
+    # range of the timestamps of the events inserted by this load, None if there were none
+    return first_timestamp, last_timestamp
+
+
+# parallel loading. events of different users are independent, except for matches. registrations are inserted in
+# the order of the file by this process, session pings are split by user between the worker processes, each with its
+# own connection, and matches are inserted by this process while the workers run. an event id belongs to the spool of
+# the first line that uses it, so that no two processes insert the same event id and wait on each other.
+def partition_of(user_name, workers):
+    return zlib.crc32(str(user_name).encode()) % workers
+
+
+# the lines in duplicate_lines use an event id that belongs to another spool. they are refused as the row by row
+# insertion refuses a duplicate.
+def insert_spooled_events(spool_filename, duplicate_lines=frozenset()):
+    with open(spool_filename, 'rb') as spool, conn.cursor() as insert_events:
+        for spooled_no, spooled_line in enumerate(spool, 1):
+            line_no, line = spooled_line.split(b'\t', 1)
+            line_no = int(line_no)
+            line = loads(line)
+            event_type = line['event_type'].lower()
+            if line_no in duplicate_lines:
+                if event_type == 'session_ping':
+                    rejection_log.refuse(line['event_id'], event_type, code=3)
+                else:
+                    rejection_log.refuse(line['event_id'], event_type, rejection='duplicate')
             else:
-                print(f"Event {line.get('event_id')} is not inserted. It is likely duplicate or of non-existent type {line.get('event_type')}")
-            line = events.readline()
+                user_cache.line_no = line_no
+                if insert_event(insert_events, line) == 0 and event_type == 'registration':
+                    user_cache.registration_lines[line['event_data']['user_id']] = line_no
+            if spooled_no % CHECKPOINT_LINES == 0:
+                conn.commit()
+                rejection_log.flush()
+        finish_events(insert_events)
 
-#data cleansing after data collection
-def delete_bad_matches():
-    with conn.cursor() as delete_cursor:
-        delete_cursor.execute("DELETE FROM events.event WHERE event_id IN (SELECT event_id_start FROM events.match WHERE event_id_end IS NULL)")
+
+# runs in a worker process, which has its own rejection log writing to the same file. the counts are summed up by
+# the main process.
+def insert_partition_into_events(spool_filename, registration_lines, duplicate_lines, rejection_filename):
+    load_lookups()
+    user_cache.registration_lines = registration_lines
+    rejection_log.filename = rejection_filename
+    insert_spooled_events(spool_filename, duplicate_lines)
+    conn.close()
+    return user_cache.statistics(), rejection_log.counts
+
+
+# the lines of each spool whose event id is used first by a line of another spool
+def spooled_duplicates(owner_filename):
+    duplicate_lines = collections.defaultdict(set)
+    with open(owner_filename, 'rb') as owners, conn.cursor() as owner_cursor:
+        owner_cursor.execute("TRUNCATE staging.event_owner")
+        owner_cursor.copy_expert("COPY staging.event_owner(line_no, event_id, spool) FROM STDIN", owners)
+        owner_cursor.execute("SELECT o.spool, o.line_no FROM staging.event_owner o "
+                             "JOIN (SELECT DISTINCT ON (event_id) event_id, spool FROM staging.event_owner "
+                             "ORDER BY event_id, line_no) f ON f.event_id = o.event_id "
+                             "WHERE o.spool <> f.spool")
+        for spool_name, line_no in owner_cursor:
+            duplicate_lines[spool_name].add(line_no)
+        owner_cursor.execute("TRUNCATE staging.event_owner")
+    conn.commit()
+    return duplicate_lines
+
+
+def parallel_insert_into_events(filename, workers, sort=False):
+    unix_date_start, unix_date_end = event_window()
+    load_lookups()
+    create_partitions(unix_date_start, unix_date_end)
+
+    with tempfile.TemporaryDirectory() as spool_directory:
+        ping_spool_names = [f"session_ping_{worker}" for worker in range(workers)]
+        spool_filenames = {spool_name: os.path.join(spool_directory, f"{spool_name}.jsonl")
+                           for spool_name in ping_spool_names + ['match', 'registration']}
+        spools = {spool_name: open(spool_filename, 'wb') for spool_name, spool_filename in spool_filenames.items()}
+        owner_filename = os.path.join(spool_directory, "event_owner.tsv")
+        owners = open(owner_filename, 'wb')
+
+        started = time.perf_counter()
+        with event_lines(filename, sort) as lines, conn.cursor() as insert_events:
+            if sort:
+                started = stage_timer.add('sort runs', started)
+            line_no = 0
+            # incomplete data and the database-independent checks are refused by the reader
+            for batch in read_event_batches(lines, unix_date_start, unix_date_end):
+                stage_timer.add('parse', started)
+                stage_timer.lines += len(batch)
+                for _, text, line, refusal in batch:
+                    line_no += 1
+                    if refusal == 'malformed':
+                        rejection_log.refuse(None, None, rejection=refusal)
+                        continue
+                    if refusal is not None:
+                        rejection_log.refuse(line['event_id'], line['event_type'].lower(), rejection=refusal)
+                        continue
+                    event_type = line['event_type'].lower()
+                    if event_type == 'session_ping':
+                        spool_name = ping_spool_names[partition_of(line['event_data'].get('user_id'), workers)]
+                    elif event_type in ('match', 'registration'):
+                        spool_name = event_type
+                    else:
+                        # refused as an unknown type
+                        insert_event(insert_events, line)
+                        continue
+                    spools[spool_name].write(b"%d\t%s\n" % (line_no, text.strip()))
+                    owners.write(b"%d\t%d\t%s\n" % (line_no, line['event_id'], spool_name.encode()))
+                started = time.perf_counter()
+            rejection_log.flush()
+
+        for spool in list(spools.values()) + [owners]:
+            spool.close()
+
+        with stage_timer.stage('duplicate event ids'):
+            duplicate_lines = spooled_duplicates(owner_filename)
+        # the registrations must be visible to the workers
+        insert_spooled_events(spool_filenames['registration'], duplicate_lines['registration'])
+
+        # every process can tell apart the users registered later in the file than the event it is inserting
+        registration_lines = user_cache.registration_lines
+        partition_registration_lines = [{} for _ in range(workers)]
+        for user_name, line_no in registration_lines.items():
+            partition_registration_lines[partition_of(user_name, workers)][user_name] = line_no
+
+        # the workers are timed as a whole. the stages of the matches inserted by this process meanwhile are also
+        # counted on their own
+        with stage_timer.stage('parallel session pings and matches'):
+            with multiprocessing.get_context('spawn').Pool(workers) as pool:
+                partitions = pool.starmap_async(insert_partition_into_events,
+                                                zip([spool_filenames[spool_name] for spool_name in ping_spool_names],
+                                                    partition_registration_lines,
+                                                    [duplicate_lines[spool_name] for spool_name in ping_spool_names],
+                                                    [rejection_log.filename] * workers))
+                insert_spooled_events(spool_filenames['match'], duplicate_lines['match'])
+                for worker, (statistics, rejection_counts) in enumerate(partitions.get()):
+                    print(f"Worker {worker}. {statistics}")
+                    rejection_log.counts.update(rejection_counts)
+    print(user_cache.statistics())
+
+
+# bulk loading. the file is copied to the unlogged staging tables and the same cleaning rules are applied with
+# set-based queries, so the whole file costs a handful of round trips instead of several per line.
+BULK_CHUNK_BYTES = 64 * 1024 * 1024
+
+bulk_staging_tables = ["staging.event_raw", "staging.event", "staging.registration", "staging.user",
+                       "staging.session", "staging.match", "staging.match_end"]
+
+# user is registered before the given line if it was registered in an earlier load, or earlier in this file
+registered_before = ("(EXISTS (SELECT 1 FROM users.user u WHERE u.user_name = {name}) "
+                     "OR EXISTS (SELECT 1 FROM staging.user su WHERE su.user_name = {name} AND su.line_no < {line}))")
+
+bulk_cleaning_steps = [
+    # event level checks. the json is parsed by the database, the lines that are not valid json or whose required
+    # keys are missing or of the wrong type are refused as malformed, as by the reader: event_id must be a number
+    # that fits a BIGINT, event_timestamp a number, event_type a string and event_data an object. OFFSET 0 keeps the
+    # subqueries from being merged into the query, which would parse every line once for each use of the document.
+    ("INSERT INTO staging.event(line_no, event_id, event_type, event_timestamp, event_data, rejection) "
+     "SELECT line_no, CASE WHEN valid THEN (doc->>'event_id')::BIGINT END, "
+     "CASE WHEN valid THEN LOWER(doc->>'event_type') END, "
+     "CASE WHEN valid THEN (doc->>'event_timestamp')::DOUBLE PRECISION END, "
+     "CASE WHEN valid THEN doc->'event_data' END, "
+     "CASE WHEN NOT valid THEN 'malformed' "
+     "WHEN NOT ((doc->>'event_timestamp')::DOUBLE PRECISION BETWEEN %(date_start)s AND %(date_end)s) "
+     "THEN 'out_of_window' "
+     "WHEN LOWER(doc->>'event_type') NOT IN (SELECT LOWER(type_name) FROM events.type) THEN 'unknown_type' END "
+     "FROM (SELECT line_no, doc, COALESCE(jsonb_typeof(doc) = 'object' "
+     "AND jsonb_typeof(doc->'event_id') = 'number' AND pg_input_is_valid(doc->>'event_id', 'bigint') "
+     "AND jsonb_typeof(doc->'event_timestamp') = 'number' AND jsonb_typeof(doc->'event_type') = 'string' "
+     "AND jsonb_typeof(doc->'event_data') = 'object', FALSE) AS valid "
+     "FROM (SELECT line_no, CASE WHEN pg_input_is_valid(raw, 'jsonb') THEN raw::JSONB END AS doc "
+     "FROM staging.event_raw OFFSET 0) parsed OFFSET 0) checked"),
+    "ANALYZE staging.event",
+    # checks of the strategy functions that do not depend on the rest of the data. same codes as the functions.
+    ("UPDATE staging.event SET code = CASE "
+     "WHEN event_type = 'registration' AND (NOT event_data ?& ARRAY['user_id', 'country', 'device_os'] "
+     "OR event_data->>'user_id' IS NULL) THEN 1 "
+     "WHEN event_type = 'session_ping' AND NOT event_data ? 'user_id' THEN 1 "
+     "WHEN event_type = 'match' AND NOT event_data ?& ARRAY['match_id', 'home_user_id', 'away_user_id', "
+     "'home_goals_scored', 'away_goals_scored'] THEN 1 "
+     "WHEN event_type = 'match' AND event_data->'home_user_id' = event_data->'away_user_id' THEN 2 "
+     "WHEN event_type = 'match' "
+     "AND (event_data->>'home_goals_scored' IS NULL) <> (event_data->>'away_goals_scored' IS NULL) THEN 3 END "
+     "WHERE rejection IS NULL"),
+    # duplicate event_id. the first value is considered to be correct, the others an error. a duplicate session ping
+    # is refused by the session tracker row by row, with code 3.
+    ("UPDATE staging.event s "
+     "SET rejection = CASE WHEN s.event_type = 'session_ping' THEN NULL ELSE 'duplicate' END, "
+     "code = CASE WHEN s.event_type = 'session_ping' THEN 3 END "
+     "FROM (SELECT line_no, ROW_NUMBER() OVER (PARTITION BY event_id ORDER BY line_no) AS occurrence "
+     "FROM staging.event WHERE rejection IS NULL AND code IS NULL) d "
+     "WHERE s.line_no = d.line_no "
+     "AND (d.occurrence > 1 OR EXISTS (SELECT 1 FROM events.event e WHERE e.event_id = s.event_id))"),
+    # row by row, a duplicate is refused before the strategy function gets to refuse it. session pings without a
+    # user are refused before the session tracker looks at them.
+    ("UPDATE staging.event s SET rejection = 'duplicate', code = NULL "
+     "WHERE s.rejection IS NULL AND s.code IS NOT NULL AND s.event_type <> 'session_ping' "
+     "AND (EXISTS (SELECT 1 FROM staging.event f WHERE f.event_id = s.event_id AND f.line_no < s.line_no "
+     "AND f.rejection IS NULL AND f.code IS NULL) "
+     "OR EXISTS (SELECT 1 FROM events.event e WHERE e.event_id = s.event_id))"),
+    # registration. attempt is the order of insertion attempts into users.user, which defines the user_id
+    ("WITH candidate AS ("
+     "SELECT s.line_no, s.event_data->>'user_id' AS user_name, ROW_NUMBER() OVER (ORDER BY s.line_no) AS attempt, "
+     "d.device_id, c.country_id, "
+     "EXISTS (SELECT 1 FROM users.user u WHERE u.user_name = s.event_data->>'user_id') AS registered "
+     "FROM staging.event s "
+     "LEFT JOIN device.device d ON d.device_os = LOWER(s.event_data->>'device_os') "
+     "LEFT JOIN country.country c ON c.country_id = UPPER(s.event_data->>'country') "
+     "WHERE s.event_type = 'registration' AND s.rejection IS NULL AND s.code IS NULL"
+     "), first_valid AS ("
+     "SELECT user_name, MIN(line_no) AS line_no FROM candidate "
+     "WHERE device_id IS NOT NULL AND country_id IS NOT NULL AND NOT registered GROUP BY user_name) "
+     "INSERT INTO staging.registration(line_no, user_name, attempt, device_id, country_id, code) "
+     "SELECT c.line_no, c.user_name, c.attempt, c.device_id, c.country_id, "
+     "CASE WHEN c.registered OR c.line_no > f.line_no THEN 2 "
+     "WHEN c.device_id IS NULL OR c.country_id IS NULL THEN 3 END "
+     "FROM candidate c LEFT JOIN first_valid f ON f.user_name = c.user_name"),
+    ("INSERT INTO staging.user(user_name, user_id, line_no) "
+     "SELECT r.user_name, q.next_id + r.attempt - 1, r.line_no "
+     "FROM staging.registration r, (SELECT COALESCE(pg_sequence_last_value("
+     "pg_get_serial_sequence('users.user', 'user_id')::REGCLASS), 0) + 1 AS next_id) q "
+     "WHERE r.code IS NULL"),
+    # every insertion attempt consumes a value of the sequence, as it would row by row
+    ("SELECT setval(pg_get_serial_sequence('users.user', 'user_id'), "
+     "COALESCE(pg_sequence_last_value(pg_get_serial_sequence('users.user', 'user_id')::REGCLASS), 0) + MAX(attempt)) "
+     "FROM staging.registration HAVING COUNT(*) > 0"),
+    ("UPDATE staging.event s SET code = r.code FROM staging.registration r "
+     "WHERE s.line_no = r.line_no AND r.code IS NOT NULL"),
+    # session pings inside a session of the user written by an earlier insertion were seen before, code 3. only
+    # pings before the end of the last written session can be.
+    ("UPDATE staging.event s SET code = 3 "
+     "WHERE s.event_type = 'session_ping' AND s.rejection IS NULL AND s.code IS NULL "
+     "AND s.event_timestamp < (SELECT EXTRACT(EPOCH FROM MAX(end_ts)) FROM events.session) "
+     "AND EXISTS (SELECT 1 FROM users.user u JOIN events.session es ON es.user_id = u.user_id "
+     "WHERE u.user_name = s.event_data->>'user_id' AND es.start_ts < to_timestamp(s.event_timestamp) "
+     "AND es.end_ts > to_timestamp(s.event_timestamp))"),
+    # session pings of users that are not registered at the time of the ping
+    ("UPDATE staging.event s SET code = 2 "
+     "WHERE s.event_type = 'session_ping' AND s.rejection IS NULL AND s.code IS NULL AND NOT "
+     + registered_before.format(name="s.event_data->>'user_id'", line="s.line_no")),
+    # a ping earlier than an earlier ping of the user can neither continue nor end the session, code 4
+    ("UPDATE staging.event s SET code = 4 "
+     "FROM (SELECT line_no, event_timestamp < MAX(event_timestamp) OVER (PARTITION BY event_data->>'user_id' "
+     "ORDER BY line_no ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING) AS late "
+     "FROM staging.event WHERE event_type = 'session_ping' AND rejection IS NULL AND code IS NULL) p "
+     "WHERE s.line_no = p.line_no AND p.late"),
+    # a ping continues the session of the user if it comes exactly 60 seconds after the previous one.
+    # only the first and the last ping of every session with at least two pings are kept.
+    ("WITH ping AS ("
+     "SELECT line_no, event_data->>'user_id' AS user_name, CASE WHEN "
+     "LAG(event_timestamp) OVER (PARTITION BY event_data->>'user_id' ORDER BY line_no) + 60 = event_timestamp "
+     "THEN 0 ELSE 1 END AS opens "
+     "FROM staging.event WHERE event_type = 'session_ping' AND rejection IS NULL AND code IS NULL"
+     "), numbered AS ("
+     "SELECT line_no, user_name, SUM(opens) OVER (PARTITION BY user_name ORDER BY line_no) AS session_no "
+     "FROM ping"
+     "), edges AS ("
+     "SELECT line_no, user_name, session_no, "
+     "MIN(line_no) OVER (PARTITION BY user_name, session_no) AS first_line, "
+     "MAX(line_no) OVER (PARTITION BY user_name, session_no) AS last_line "
+     "FROM numbered) "
+     "INSERT INTO staging.session(line_no, user_name, session_no, is_start) "
+     "SELECT line_no, user_name, session_no, CASE WHEN line_no = first_line THEN 1 ELSE 0 END "
+     "FROM edges WHERE first_line <> last_line AND (line_no = first_line OR line_no = last_line)"),
+    # match start. the first start of the match with registered users is correct, others are refused with code 9
+    ("INSERT INTO staging.match(match_id, start_line, home_name, away_name, start_ts) "
+     "SELECT DISTINCT ON (s.event_data->>'match_id') s.event_data->>'match_id', s.line_no, "
+     "s.event_data->>'home_user_id', s.event_data->>'away_user_id', s.event_timestamp "
+     "FROM staging.event s "
+     "WHERE s.event_type = 'match' AND s.rejection IS NULL AND s.code IS NULL "
+     "AND s.event_data->>'home_goals_scored' IS NULL AND s.event_data->>'match_id' IS NOT NULL AND "
+     + registered_before.format(name="s.event_data->>'home_user_id'", line="s.line_no") + " AND "
+     + registered_before.format(name="s.event_data->>'away_user_id'", line="s.line_no") +
+     " AND NOT EXISTS (SELECT 1 FROM events.match m WHERE m.match_id = s.event_data->>'match_id') "
+     "ORDER BY s.event_data->>'match_id', s.line_no"),
+    ("UPDATE staging.event s SET code = 9 "
+     "WHERE s.event_type = 'match' AND s.rejection IS NULL AND s.code IS NULL "
+     "AND s.event_data->>'home_goals_scored' IS NULL "
+     "AND s.line_no NOT IN (SELECT start_line FROM staging.match)"),
+    # match end. the first end after the start with the same users and later timestamp closes the match
+    ("WITH opened AS ("
+     "SELECT match_id, start_line, home_name, away_name, start_ts, FALSE AS ended FROM staging.match "
+     "UNION ALL "
+     "SELECT m.match_id, 0, home.user_name, away.user_name, EXTRACT(EPOCH FROM e.event_timestamp), "
+     "m.event_id_end IS NOT NULL "
+     "FROM events.match m JOIN users.user home ON m.home_user_id = home.user_id "
+     "JOIN users.user away ON m.away_user_id = away.user_id "
+     "JOIN events.event e ON e.event_id = m.event_id_start "
+     "WHERE m.match_id IN (SELECT event_data->>'match_id' FROM staging.event WHERE event_type = 'match')"
+     "), ending AS ("
+     "SELECT s.line_no, o.match_id, o.ended, "
+     "s.event_data->>'home_user_id' IS NOT DISTINCT FROM o.home_name "
+     "AND s.event_data->>'away_user_id' IS NOT DISTINCT FROM o.away_name AS same_users, "
+     "s.event_timestamp >= o.start_ts AS after_start "
+     "FROM staging.event s LEFT JOIN opened o "
+     "ON o.match_id = s.event_data->>'match_id' AND o.start_line < s.line_no "
+     "WHERE s.event_type = 'match' AND s.rejection IS NULL AND s.code IS NULL "
+     "AND s.event_data->>'home_goals_scored' IS NOT NULL"
+     "), first_end AS ("
+     "SELECT match_id, MIN(line_no) AS line_no FROM ending "
+     "WHERE same_users AND after_start AND NOT ended GROUP BY match_id) "
+     "INSERT INTO staging.match_end(line_no, match_id, code) "
+     "SELECT e.line_no, e.match_id, CASE WHEN e.match_id IS NULL THEN 4 "
+     "WHEN e.ended OR e.line_no > f.line_no THEN 5 "
+     "WHEN NOT e.same_users THEN 6 WHEN NOT e.after_start THEN 7 END "
+     "FROM ending e LEFT JOIN first_end f ON f.match_id = e.match_id"),
+    ("UPDATE staging.event s SET code = me.code FROM staging.match_end me "
+     "WHERE s.line_no = me.line_no AND me.code IS NOT NULL"),
+    ("UPDATE staging.match m SET end_line = me.line_no FROM staging.match_end me "
+     "WHERE m.match_id = me.match_id AND me.code IS NULL"),
+]
+
+bulk_insertion_steps = [
+    ("INSERT INTO users.user(user_id, user_name) SELECT user_id, user_name FROM staging.user ORDER BY user_id"),
+    ("INSERT INTO events.event(event_id, event_timestamp, event_type_id) "
+     "SELECT s.event_id, to_timestamp(s.event_timestamp), t.type_id "
+     "FROM staging.event s JOIN events.type t ON LOWER(t.type_name) = s.event_type "
+     "WHERE s.rejection IS NULL AND s.code IS NULL "
+     "AND (s.event_type <> 'session_ping' OR s.line_no IN (SELECT line_no FROM staging.session)) "
+     "AND s.line_no NOT IN (SELECT start_line FROM staging.match WHERE end_line IS NULL) "
+     "ORDER BY s.line_no"),
+    ("INSERT INTO events.registration(event_id, user_id, device_id, country_code) "
+     "SELECT s.event_id, su.user_id, r.device_id, r.country_id "
+     "FROM staging.registration r JOIN staging.event s ON s.line_no = r.line_no "
+     "JOIN staging.user su ON su.line_no = r.line_no "
+     "WHERE r.code IS NULL"),
+    ("INSERT INTO events.session(event_id_start, event_id_end, user_id, start_ts, end_ts, timezone) "
+     "SELECT start_event.event_id, end_event.event_id, u.user_id, "
+     "to_timestamp(start_event.event_timestamp), to_timestamp(end_event.event_timestamp), "
+     + user_timezone.format(user_id="u.user_id") + " "
+     "FROM staging.session session_start JOIN staging.session session_end "
+     "ON session_end.user_name = session_start.user_name AND session_end.session_no = session_start.session_no "
+     "AND session_end.is_start = 0 "
+     "JOIN staging.event start_event ON start_event.line_no = session_start.line_no "
+     "JOIN staging.event end_event ON end_event.line_no = session_end.line_no "
+     "JOIN users.user u ON u.user_name = session_start.user_name "
+     "WHERE session_start.is_start = 1"),
+    ("INSERT INTO events.match(match_id, event_id_start, event_id_end, home_user_id, away_user_id, "
+     "home_goals_scored, away_goals_scored, start_ts, end_ts, home_timezone, away_timezone) "
+     "SELECT m.match_id, start_event.event_id, end_event.event_id, home.user_id, away.user_id, "
+     "(end_event.event_data->>'home_goals_scored')::INT, (end_event.event_data->>'away_goals_scored')::INT, "
+     "to_timestamp(start_event.event_timestamp), to_timestamp(end_event.event_timestamp), "
+     + user_timezone.format(user_id="home.user_id") + ", " + user_timezone.format(user_id="away.user_id") + " "
+     "FROM staging.match m JOIN staging.event start_event ON start_event.line_no = m.start_line "
+     "JOIN staging.event end_event ON end_event.line_no = m.end_line "
+     "JOIN users.user home ON home.user_name = m.home_name "
+     "JOIN users.user away ON away.user_name = m.away_name"),
+]
+
+
+def copy_chunk_to_staging(opened_cursor, chunk):
+    chunk.seek(0)
+    opened_cursor.copy_expert("COPY staging.event_raw(line_no, raw) FROM STDIN", chunk)
+
+
+# lines that are not valid utf-8 or hold a NUL cannot be copied into a text column. they are copied as NULL, and
+# refused as malformed
+def valid_text(data):
+    try:
+        data.decode('utf-8')
+    except UnicodeDecodeError:
+        return False
+    return b'\0' not in data
+
+
+# line_no is the order of the lines in the file, or in the sorted file. the cleaning rules follow it. the lines of a
+# chunk are checked together, and one by one only if some of them are not valid text.
+def copy_events_to_staging(filename, opened_cursor, sort=False):
+    line_no = 0
+    chunk = io.BytesIO()
+    with event_lines(filename, sort, chunk_bytes=BULK_CHUNK_BYTES) as line_lists:
+        for lines in line_lists:
+            checked = valid_text(b'\n'.join(lines))
+            for line in lines:
+                line = line.strip()
+                if not line:
+                    continue
+                line_no += 1
+                if not (checked or valid_text(line)):
+                    chunk.write(b"%d\t\\N\n" % line_no)
+                    continue
+                # escape the characters that have special meaning in the text format of COPY
+                line = line.replace(b'\\', b'\\\\').replace(b'\t', b'\\t').replace(b'\r', b'\\r')
+                chunk.write(b"%d\t%s\n" % (line_no, line))
+            if chunk.tell() >= BULK_CHUNK_BYTES:
+                copy_chunk_to_staging(opened_cursor, chunk)
+                chunk = io.BytesIO()
+    if chunk.tell():
+        copy_chunk_to_staging(opened_cursor, chunk)
+    return line_no
+
+
+def bulk_insert_into_events(filename, sort=False):
+    unix_date_start, unix_date_end = event_window()
+    create_partitions(unix_date_start, unix_date_end)
+    parameters = {'date_start': unix_date_start, 'date_end': unix_date_end}
+
+    with conn.cursor() as bulk_cursor:
+        conn.rollback()
+        bulk_cursor.execute(f"TRUNCATE {', '.join(bulk_staging_tables)}")
+        started = time.perf_counter()
+        lines = copy_events_to_staging(filename, bulk_cursor, sort)
+        stage_timer.lines += lines
+        print(f"Copied {lines} lines to staging")
+        bulk_cursor.execute("ANALYZE staging.event_raw")
+        started = stage_timer.add('copy to staging', started)
+        for step_no, step in enumerate(bulk_cleaning_steps, 1):
+            bulk_cursor.execute(step, parameters if '%(' in step else None)
+            started = stage_timer.add(f"bulk cleaning step {step_no}", started)
+        for step_no, step in enumerate(bulk_insertion_steps, 1):
+            bulk_cursor.execute(step)
+            started = stage_timer.add(f"bulk insertion step {step_no}", started)
+
+        # same codes as returned by the strategy functions, grouped by event type
+        bulk_cursor.execute("SELECT COALESCE(rejection, event_type || ' ' || code), COUNT(*) "
+                            "FROM staging.event WHERE rejection IS NOT NULL OR code IS NOT NULL "
+                            "GROUP BY 1 ORDER BY 1")
+        rejections = dict(bulk_cursor.fetchall())
+        rejection_log.counts.update(rejections)
+        if rejection_log.filename is not None:
+            # read in blocks by a cursor on the server
+            with conn.cursor(name='rejections') as rejection_cursor:
+                rejection_cursor.itersize = rejection_log.block_rows
+                rejection_cursor.execute("SELECT event_id, event_type, code, rejection FROM staging.event "
+                                         "WHERE rejection IS NOT NULL OR code IS NOT NULL ORDER BY line_no")
+                for rejected in rejection_cursor:
+                    rejection_log.write(*rejected)
+            rejection_log.flush()
+        started = stage_timer.add('rejection log', started)
+        bulk_cursor.execute(f"TRUNCATE {', '.join(bulk_staging_tables)}")
+        conn.commit()
+        stage_timer.add('commit', started)
+    return rejections
+
+
+# daily rollups answering /game_stats and /user_stats. the days of the event window never change once loaded, so
+# only the days touched by a load are recomputed. a session is counted on every day it overlaps, a match on the day
+# it started. for /user_stats, sessions are counted on the day they started and the time of sessions and matches
+# is split between the days they overlap. every rollup is computed twice, over utc days and over the local days of
+# the users. the sessions and matches of the refreshed days are found with a range on their end timestamp, the
+# partition key, so only the partitions from the day before the refreshed days on are read.
+day_buckets = {
+    'session': ("CROSS JOIN LATERAL (VALUES (FALSE, 'UTC', s.start_day, s.end_day), "
+                "(TRUE, s.timezone, s.start_local_day, s.end_local_day)) "
+                "bucket(local_day, timezone, start_day, end_day) "),
+    'match': ("CROSS JOIN LATERAL (VALUES (FALSE, 'UTC', m.start_day, m.end_day), "
+              "(TRUE, player.timezone, player.start_local_day, player.end_local_day)) "
+              "bucket(local_day, timezone, start_day, end_day) "),
+    'days': ("CROSS JOIN generate_series(GREATEST(bucket.start_day, %(first_day)s::DATE)::TIMESTAMP, "
+             "LEAST(bucket.end_day, %(last_day)s::DATE)::TIMESTAMP, INTERVAL '1 day') day "),
+}
+
+match_players = ("CROSS JOIN LATERAL (VALUES "
+                 "(m.home_user_id, CASE WHEN m.home_goals_scored > m.away_goals_scored THEN 3 "
+                 "WHEN m.home_goals_scored = m.away_goals_scored THEN 1 ELSE 0 END, 0, "
+                 "m.home_timezone, m.home_start_local_day, m.home_end_local_day), "
+                 "(m.away_user_id, 0, CASE WHEN m.away_goals_scored > m.home_goals_scored THEN 3 "
+                 "WHEN m.away_goals_scored = m.home_goals_scored THEN 1 ELSE 0 END, "
+                 "m.away_timezone, m.away_start_local_day, m.away_end_local_day)) "
+                 "player(user_id, score_home, score_away, timezone, start_local_day, end_local_day) ")
+
+rollup_steps = [
+    "DELETE FROM stats.user_day_sessions WHERE day BETWEEN %(first_day)s AND %(last_day)s",
+    ("INSERT INTO stats.user_day_sessions(local_day, day, user_id, sessions) "
+     "SELECT bucket.local_day, day::DATE, s.user_id, COUNT(*) FROM events.session s "
+     + day_buckets['session'] + day_buckets['days'] +
+     "WHERE s.end_ts >= (%(first_day)s::DATE - 1)::TIMESTAMP AT TIME ZONE 'UTC' "
+     "GROUP BY 1, 2, 3"),
+    "DELETE FROM stats.user_day_points WHERE day BETWEEN %(first_day)s AND %(last_day)s",
+    ("INSERT INTO stats.user_day_points(local_day, day, user_id, points) "
+     "SELECT bucket.local_day, bucket.start_day, player.user_id, SUM(player.score_home + player.score_away) "
+     "FROM events.match m " + match_players + day_buckets['match'] +
+     "WHERE m.end_ts >= (%(first_day)s::DATE - 1)::TIMESTAMP AT TIME ZONE 'UTC' "
+     "AND bucket.start_day BETWEEN %(first_day)s AND %(last_day)s "
+     "GROUP BY 1, 2, 3"),
+    "DELETE FROM stats.daily_game WHERE day BETWEEN %(first_day)s AND %(last_day)s",
+    ("INSERT INTO stats.daily_game(local_day, day, dau, number_of_sessions, average_sessions_number, "
+     "max_points_users) "
+     "SELECT local_day, day, COALESCE(sessions.dau, 0), COALESCE(sessions.number_of_sessions, 0), "
+     "COALESCE(sessions.average_sessions_number, 0), COALESCE(points.max_points_users, '{}') "
+     "FROM (SELECT local_day, day, COUNT(*) dau, SUM(sessions) number_of_sessions, "
+     "AVG(sessions) average_sessions_number "
+     "FROM stats.user_day_sessions WHERE day BETWEEN %(first_day)s AND %(last_day)s GROUP BY local_day, day) sessions "
+     "FULL JOIN (SELECT p.local_day, p.day, ARRAY_AGG(u.user_name ORDER BY u.user_name) max_points_users "
+     "FROM (SELECT local_day, day, user_id, RANK() OVER (PARTITION BY local_day, day ORDER BY points DESC) points_rank "
+     "FROM stats.user_day_points WHERE day BETWEEN %(first_day)s AND %(last_day)s) p "
+     "JOIN users.user u ON u.user_id = p.user_id WHERE p.points_rank = 1 GROUP BY p.local_day, p.day) points "
+     "USING (local_day, day)"),
+    "DELETE FROM stats.user_day WHERE day BETWEEN %(first_day)s AND %(last_day)s",
+    ("INSERT INTO stats.user_day(user_id, local_day, day, sessions_number, time_spent, score_home, score_away, "
+     "match_time) "
+     "SELECT user_id, local_day, day, SUM(sessions_number), SUM(time_spent), SUM(score_home), SUM(score_away), "
+     "SUM(match_time) FROM ("
+     "SELECT s.user_id, bucket.local_day, day::DATE AS day, "
+     "CASE WHEN day::DATE = bucket.start_day THEN 1 ELSE 0 END sessions_number, "
+     "EXTRACT (EPOCH FROM LEAST(s.end_ts, (day + INTERVAL '1 day') AT TIME ZONE bucket.timezone) "
+     "- GREATEST(s.start_ts, day AT TIME ZONE bucket.timezone)) time_spent, "
+     "0 score_home, 0 score_away, 0 match_time "
+     "FROM events.session s " + day_buckets['session'] + day_buckets['days'] +
+     "WHERE s.end_ts >= (%(first_day)s::DATE - 1)::TIMESTAMP AT TIME ZONE 'UTC' "
+     "UNION ALL "
+     "SELECT player.user_id, bucket.local_day, day::DATE, 0, 0, "
+     "CASE WHEN day::DATE = bucket.start_day THEN player.score_home ELSE 0 END, "
+     "CASE WHEN day::DATE = bucket.start_day THEN player.score_away ELSE 0 END, "
+     "EXTRACT (EPOCH FROM LEAST(m.end_ts, (day + INTERVAL '1 day') AT TIME ZONE bucket.timezone) "
+     "- GREATEST(m.start_ts, day AT TIME ZONE bucket.timezone)) "
+     "FROM events.match m " + match_players + day_buckets['match'] + day_buckets['days'] +
+     "WHERE m.end_ts >= (%(first_day)s::DATE - 1)::TIMESTAMP AT TIME ZONE 'UTC'"
+     ") activity "
+     "GROUP BY user_id, local_day, day"),
+    # the all time summary of the users active on the refreshed days and of the users registered since the last
+    # refresh. user ids only grow, so these are the ones after the last summarised user.
+    ("INSERT INTO stats.user_summary(user_id, user_name, country_id, timezone, registration_ts, last_login, "
+     "last_login_local, sessions_number, time_spent, score_home, score_away, match_time) "
+     "SELECT u.user_id, u.user_name, c.country_id, c.timezone, e.event_timestamp, d.last_login, "
+     "d.last_login_local, COALESCE(d.sessions_number, 0), COALESCE(d.time_spent, 0), COALESCE(d.score_home, 0), "
+     "COALESCE(d.score_away, 0), COALESCE(d.match_time, 0) "
+     "FROM users.user u JOIN events.registration r ON r.user_id = u.user_id "
+     "JOIN events.event e ON e.event_id = r.event_id JOIN country.country c ON c.country_id = r.country_code "
+     "LEFT JOIN LATERAL (SELECT MAX(day) FILTER (WHERE NOT local_day AND sessions_number > 0) last_login, "
+     "MAX(day) FILTER (WHERE local_day AND sessions_number > 0) last_login_local, "
+     "SUM(sessions_number) FILTER (WHERE NOT local_day) sessions_number, "
+     "SUM(time_spent) FILTER (WHERE NOT local_day) time_spent, "
+     "SUM(score_home) FILTER (WHERE NOT local_day) score_home, "
+     "SUM(score_away) FILTER (WHERE NOT local_day) score_away, "
+     "SUM(match_time) FILTER (WHERE NOT local_day) match_time "
+     "FROM stats.user_day WHERE user_id = u.user_id) d ON TRUE "
+     "WHERE u.user_id IN (SELECT user_id FROM stats.user_day WHERE day BETWEEN %(first_day)s AND %(last_day)s "
+     "UNION SELECT user_id FROM users.user WHERE user_id > %(last_summarised_user_id)s) "
+     "ON CONFLICT(user_id) DO UPDATE SET last_login = EXCLUDED.last_login, "
+     "last_login_local = EXCLUDED.last_login_local, "
+     "sessions_number = EXCLUDED.sessions_number, time_spent = EXCLUDED.time_spent, "
+     "score_home = EXCLUDED.score_home, score_away = EXCLUDED.score_away, match_time = EXCLUDED.match_time"),
+    # the all time totals come from the summaries, which count every session once, on the day it started, and keep
+    # the frozen days. sessions overlapping several days are counted once here, so the totals are not a sum of the
+    # days of stats.daily_game
+    ("INSERT INTO stats.total_game(dau, number_of_sessions, average_sessions_number, max_points_users) "
+     "SELECT COUNT(*) FILTER (WHERE sessions_number > 0), COALESCE(SUM(sessions_number), 0), "
+     "COALESCE(SUM(sessions_number) * 1.0 / NULLIF(COUNT(*) FILTER (WHERE sessions_number > 0), 0), 0), "
+     "ARRAY(WITH user_points(user_id, points) AS ("
+     "SELECT user_id, SUM(points) FROM stats.user_day_points WHERE NOT local_day GROUP BY user_id) "
+     "SELECT u.user_name FROM user_points up JOIN users.user u ON u.user_id = up.user_id "
+     "WHERE up.points = (SELECT MAX(points) FROM user_points) ORDER BY u.user_name) "
+     "FROM stats.user_summary "
+     "ON CONFLICT(total_id) DO UPDATE SET dau = EXCLUDED.dau, number_of_sessions = EXCLUDED.number_of_sessions, "
+     "average_sessions_number = EXCLUDED.average_sessions_number, max_points_users = EXCLUDED.max_points_users, "
+     "refreshed_at = now()"),
+]
+
+
+# without timestamps all days are rebuilt, otherwise the days between the two unix timestamps. the utc days are
+# widened by one day on both sides to cover the local days of the same moments. the frozen days are never rebuilt.
+def refresh_rollups(first_timestamp=None, last_timestamp=None):
+    with conn.cursor() as rollup_cursor:
+        if first_timestamp is None:
+            parameters = {'first_day': '-infinity', 'last_day': 'infinity', 'last_summarised_user_id': 0}
+        else:
+            rollup_cursor.execute("SELECT (to_timestamp(%s) AT TIME ZONE 'UTC')::DATE - 1, "
+                                  "(to_timestamp(%s) AT TIME ZONE 'UTC')::DATE + 1",
+                                  (first_timestamp, last_timestamp))
+            first_day, last_day = rollup_cursor.fetchone()
+            rollup_cursor.execute("SELECT COALESCE(MAX(user_id), 0) FROM stats.user_summary")
+            parameters = {'first_day': first_day, 'last_day': last_day,
+                          'last_summarised_user_id': rollup_cursor.fetchone()[0]}
+        rollup_cursor.execute("SELECT GREATEST(%s::DATE, (SELECT before_day FROM stats.frozen_days))",
+                              (parameters['first_day'],))
+        parameters['first_day'] = rollup_cursor.fetchone()[0]
+        for step in rollup_steps:
+            rollup_cursor.execute(step, parameters)
+        # the api sees the new data version and the new rollups at the same time
+        rollup_cursor.execute("UPDATE events.data_version SET version = version + 1, loaded_at = now()")
         conn.commit()
+    if first_timestamp is None:
+        print("Rollups rebuilt")
+    else:
+        print(f"Rollups refreshed from {parameters['first_day']} to {parameters['last_day']}")
 
+
+#data cleansing after data collection
 '''
 def delete_unnecessary_session_pings(free_memory=True):
     query = """
@@ -368,41 +1440,80 @@ def delete_unnecessary_session_pings(free_memory=True):
         conn.autocommit = False
 '''
 
-def delete_sessions_with_no_valid_end():
-    with conn.cursor() as delete_cursor:
-        delete_cursor.execute("DELETE FROM events.event "
-                              "WHERE event_id IN "
-                              "(SELECT event_id FROM events.session "
-                              "WHERE (session_user_id, user_id) IN "
-                              "(SELECT s1.session_user_id, s1.user_id "
-                              "FROM events.session s1 JOIN events.session s2 "
-                              "ON s1.session_user_id = s2.session_user_id "
-                              "AND s1.user_id = s2.user_id AND s1.is_start = s2.is_start "
-                              "GROUP BY s1.session_user_id, s1.user_id  "
-                              "HAVING COUNT(*) != 2))"
-                              )
-        conn.commit()
-
-def vacuum():
+# plain VACUUM (ANALYZE) by default, which does not block the queries of the API. VACUUM FULL rewrites the tables
+# under an exclusive lock and only runs with --vacuum-full.
+def vacuum(full=False):
     conn.autocommit = True
     with conn.cursor() as cursor:
-        cursor.execute("VACUUM FULL events.event")
-        cursor.execute("VACUUM FULL events.match")
-        cursor.execute("VACUUM FULL events.session")
+        for table in ("events.event", "events.match", "events.session", "stats.user_day_sessions",
+                      "stats.user_day_points", "stats.daily_game", "stats.user_day", "stats.user_summary"):
+            cursor.execute(f"VACUUM FULL {table}" if full else f"VACUUM (ANALYZE) {table}")
     conn.autocommit = False
 
+
+# wall time of every stage and its share of the run, the lines read per second of the run and the refused events
+def print_load_summary(seconds):
+    print(f"Load summary. {stage_timer.lines} lines in {seconds:.1f} s, {stage_timer.lines / seconds:.0f} lines/s")
+    for stage, stage_seconds in stage_timer.seconds.items():
+        print(f"{stage:40} {stage_seconds:10.2f} s {stage_seconds / seconds:7.1%}")
+    print(f"{sum(rejection_log.counts.values())} events refused")
+    for key, count in sorted(rejection_log.counts.items()):
+        print(f"{key:40} {count:10} {rejection_reasons.get(key, '')}")
+
 if __name__ == '__main__':
-    if len(sys.argv) < 3:
-        raise Exception('Missing command line parameters: file towards timezones and file towards events')
-    timezones = sys.argv[1]
-    events = sys.argv[2]
-    insert_into_country(timezones)
+    parser = argparse.ArgumentParser(description='Clean the events and insert them into the database.')
+    parser.add_argument('timezones', help='file towards timezones')
+    parser.add_argument('events', help='file towards events')
+    parser.add_argument('--bulk', action='store_true',
+                        help='copy the whole file to staging tables and clean it with set-based queries')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes inserting session pings, partitioned by user')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue the insertion of the events file from its last checkpoint')
+    parser.add_argument('--incremental', action='store_true',
+                        help='append the events file to the existing data, keeping sessions and matches open '
+                             'for the next file')
+    parser.add_argument('--drop-before', type=datetime.date.fromisoformat, metavar='YYYY-MM-DD',
+                        help='after the load, drop the partitions of the sessions and matches of the days before '
+                             'this day')
+    parser.add_argument('--rejections', metavar='FILE',
+                        help='append the refused events to this file, as json lines')
+    parser.add_argument('--sort', action='store_true',
+                        help='sort the events by timestamp and event id before they are inserted, for files that '
+                             'are not in order')
+    parser.add_argument('--vacuum-full', action='store_true',
+                        help='rewrite the tables with VACUUM FULL after the load, which locks them until it is done, '
+                             'instead of a plain VACUUM (ANALYZE)')
+    arguments = parser.parse_args()
+    if (arguments.resume or arguments.incremental) and (arguments.bulk or arguments.workers > 1):
+        parser.error('--resume and --incremental are supported only by the row by row insertion')
+    if arguments.resume and arguments.sort:
+        parser.error('a sorted insertion cannot be resumed, it starts over')
+
+    run_started = time.perf_counter()
+    rejection_log.filename = arguments.rejections
+    with stage_timer.stage('country insert'):
+        insert_into_country(arguments.timezones)
     print("Country insertion successful")
-    insert_into_events(events)
+    if arguments.bulk:
+        bulk_insert_into_events(arguments.events, arguments.sort)
+    elif arguments.workers > 1:
+        parallel_insert_into_events(arguments.events, arguments.workers, arguments.sort)
+    else:
+        first_timestamp, last_timestamp = insert_into_events(arguments.events, arguments.resume,
+                                                             arguments.incremental, arguments.sort)
     print("Event insertion successful")
-    delete_sessions_with_no_valid_end()
-    print("Session deletion successful")
-    delete_bad_matches()
-    print("Match deletion is successful")
-    vacuum()
-    conn.close()
\ No newline at end of file
+    # a resumed load may have inserted events before its checkpoint in an earlier run, so it rebuilds every day
+    with stage_timer.stage('rollups'):
+        if arguments.incremental and not arguments.resume:
+            if first_timestamp is not None:
+                refresh_rollups(first_timestamp, last_timestamp)
+        else:
+            refresh_rollups()
+    if arguments.drop_before is not None:
+        with stage_timer.stage('drop partitions'):
+            drop_partitions(arguments.drop_before)
+    with stage_timer.stage('vacuum'):
+        vacuum(full=arguments.vacuum_full)
+    conn.close()
+    print_load_summary(time.perf_counter() - run_started)
@@ -36,22 +36,224 @@ CREATE TABLE events.Registration (
     country_code CHAR(2) NOT NULL REFERENCES country.Country(country_id)
 );
 
+-- sessions and matches are partitioned by the utc day they end on, one partition per day named after the day
+-- (events.session_20241007). data_collection.py creates the partitions of the days it loads, and drops the partitions
+-- of old days with --drop-before. events.event is not partitioned: event ids must stay unique across all days.
 CREATE TABLE events.Match (
-  match_id TEXT PRIMARY KEY NOT NULL,
+  match_id TEXT NOT NULL,
   event_id_start BIGINT NOT NULL REFERENCES events.Event (event_id) ON DELETE CASCADE,
   event_id_end BIGINT REFERENCES events.Event(event_id),
   home_user_id BIGINT NOT NULL REFERENCES users.User(user_id),
   away_user_id BIGINT NOT NULL REFERENCES users.User(user_id),
   home_goals_scored INT,
-  away_goals_scored INT
-);
+  away_goals_scored INT,
+  start_ts TIMESTAMPTZ NOT NULL,
+  end_ts TIMESTAMPTZ NOT NULL,
+  home_timezone VARCHAR(50) NOT NULL,
+  away_timezone VARCHAR(50) NOT NULL,
+  start_day DATE GENERATED ALWAYS AS ((start_ts AT TIME ZONE 'UTC')::DATE) STORED,
+  end_day DATE GENERATED ALWAYS AS ((end_ts AT TIME ZONE 'UTC')::DATE) STORED,
+  home_start_local_day DATE GENERATED ALWAYS AS ((start_ts AT TIME ZONE home_timezone)::DATE) STORED,
+  home_end_local_day DATE GENERATED ALWAYS AS ((end_ts AT TIME ZONE home_timezone)::DATE) STORED,
+  away_start_local_day DATE GENERATED ALWAYS AS ((start_ts AT TIME ZONE away_timezone)::DATE) STORED,
+  away_end_local_day DATE GENERATED ALWAYS AS ((end_ts AT TIME ZONE away_timezone)::DATE) STORED,
+  PRIMARY KEY (match_id, end_ts)
+) PARTITION BY RANGE (end_ts);
 
 CREATE TABLE events.Session (
-    event_id BIGINT PRIMARY KEY REFERENCES events.Event(event_id) ON DELETE CASCADE,
+    event_id_start BIGINT NOT NULL REFERENCES events.Event(event_id) ON DELETE CASCADE,
+    event_id_end BIGINT NOT NULL REFERENCES events.Event(event_id) ON DELETE CASCADE,
     user_id BIGINT NOT NULL REFERENCES users.User(user_id),
-    session_user_id BIGINT NOT NULL,
-    is_start SMALLINT NOT NULL CHECK(is_start = 1 OR is_start = 0)
-);
+    start_ts TIMESTAMPTZ NOT NULL,
+    end_ts TIMESTAMPTZ NOT NULL,
+    duration DOUBLE PRECISION GENERATED ALWAYS AS (EXTRACT(EPOCH FROM end_ts - start_ts)) STORED,
+    timezone VARCHAR(50) NOT NULL,
+    start_day DATE GENERATED ALWAYS AS ((start_ts AT TIME ZONE 'UTC')::DATE) STORED,
+    end_day DATE GENERATED ALWAYS AS ((end_ts AT TIME ZONE 'UTC')::DATE) STORED,
+    start_local_day DATE GENERATED ALWAYS AS ((start_ts AT TIME ZONE timezone)::DATE) STORED,
+    end_local_day DATE GENERATED ALWAYS AS ((end_ts AT TIME ZONE timezone)::DATE) STORED,
+    PRIMARY KEY (event_id_start, end_ts)
+) PARTITION BY RANGE (end_ts);
+
+-- indexes for the lookups of the api by user, and for the foreign keys checked when the loader deletes refused
+-- events or users. basic_tests/test_query_plans.py checks that the queries use them.
+CREATE INDEX registration_user_id_idx ON events.Registration(user_id);
+CREATE INDEX session_user_id_idx ON events.Session(user_id, start_ts);
+CREATE INDEX session_event_id_end_idx ON events.Session(event_id_end);
+CREATE INDEX match_home_user_id_idx ON events.Match(home_user_id);
+CREATE INDEX match_away_user_id_idx ON events.Match(away_user_id);
+CREATE INDEX match_event_id_start_idx ON events.Match(event_id_start);
+CREATE INDEX match_event_id_end_idx ON events.Match(event_id_end);
+-- the day buckets above are the utc day and the local day of the user (timezone of the registration country).
+-- a local day is at most one day away from the utc day, so the queries on a range of days, whichever day semantics
+-- they use, read only the partitions from the day before the range on.
 
 INSERT INTO events.Type(type_name) VALUES ('registration'), ('session_ping'), ('match');
-INSERT INTO device.Device(device_os) VALUES ('ios'), ('android'), ('web');
\ No newline at end of file
+INSERT INTO device.Device(device_os) VALUES ('ios'), ('android'), ('web');
+
+-- daily rollups answering /game_stats and /user_stats, rebuilt or refreshed by data_collection.py after every load.
+-- local_day tells whether the rows are computed over the local days of the users or over utc days.
+CREATE SCHEMA stats;
+
+CREATE TABLE stats.User_Day_Sessions (
+    local_day BOOLEAN NOT NULL,
+    day DATE NOT NULL,
+    user_id BIGINT NOT NULL REFERENCES users.User(user_id),
+    sessions BIGINT NOT NULL,
+    PRIMARY KEY (day, local_day, user_id)
+);
+
+CREATE TABLE stats.User_Day_Points (
+    local_day BOOLEAN NOT NULL,
+    day DATE NOT NULL,
+    user_id BIGINT NOT NULL REFERENCES users.User(user_id),
+    points BIGINT NOT NULL,
+    PRIMARY KEY (day, local_day, user_id)
+);
+
+CREATE INDEX user_day_sessions_user_id_idx ON stats.User_Day_Sessions(user_id);
+CREATE INDEX user_day_points_user_id_idx ON stats.User_Day_Points(user_id);
+
+CREATE TABLE stats.Daily_Game (
+    local_day BOOLEAN NOT NULL,
+    day DATE NOT NULL,
+    dau BIGINT NOT NULL,
+    number_of_sessions BIGINT NOT NULL,
+    average_sessions_number NUMERIC NOT NULL,
+    max_points_users TEXT[] NOT NULL,
+    PRIMARY KEY (day, local_day)
+);
+
+CREATE TABLE stats.Total_Game (
+    total_id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (total_id),
+    dau BIGINT NOT NULL,
+    number_of_sessions BIGINT NOT NULL,
+    average_sessions_number NUMERIC NOT NULL,
+    max_points_users TEXT[] NOT NULL,
+    refreshed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- the days before before_day are frozen: the partitions of sessions and matches they are computed from were dropped
+-- (data_collection.py --drop-before), so their rollups are kept as they are and never recomputed.
+CREATE TABLE stats.Frozen_Days (
+    frozen_id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (frozen_id),
+    before_day DATE NOT NULL
+);
+
+CREATE TABLE stats.User_Day (
+    user_id BIGINT NOT NULL REFERENCES users.User(user_id),
+    local_day BOOLEAN NOT NULL,
+    day DATE NOT NULL,
+    sessions_number BIGINT NOT NULL,
+    time_spent NUMERIC NOT NULL,
+    score_home BIGINT NOT NULL,
+    score_away BIGINT NOT NULL,
+    match_time NUMERIC NOT NULL,
+    PRIMARY KEY (user_id, local_day, day)
+);
+
+CREATE INDEX user_day_day_idx ON stats.User_Day(day);
+
+CREATE TABLE stats.User_Summary (
+    user_id BIGINT PRIMARY KEY REFERENCES users.User(user_id),
+    user_name TEXT UNIQUE NOT NULL,
+    country_id CHAR(2) NOT NULL,
+    timezone VARCHAR(50) NOT NULL,
+    registration_ts TIMESTAMPTZ NOT NULL,
+    last_login DATE,
+    last_login_local DATE,
+    sessions_number BIGINT NOT NULL,
+    time_spent NUMERIC NOT NULL,
+    score_home BIGINT NOT NULL,
+    score_away BIGINT NOT NULL,
+    match_time NUMERIC NOT NULL
+);
+
+-- bumped by data_collection.py together with the rollups, the api drops its cached responses when it changes
+CREATE TABLE events.Data_Version (
+    data_version_id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (data_version_id),
+    version BIGINT NOT NULL,
+    loaded_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+INSERT INTO events.Data_Version(version) VALUES (0);
+
+-- progress of the row by row insertion of an events file, see data_collection.py --resume
+CREATE TABLE events.Load_Checkpoint (
+    file_name TEXT PRIMARY KEY,
+    byte_offset BIGINT NOT NULL,
+    open_sessions JSONB NOT NULL,
+    open_matches JSONB NOT NULL,
+    saved_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- sessions and matches still open at the end of the last incremental insertion, see data_collection.py --incremental
+CREATE TABLE events.Carry_Over (
+    carry_over_id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (carry_over_id),
+    open_sessions JSONB NOT NULL,
+    open_matches JSONB NOT NULL,
+    saved_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- staging tables used by the bulk loader (data_collection.py --bulk). They are unlogged since their content
+-- is truncated on every load and does not need to survive a crash.
+CREATE SCHEMA staging;
+
+CREATE UNLOGGED TABLE staging.Event_Raw (
+    line_no BIGINT NOT NULL,
+    raw TEXT
+);
+
+CREATE UNLOGGED TABLE staging.Event (
+    line_no BIGINT PRIMARY KEY,
+    event_id BIGINT,
+    event_type TEXT,
+    event_timestamp DOUBLE PRECISION,
+    event_data JSONB,
+    rejection TEXT,
+    code SMALLINT
+);
+
+CREATE UNLOGGED TABLE staging.Registration (
+    line_no BIGINT PRIMARY KEY,
+    user_name TEXT,
+    attempt BIGINT NOT NULL,
+    device_id BIGINT,
+    country_id CHAR(2),
+    code SMALLINT
+);
+
+CREATE UNLOGGED TABLE staging.User (
+    user_name TEXT PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    line_no BIGINT NOT NULL
+);
+
+CREATE UNLOGGED TABLE staging.Session (
+    line_no BIGINT PRIMARY KEY,
+    user_name TEXT NOT NULL,
+    session_no BIGINT NOT NULL,
+    is_start SMALLINT NOT NULL
+);
+
+CREATE UNLOGGED TABLE staging.Match (
+    match_id TEXT PRIMARY KEY,
+    start_line BIGINT NOT NULL,
+    home_name TEXT NOT NULL,
+    away_name TEXT NOT NULL,
+    start_ts DOUBLE PRECISION NOT NULL,
+    end_line BIGINT
+);
+
+CREATE UNLOGGED TABLE staging.Match_End (
+    line_no BIGINT PRIMARY KEY,
+    match_id TEXT,
+    code SMALLINT
+);
+
+-- the event id of every line spooled by the parallel loader (data_collection.py --workers), and the spool it went to
+CREATE UNLOGGED TABLE staging.Event_Owner (
+    line_no BIGINT PRIMARY KEY,
+    event_id BIGINT NOT NULL,
+    spool TEXT NOT NULL
+);
@@ -0,0 +1,167 @@
+import os
+import sys
+import gzip
+import json
+import heapq
+import tempfile
+import contextlib
+
+# reading of the events files. the file is read in large binary chunks that are split into lines at once instead of
+# line by line, and the lines are decoded with orjson when it is installed. gzip compressed files are decompressed
+# while they are read. files that are not in the order of the events can be sorted on the way, with an external
+# merge sort: runs of the file that fit in memory are sorted and written to disk, then merged.
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+READER_CHUNK_BYTES = int(os.environ.get('READER_CHUNK_BYTES', default=4 * 1024 * 1024))
+READER_BATCH_LINES = int(os.environ.get('READER_BATCH_LINES', default=1000))
+SORT_RUN_BYTES = int(os.environ.get('SORT_RUN_BYTES', default=128 * 1024 * 1024))
+
+REQUIRED_EVENT_KEYS = ('event_id', 'event_data', 'event_timestamp', 'event_type')
+
+# memory a line of a run takes besides its bytes: the tuple of its key and line, the objects of the key, the header
+# of the bytes object and the slot in the list. SORT_RUN_BYTES counts it, so it bounds the memory of a run.
+RUN_ENTRY_BYTES = (sys.getsizeof((0.0, 0, 0, b'')) + sys.getsizeof(0.0) + 2 * sys.getsizeof(2 ** 40)
+                   + sys.getsizeof(b'') + 8)
+
+
+# the file in binary mode, decompressed if it starts with the magic number of gzip
+def open_events(filename):
+    with open(filename, 'rb') as events:
+        compressed = events.read(2) == b'\x1f\x8b'
+    return gzip.open(filename, 'rb') if compressed else open(filename, 'rb')
+
+
+# the lines of the file from its current position, without the line ends, in one list per chunk
+def read_lines(events, chunk_bytes=READER_CHUNK_BYTES):
+    rest = b''
+    chunk = events.read(chunk_bytes)
+    while chunk:
+        lines = (rest + chunk).split(b'\n')
+        rest = lines.pop()
+        yield lines
+        chunk = events.read(chunk_bytes)
+    if rest:
+        yield [rest]
+
+
+# returns the event, or None if the line is not valid json, misses one of the required keys, or one of them has the
+# wrong type: event_id must be an integer that fits a BIGINT, event_timestamp a number, event_type a string and
+# event_data an object. booleans are not numbers here, although python counts them as integers.
+def parse_event(line):
+    try:
+        event = loads(line)
+    except ValueError:
+        return None
+    if not (isinstance(event, dict) and 'event_id' in event and 'event_data' in event
+            and 'event_timestamp' in event and 'event_type' in event):
+        return None
+    event_id = event['event_id']
+    if not (type(event_id) is int and -2 ** 63 <= event_id < 2 ** 63
+            and type(event['event_timestamp']) in (int, float)
+            and isinstance(event['event_type'], str) and isinstance(event['event_data'], dict)):
+        return None
+    return event
+
+
+# returns the event and the name of its refusal, malformed or out_of_window, or None. the line is decoded before it
+# is checked: looking for the keys or the timestamp in its bytes costs more than decoding it with orjson.
+def parse_line(line, date_start, date_end):
+    event = parse_event(line)
+    if event is None:
+        return None, 'malformed'
+    if not (date_start <= event['event_timestamp'] <= date_end):
+        return event, 'out_of_window'
+    return event, None
+
+
+# the line is sorted by event_timestamp, event_id and its position in the file, so duplicates keep their order. the
+# key is defined for every line: the lines parse_event refuses come first, before every event id, and so do the
+# timestamps that are not a number (NaN, which the json module accepts). timestamps too large for a float are
+# infinite.
+def sort_key(line, line_no):
+    event = parse_event(line)
+    if event is None:
+        return float('-inf'), -2 ** 63 - 1, line_no
+    try:
+        event_timestamp = float(event['event_timestamp'])
+    except OverflowError:
+        event_timestamp = float('inf') if event['event_timestamp'] > 0 else float('-inf')
+    if event_timestamp != event_timestamp:
+        event_timestamp = float('-inf')
+    return event_timestamp, event['event_id'], line_no
+
+
+def write_run(run, filename):
+    run.sort()
+    with open(filename, 'wb') as run_file:
+        run_file.writelines(b'%s\t%d\t%d\t%s\n' % (repr(event_timestamp).encode(), event_id, line_no, line)
+                            for event_timestamp, event_id, line_no, line in run)
+
+
+def read_run(filename):
+    with open(filename, 'rb') as run_file:
+        for record in run_file:
+            event_timestamp, event_id, line_no, line = record[:-1].split(b'\t', 3)
+            yield float(event_timestamp), int(event_id), int(line_no), line
+
+
+# the lines of the file sorted by sort_key, in lists of batch_lines. the file is read once and split into runs of
+# run_bytes of memory, the runs are sorted in memory and written to the directory, except for the last one, and the
+# runs are merged while the lines are read.
+def sort_lines(filename, directory, run_bytes=SORT_RUN_BYTES, batch_lines=READER_BATCH_LINES):
+    run_filenames = []
+    run = []
+    run_size = 0
+    line_no = 0
+    with open_events(filename) as events:
+        for lines in read_lines(events):
+            for line in lines:
+                run.append(sort_key(line, line_no) + (line,))
+                line_no += 1
+                run_size += len(line) + RUN_ENTRY_BYTES
+                if run_size >= run_bytes:
+                    run_filenames.append(os.path.join(directory, f"run_{len(run_filenames)}"))
+                    write_run(run, run_filenames[-1])
+                    run = []
+                    run_size = 0
+    run.sort()
+
+    def merge():
+        batch = []
+        for _, _, _, line in heapq.merge(*[read_run(run_filename) for run_filename in run_filenames], run):
+            batch.append(line)
+            if len(batch) == batch_lines:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    return merge()
+
+
+# the lines of the file in lists, from the offset in the decompressed file, or sorted by sort_key. a sorted file
+# cannot be read from an offset. the runs are written and sorted when the context is entered.
+@contextlib.contextmanager
+def event_lines(filename, sort=False, offset=0, chunk_bytes=READER_CHUNK_BYTES):
+    if sort:
+        with tempfile.TemporaryDirectory() as directory:
+            yield sort_lines(filename, directory)
+    else:
+        with open_events(filename) as events:
+            events.seek(offset)
+            yield read_lines(events, chunk_bytes)
+
+
+# lists of at most batch_lines (offset, line, event, refusal) of the lists of lines, where offset is the position in
+# the decompressed file after the line, to continue from. offset is the position the lines are read from.
+def read_event_batches(line_lists, date_start, date_end, offset=0, batch_lines=READER_BATCH_LINES):
+    for lines in line_lists:
+        for first in range(0, len(lines), batch_lines):
+            batch = []
+            for line in lines[first:first + batch_lines]:
+                offset += len(line) + 1
+                batch.append((offset, line) + parse_line(line, date_start, date_end))
+            yield batch